@@ -0,0 +1,54 @@
+import os
+from collections import defaultdict
+
+import pytest
+
+from hsarchetypes.signatures import calculate_signature_weights
+from hsarchetypes.synthetic import generate_input_data
+
+
+# (classes, clusters per class, decks per cluster)
+SCALES = {
+	"small": (1, 3, 20),
+	"medium": (1, 8, 100),
+	"large": (1, 20, 250),
+}
+
+# Run with e.g. HSARCHETYPES_BENCHMARK_SCALES=small,medium,large
+BENCHMARK_SCALES = os.environ.get("HSARCHETYPES_BENCHMARK_SCALES", "small,medium").split(",")
+
+
+@pytest.fixture(scope="session", params=BENCHMARK_SCALES)
+def data_points(request):
+	num_classes, clusters_per_class, decks_per_cluster = SCALES[request.param]
+	input_data = generate_input_data(
+		num_classes=num_classes,
+		clusters_per_class=clusters_per_class,
+		decks_per_cluster=decks_per_cluster,
+		seed=0
+	)
+	return input_data["DRUID"]
+
+
+@pytest.fixture(scope="session")
+def cluster_data(data_points):
+	result = defaultdict(list)
+	for data_point in data_points:
+		result[data_point["archetype"]].append(data_point)
+	# calculate_signature_weights expects (cluster_id, data_points) pairs
+	return list(result.items())
+
+
+@pytest.fixture(scope="session")
+def signatures(cluster_data):
+	return calculate_signature_weights(cluster_data)
+
+
+@pytest.fixture(scope="session")
+def classifier_clusters(signatures):
+	return {
+		archetype_id: {
+			"signature_weights": {int(dbf_id): weight for dbf_id, weight in signature.items()}
+		}
+		for archetype_id, signature in signatures.items()
+	}
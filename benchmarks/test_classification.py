@@ -0,0 +1,33 @@
+import pytest
+
+from hsarchetypes.classification import classify_deck
+from hsarchetypes.metrics import ClassificationMetrics
+
+
+pytest.importorskip("pytest_benchmark")
+
+
+def test_classify_deck(benchmark, data_points, classifier_clusters):
+	decks = [
+		{int(dbf_id): count for dbf_id, count in d["cards"].items()} for d in data_points[:200]
+	]
+
+	def classify_all():
+		return [classify_deck(deck, classifier_clusters) for deck in decks]
+
+	result = benchmark(classify_all)
+	assert len(result) == len(decks)
+
+
+def test_classify_deck_with_metrics(benchmark, data_points, classifier_clusters):
+	# Compare with test_classify_deck for the overhead of the metrics
+	decks = [
+		{int(dbf_id): count for dbf_id, count in d["cards"].items()} for d in data_points[:200]
+	]
+	metrics = ClassificationMetrics()
+
+	def classify_all():
+		return [classify_deck(deck, classifier_clusters, metrics=metrics) for deck in decks]
+
+	benchmark(classify_all)
+	assert sum(metrics.to_dict()["latency"]["counts"]) >= len(decks)
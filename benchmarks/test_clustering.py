@@ -0,0 +1,47 @@
+from copy import deepcopy
+
+import pytest
+from hearthstone.enums import CardClass
+
+from hsarchetypes.clustering import (
+	SIMILARITY_THRESHOLD_FLOOR, ClassClusters, Cluster, ClusterSet, create_cluster_set
+)
+from hsarchetypes.decks import DeckMatrix
+
+
+pytest.importorskip("pytest_benchmark")
+
+
+def _cluster_set(cluster_data):
+	# Split every archetype in two, so that consolidation has clusters to merge
+	cluster_set = ClusterSet()
+	clusters = []
+	for archetype, data_points in cluster_data:
+		data_points = deepcopy(data_points)
+		for half in (data_points[::2], data_points[1::2]):
+			if half:
+				clusters.append(Cluster.create(Cluster, cluster_set, len(clusters), half))
+	class_cluster = ClassClusters.create(ClassClusters, cluster_set, CardClass.DRUID, clusters)
+	cluster_set.class_clusters = [class_cluster]
+	class_cluster.update_cluster_signatures()
+	return cluster_set
+
+
+def test_consolidate_clusters(benchmark, cluster_data):
+	def setup():
+		return (_cluster_set(cluster_data), ), {}
+
+	def consolidate(cluster_set):
+		cluster_set.consolidate_clusters(SIMILARITY_THRESHOLD_FLOOR)
+
+	benchmark.pedantic(consolidate, setup=setup, rounds=3)
+
+
+def test_create_cluster_set(benchmark, data_points):
+	pytest.importorskip("sklearn")
+	input_data = {"DRUID": DeckMatrix.from_data_points(data_points)}
+
+	cluster_set = benchmark.pedantic(
+		create_cluster_set, args=(input_data, ), kwargs={"num_clusters": 10}, rounds=1
+	)
+	assert cluster_set.class_clusters
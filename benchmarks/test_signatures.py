@@ -0,0 +1,24 @@
+from itertools import combinations
+
+import pytest
+
+from hsarchetypes.clustering import signature_similarity
+from hsarchetypes.signatures import calculate_signature_weights
+
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.mark.parametrize("use_ccp", [True, False])
+def test_calculate_signature_weights(benchmark, cluster_data, use_ccp):
+	result = benchmark(calculate_signature_weights, cluster_data, use_ccp=use_ccp)
+	assert len(result) == len(cluster_data)
+
+
+def test_signature_similarity(benchmark, signatures):
+	pairs = list(combinations(signatures.values(), 2))
+
+	def compare_all():
+		return [signature_similarity(a, b) for a, b in pairs]
+
+	benchmark(compare_all)
@@ -0,0 +1,38 @@
+import json
+
+from .throughput import find_regressions, main, run
+
+
+def test_find_regressions():
+	baseline = {"classify_deck": {"10": {"decks_per_second": 1000.0}}}
+
+	results = {"classify_deck": {"10": {"decks_per_second": 850.0}, "50": {"decks_per_second": 1}}}
+	assert find_regressions(results, baseline, tolerance=0.2) == []
+
+	results = {"classify_deck": {"10": {"decks_per_second": 750.0}}}
+	assert len(find_regressions(results, baseline, tolerance=0.2)) == 1
+
+
+def test_run(tmpdir):
+	results = run(cluster_counts=[5], num_decks=20, batch_size=10)
+	for classifier in ("classify_deck", "compiled_batch"):
+		metrics = results[classifier]["5"]
+		assert metrics["decks_per_second"] > 0
+		assert metrics["p50_ms"] <= metrics["p99_ms"]
+
+	# Latencies are per deck for both classifiers; batches also report their own
+	assert "batch_p50_ms" not in results["classify_deck"]["5"]
+	batch_metrics = results["compiled_batch"]["5"]
+	assert batch_metrics["batch_size"] == 10
+	assert batch_metrics["batch_p50_ms"] <= batch_metrics["batch_p99_ms"]
+	assert batch_metrics["p50_ms"] < batch_metrics["batch_p50_ms"]
+
+	path = str(tmpdir.join("throughput.json"))
+	args = ["--baseline", path, "--cluster-counts", "5", "--num-decks", "20"]
+	assert main(args) == 0
+	with open(path) as f:
+		baseline = json.load(f)
+	baseline["classify_deck"]["5"]["decks_per_second"] *= 1000
+	with open(path, "w") as f:
+		json.dump(baseline, f)
+	assert main(args) == 1
@@ -0,0 +1,190 @@
+"""
+Classification throughput and latency regression harness.
+
+Replays a fixed synthetic corpus of decks through classify_deck and the compiled
+batch classifier against clusters dicts of increasing size, and reports decks/sec
+and p50/p99 latency per deck for each, plus the p50/p99 latency of a whole batch
+for the batch classifier. Results are compared to a baseline JSON file, and the
+run fails if the throughput of any configuration drops by more than the tolerance:
+
+	python -m benchmarks.throughput --baseline throughput.json --tolerance 0.2
+
+The baseline is written when it does not exist yet, or with --update-baseline.
+Baselines are machine specific and should be recorded on the machine they gate.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from hearthstone.enums import CardClass
+
+from hsarchetypes.classification import classify_deck
+from hsarchetypes.compiled import CompiledClassifier, write_classifier
+from hsarchetypes.signatures import calculate_signature_weights
+from hsarchetypes.synthetic import generate_input_data
+
+
+CLUSTER_COUNTS = (10, 50, 200)
+NUM_DECKS = 1000
+BATCH_SIZE = 100
+TOLERANCE = 0.2
+SEED = 0
+
+
+def build_corpus(num_decks=NUM_DECKS, seed=SEED):
+	"""Return `num_decks` synthetic Druid decks, as maps of dbf_id (int) to count."""
+	data_points = generate_input_data(
+		num_classes=1, clusters_per_class=10, decks_per_cluster=-(-num_decks // 10), seed=seed
+	)["DRUID"]
+	return [
+		{int(dbf_id): count for dbf_id, count in d["cards"].items()}
+		for d in data_points[:num_decks]
+	]
+
+
+def build_clusters(num_clusters, seed=SEED):
+	"""Return a clusters dict for classify_deck with `num_clusters` synthetic archetypes."""
+	data_points = generate_input_data(
+		num_classes=1, clusters_per_class=num_clusters, decks_per_cluster=20, seed=seed + 1
+	)["DRUID"]
+	cluster_data = {}
+	for data_point in data_points:
+		cluster_data.setdefault(data_point["archetype"], []).append(data_point)
+	signatures = calculate_signature_weights(list(cluster_data.items()))
+	return {
+		archetype_id: {
+			"signature_weights": {int(dbf_id): weight for dbf_id, weight in signature.items()}
+		}
+		for archetype_id, signature in signatures.items()
+	}
+
+
+def _percentile(sorted_values, percentile):
+	index = int(round(percentile / 100.0 * (len(sorted_values) - 1)))
+	return sorted_values[index]
+
+
+def measure(classify_batch, decks, batch_size=1):
+	"""
+	Classify `decks` in batches of `batch_size` with `classify_batch` and return the
+	throughput and the p50/p99 latency per deck in milliseconds, which for batches
+	is the latency of the batch divided by its size. With a batch_size above 1, the
+	p50/p99 latency of a whole batch is returned as well, as batch_p50_ms and
+	batch_p99_ms.
+	"""
+	latencies = []
+	batch_latencies = []
+	start = time.perf_counter()
+	for i in range(0, len(decks), batch_size):
+		batch = decks[i:i + batch_size]
+		batch_start = time.perf_counter()
+		classify_batch(batch)
+		batch_latency = time.perf_counter() - batch_start
+		batch_latencies.append(batch_latency)
+		latencies.append(batch_latency / len(batch))
+	elapsed = time.perf_counter() - start
+
+	latencies.sort()
+	result = OrderedDict([
+		("decks_per_second", len(decks) / elapsed),
+		("batch_size", batch_size),
+		("p50_ms", _percentile(latencies, 50) * 1000),
+		("p99_ms", _percentile(latencies, 99) * 1000),
+	])
+	if batch_size > 1:
+		batch_latencies.sort()
+		result["batch_p50_ms"] = _percentile(batch_latencies, 50) * 1000
+		result["batch_p99_ms"] = _percentile(batch_latencies, 99) * 1000
+	return result
+
+
+def run(cluster_counts=CLUSTER_COUNTS, num_decks=NUM_DECKS, batch_size=BATCH_SIZE):
+	"""Return the measurements as {classifier: {number of clusters: metrics}}."""
+	decks = build_corpus(num_decks)
+	results = OrderedDict([("classify_deck", OrderedDict()), ("compiled_batch", OrderedDict())])
+	for num_clusters in cluster_counts:
+		clusters = build_clusters(num_clusters)
+		results["classify_deck"][str(num_clusters)] = measure(
+			lambda batch: [classify_deck(deck, clusters) for deck in batch], decks
+		)
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, "classifier.npz")
+			write_classifier({CardClass.DRUID: clusters}, path)
+			classifier = CompiledClassifier.load(path)
+		results["compiled_batch"][str(num_clusters)] = measure(
+			lambda batch: classifier.classify_batch(batch, CardClass.DRUID),
+			decks,
+			batch_size=batch_size
+		)
+	return results
+
+
+def find_regressions(results, baseline, tolerance=TOLERANCE):
+	"""
+	Return a description of every configuration whose throughput is more than
+	`tolerance` (a fraction) below the baseline. Configurations missing from either
+	side are ignored.
+	"""
+	regressions = []
+	for classifier, by_size in results.items():
+		for num_clusters, metrics in by_size.items():
+			expected = baseline.get(classifier, {}).get(num_clusters)
+			if not expected:
+				continue
+			minimum = expected["decks_per_second"] * (1 - tolerance)
+			if metrics["decks_per_second"] < minimum:
+				regressions.append("%s with %s clusters: %.0f decks/sec, baseline %.0f" % (
+					classifier, num_clusters, metrics["decks_per_second"],
+					expected["decks_per_second"]
+				))
+	return regressions
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("--baseline", default="throughput.json")
+	parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+	parser.add_argument("--update-baseline", action="store_true")
+	parser.add_argument(
+		"--cluster-counts", default=",".join(str(n) for n in CLUSTER_COUNTS)
+	)
+	parser.add_argument("--num-decks", type=int, default=NUM_DECKS)
+	args = parser.parse_args(args)
+
+	results = run(
+		cluster_counts=[int(n) for n in args.cluster_counts.split(",")],
+		num_decks=args.num_decks
+	)
+	for classifier, by_size in results.items():
+		for num_clusters, metrics in by_size.items():
+			line = "%-16s %5s clusters: %10.0f decks/sec  per deck p50 %8.3f ms  p99 %8.3f ms" % (
+				classifier, num_clusters, metrics["decks_per_second"],
+				metrics["p50_ms"], metrics["p99_ms"]
+			)
+			if "batch_p50_ms" in metrics:
+				line += "  per batch of %i p50 %8.3f ms  p99 %8.3f ms" % (
+					metrics["batch_size"], metrics["batch_p50_ms"], metrics["batch_p99_ms"]
+				)
+			print(line)
+
+	if args.update_baseline or not os.path.exists(args.baseline):
+		with open(args.baseline, "w") as f:
+			json.dump(results, f, indent=4)
+		print("Wrote baseline to %s" % (args.baseline))
+		return 0
+
+	with open(args.baseline) as f:
+		baseline = json.load(f)
+	regressions = find_regressions(results, baseline, tolerance=args.tolerance)
+	for regression in regressions:
+		print("REGRESSION: %s" % (regression))
+	return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
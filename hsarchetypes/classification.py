@@ -1,8 +1,10 @@
+import time
+
 from .rules import FALSE_POSITIVE_RULES
 from .utils import to_prediction_vector_from_dbf_map
 
 
-def classify_deck(deck, clusters, failure_callback=None):
+def classify_deck(deck, clusters, failure_callback=None, metrics=None):
 	"""Attempt to classify the specified deck to one of the target archetype clusters.
 
 	Each cluster in the array of cluster data should be a dict with the following keys:
@@ -13,12 +15,20 @@ def classify_deck(deck, clusters, failure_callback=None):
 	The (optional) failure callback is invoked when a deck was blocked from a possible
 	classification by the application of a required card check or false positive rule.
 
+	The (optional) metrics object counts the outcome, the rejections and the latency
+	of the classification.
+
 	:param deck: the deck, as a map of dbf_id (int) to included count
 	:param clusters: an array of cluster objects as above
 	:param failure_callback: the failure callback, or None
+	:param metrics: a ClassificationMetrics instance, or None
 	:return: the nearest above-threshold classification for the deck, or None
 	"""
 
+	if metrics is not None:
+		start = time.perf_counter()
+		failure_callback = metrics.failure_callback(failure_callback)
+
 	distances = []
 	archetype_normalizers, cutoff_threshold = calculate_archetype_normalizers(clusters)
 
@@ -73,9 +83,14 @@ def classify_deck(deck, clusters, failure_callback=None):
 		if distance and distance >= cutoff_threshold:
 			distances.append((cluster_id, distance))
 
+	result = None
 	if distances:
 		distances = sorted(distances, key=lambda t: t[1], reverse=True)
-		return distances[0][0]
+		result = distances[0][0]
+
+	if metrics is not None:
+		metrics.observe(result, time.perf_counter() - start)
+	return result
 
 
 def calculate_archetype_normalizers(clusters):
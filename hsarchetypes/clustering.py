@@ -1,16 +1,26 @@
 # flake8: noqa (fix features and rules imports)
+import heapq
 import json
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
-from itertools import combinations
+from itertools import chain, combinations
+from operator import itemgetter
 from typing import Optional
 
-from hearthstone.enums import CardClass
+from hearthstone.enums import CardClass, FormatType
 
+from .compiled import write_classifier
+from .decks import DeckMatrix
 from .features import *
+from .instrumentation import NULL_TRACER
 from .rules import *
-from .signatures import calculate_signature_weights
-from .utils import card_db, dbf_id_vector
+from .signatures import (
+	calculate_cluster_prevalence_counts, calculate_player_class_prevalence_from_counts,
+	calculate_signature_weights, calculate_signature_weights_matrix, to_presence_matrix
+)
+from .storage import ClusterSetFile, write_cluster_set
+from .utils import card_db, dbf_id_vector, iter_json, skip_json_arrays
 
 
 logger = logging.getLogger("hsarchetypes")
@@ -22,8 +32,10 @@ INHERITENCE_THRESHOLD = .85
 SMALL_CLUSTER_CUTOFF = 1500
 SIMILARITY_THRESHOLD_FLOOR = .85
 SIGNATURE_SIMILARITY_THRESHOLD = .25
+TOP_DECKS_CACHE_SIZE = 10
 
 USE_THRESHOLDS = False
+USE_SIGNATURE_MATRIX = False
 
 db = card_db()
 
@@ -112,6 +124,63 @@ def find_closest_cluster_pair(clusterset_a, clusterset_b, cmp=cluster_similarity
 	return best_match
 
 
+def cluster_similarity_matrix(clusterset_a, clusterset_b, cmp=cluster_similarity):
+	"""
+	Compare every member of clusterset a against every member of clusterset b.
+
+	Returns: a list with one row of similarity scores per member of a
+	"""
+	return [[cmp(cluster_a, cluster_b) for cluster_b in clusterset_b] for cluster_a in clusterset_a]
+
+
+def match_cluster_pairs(similarities, threshold, method="greedy"):
+	"""
+	Pair up rows and columns of a similarity matrix, keeping only pairs that reach
+	`threshold`. Each row and column is used at most once.
+
+	The "greedy" method repeatedly takes the most similar remaining pair, which is
+	what repeated calls to `find_closest_cluster_pair` would do. The "optimal" method
+	maximizes the total similarity of the pairs with the Hungarian algorithm.
+
+	Returns: a list of (row, column, similarity_score), in the order they were matched
+	"""
+	if method == "greedy":
+		rows = list(range(len(similarities)))
+		cols = list(range(len(similarities[0]))) if similarities else []
+		result = []
+		while rows:
+			best_match = (None, None, -1)
+			for i in rows:
+				for j in cols:
+					if similarities[i][j] > best_match[2]:
+						best_match = (i, j, similarities[i][j])
+
+			if best_match[2] < threshold:
+				break
+			result.append(best_match)
+			rows.remove(best_match[0])
+			cols.remove(best_match[1])
+		return result
+	elif method == "optimal":
+		if not similarities or not similarities[0]:
+			return []
+
+		import numpy as np
+		from scipy.optimize import linear_sum_assignment
+
+		matrix = np.array(similarities, dtype=float)
+		# Pairs below the threshold must not be matched, so they get no credit
+		eligible = np.where(matrix >= threshold, matrix, 0.0)
+		row_ind, col_ind = linear_sum_assignment(eligible, maximize=True)
+		result = [
+			(int(i), int(j), similarities[i][j])
+			for i, j in zip(row_ind, col_ind) if matrix[i, j] >= threshold
+		]
+		return sorted(result, key=lambda t: t[2], reverse=True)
+	else:
+		raise ValueError("Unknown matching method: %r" % (method))
+
+
 def _most_similar_pair(clusters, distance_function):
 	result = []
 
@@ -181,9 +250,76 @@ def merge_clusters(cluster_factory, cluster_set, new_cluster_id, clusters):
 		name=name,
 		required_cards=new_cluster_required_cards,
 		rules=new_cluster_rules,
+		merged_from=clusters,
 	)
 
 
+_worker_records = []
+
+
+def _init_worker(level):
+	"""
+	Set up logging in a worker process of `ClusterSet._map_class_clusters`.
+
+	Log records are captured rather than emitted, so that the caller can replay them
+	grouped per class. Workers that are spawned rather than forked don't inherit the
+	logging configuration, hence `level`.
+	"""
+	logger.setLevel(level)
+	logger.handlers = [_RecordingHandler(_worker_records)]
+	logger.propagate = False
+
+
+def _process_class_clusters(task):
+	"""
+	Run `operation` ("consolidate" or "experimental") on a ClassClusters rebuilt from
+	its compact state in a worker process (see `_init_worker`).
+
+	Only the clusters are sent back: they refer to their data points by index into
+	the data points of `state`, which the caller already has. `tracer_config` is the
+	class and keyword arguments of the caller's tracer (see `Tracer.config`), or None.
+	"""
+	operation, state, argument, tracer_config = task
+
+	del _worker_records[:]
+	cluster_set = ClusterSet()
+	if tracer_config is not None:
+		tracer_class, tracer_kwargs = tracer_config
+		cluster_set.tracer = tracer_class(**tracer_kwargs)
+	try:
+		class_cluster = ClassClusters.create(
+			ClassClusters, cluster_set, state["player_class"], []
+		)
+		class_cluster.load_state(state)
+		if operation == "consolidate":
+			class_cluster.consolidate_clusters(argument)
+		elif operation == "experimental":
+			class_cluster.create_experimental_cluster(argument)
+		else:
+			raise ValueError("Unknown operation: %r" % (operation))
+		result = class_cluster.to_state(state["data_points"])
+		del result["data_points"]
+	finally:
+		if tracer_config is not None:
+			cluster_set.tracer.stop()
+
+	records = list(_worker_records)
+	return result, records, cluster_set.tracer.records if tracer_config is not None else []
+
+
+class _RecordingHandler(logging.Handler):
+	def __init__(self, records):
+		super().__init__()
+		self.records = records
+
+	def emit(self, record):
+		# Format now: the arguments (e.g. clusters) are neither small nor picklable
+		record.msg = record.getMessage()
+		record.args = None
+		record.exc_info = None
+		self.records.append(record)
+
+
 class Cluster:
 	"""
 	A collection of data points representing decks that share a similar strategy.
@@ -192,12 +328,15 @@ class Cluster:
 	def __init__(self, *args, **kwargs):
 		self._factory = None
 		self._cluster_set = None
+		self._observations = None
+		self._top_decks = None
 
 	@staticmethod
 	def create(
 		factory, cluster_set, cluster_id, data_points,
 		signature=None, ccp_signature=None,
-		name="NEW", external_id=None, required_cards=None, rules=None
+		name="NEW", external_id=None, required_cards=None, rules=None,
+		merged_from=None
 	):
 		self = factory()
 		self._factory = factory
@@ -212,8 +351,28 @@ class Cluster:
 		self.required_cards = required_cards or []
 		self.rules = rules or []
 		self._augment_data_points()
+		self.update_aggregates(merged_from)
 		return self
 
+	def update_aggregates(self, merged_from=None):
+		"""
+		Cache the total observations and the most observed decks of the cluster.
+
+		A cluster whose data points are exactly those of the `merged_from` clusters,
+		in order, combines their cached aggregates rather than rescanning its data
+		points. Call this again after modifying `data_points` in place.
+		"""
+		if merged_from:
+			self._observations = sum(c.observations for c in merged_from)
+			candidates = chain.from_iterable(c.top_decks for c in merged_from)
+		else:
+			self._observations = sum(d["observations"] for d in self.data_points)
+			candidates = self.data_points
+
+		self._top_decks = heapq.nlargest(
+			TOP_DECKS_CACHE_SIZE, candidates, key=itemgetter("observations")
+		)
+
 	def _augment_data_points(self):
 		for data_point in self.data_points:
 			data_point["cluster_id"] = self.cluster_id
@@ -246,6 +405,10 @@ class Cluster:
 	def __repr__(self):
 		return str(self)
 
+	@property
+	def experimental(self):
+		return self.cluster_id == -1
+
 	def to_json(self):
 		result = {
 			"cluster_id": self.cluster_id,
@@ -254,28 +417,38 @@ class Cluster:
 			"name": self.name,
 			"required_cards": self.required_cards,
 			"rules": self.rules,
-			"data_points": self.data_points,
+			"data_points": (
+				self.data_points if isinstance(self.data_points, list) else list(self.data_points)
+			),
 			"external_id": self.external_id,
 			"ccp_signature": self.ccp_signature
 		}
 		return result
 
+	@property
+	def top_decks(self):
+		"""The (up to) TOP_DECKS_CACHE_SIZE most observed data points, most observed first."""
+		if getattr(self, "_top_decks", None) is None:
+			self.update_aggregates()
+		return self._top_decks
+
 	@property
 	def most_popular_deck(self):
-		return list(sorted(self.data_points, key=lambda d: d["observations"], reverse=True))[0]
+		return self.top_decks[0]
 
 	@property
 	def observations(self):
-		return sum(d["observations"] for d in self.data_points)
+		if getattr(self, "_observations", None) is None:
+			self.update_aggregates()
+		return self._observations
 
 	@property
 	def single_deck_max_observations(self):
-		return max(d["observations"] for d in self.data_points)
+		return max(d["observations"] for d in self.top_decks)
 
 	@property
 	def pretty_decklists(self):
-		sorted_decks = list(sorted(self.data_points, key=lambda d: d["observations"], reverse=True))
-		return [d["decklist"] for d in sorted_decks[:10]]
+		return [d["decklist"] for d in self.top_decks[:10]]
 
 	def satisfies_rules(self, rules):
 		for rule_name in rules:
@@ -350,9 +523,77 @@ class ClassClusters:
 
 		self.player_class = player_class
 		self.clusters = clusters
+		self.merge_history = None
+		self._dendrogram = None
+		self._dendrogram_leaves = None
+		self._signature_matrix = None
 
 		return self
 
+	def load_state(self, state, data_points=None):
+		"""
+		Replace the clusters with those described by `state` (see `to_state`).
+
+		If `data_points` is given, clusters are built from those (in the order the
+		state was created from) rather than from the copies in the state.
+		"""
+		if data_points is None:
+			data_points = state["data_points"]
+		cluster_set = self._cluster_set
+		clusters = []
+		for c in state["clusters"]:
+			clusters.append(Cluster.create(
+				cluster_set.CLUSTER_FACTORY,
+				cluster_set,
+				cluster_id=c["cluster_id"],
+				data_points=[data_points[i] for i in c["data_points"]],
+				signature=c["signature"],
+				ccp_signature=c["ccp_signature"],
+				name=c["name"],
+				external_id=c["external_id"],
+				required_cards=c["required_cards"],
+				rules=c["rules"],
+			))
+		self.clusters = clusters
+
+	def to_state(self, data_points=None):
+		"""
+		Return a compact, picklable description of the clusters.
+
+		Clusters refer to their data points by index into the state's "data_points",
+		which only hold the fields needed to consolidate: cards and observations. If
+		`data_points` is given, the indices refer to that list instead.
+		"""
+		if data_points is None:
+			data_points = [
+				{"cards": d["cards"], "observations": d["observations"]}
+				for c in self.clusters for d in c.data_points
+			]
+			indices = iter(range(len(data_points)))
+			data_point_indices = [[next(indices) for d in c.data_points] for c in self.clusters]
+		else:
+			index_by_id = {id(d): i for i, d in enumerate(data_points)}
+			data_point_indices = [[index_by_id[id(d)] for d in c.data_points] for c in self.clusters]
+
+		clusters = []
+		for cluster, indices in zip(self.clusters, data_point_indices):
+			clusters.append({
+				"cluster_id": cluster.cluster_id,
+				"name": cluster.name,
+				"external_id": cluster.external_id,
+				"required_cards": cluster.required_cards,
+				"rules": cluster.rules,
+				"signature": cluster.signature,
+				"ccp_signature": cluster.ccp_signature,
+				"data_points": indices,
+			})
+
+		return {
+			"player_class": self.player_class,
+			"clusters": clusters,
+			"data_points": data_points,
+		}
+
 	def __str__(self):
 		return "%s - %i clusters" % (self.player_class, len(self.clusters))
 
@@ -363,9 +604,13 @@ class ClassClusters:
 	def player_class_name(self):
 		return CardClass(self.player_class).name
 
+	@property
+	def tracer(self):
+		return getattr(self._cluster_set, "tracer", NULL_TRACER)
+
 	def to_json(self):
 		result = {
-			"player_class": self.player_class.name,
+			"player_class": self.player_class_name,
 			"clusters": []
 		}
 		for cluster in self.clusters:
@@ -390,12 +635,18 @@ class ClassClusters:
 			return {id: index for index, id in enumerate(sorted(list(external_ids)))}
 
 	def create_experimental_cluster(self, experimental_cluster_threshold):
+		with self.tracer.stage("experimental_clusters", self.player_class_name):
+			self._create_experimental_cluster(experimental_cluster_threshold)
+
+	def _create_experimental_cluster(self, experimental_cluster_threshold):
 		final_clusters = []
+		experimental_clusters = []
 		experimental_cluster_data_points = []
 		for cluster in self.clusters:
 			if cluster.observations >= experimental_cluster_threshold:
 				final_clusters.append(cluster)
 			else:
+				experimental_clusters.append(cluster)
 				experimental_cluster_data_points.extend(cluster.data_points)
 
 		if len(experimental_cluster_data_points):
@@ -405,12 +656,19 @@ class ClassClusters:
 				-1,
 				experimental_cluster_data_points,
 				external_id=-1,
+				merged_from=experimental_clusters,
 			)
 			final_clusters.append(experimental_cluster)
 		self.clusters = final_clusters
 		self.update_cluster_signatures()
 
-	def inherit_from_previous(self, previous_cc, merge_threshold):
+	def inherit_from_previous(self, previous_cc, merge_threshold, method="greedy"):
+		"""
+		Pass on the names and external IDs of the previous clusters to the current
+		clusters they match. See `match_cluster_pairs` for the matching `method`.
+
+		Returns: the set of external IDs that were not inherited
+		"""
 		EXPERIMENTAL = -1
 		old_clusters = [
 			c for c in previous_cc.clusters
@@ -421,36 +679,118 @@ class ClassClusters:
 		]
 		logger.info("Attempting inheritance for: %s" % self.player_class_name)
 
-		while old_clusters:
-			old, new, similarity = find_closest_cluster_pair(old_clusters, new_clusters)
-			if similarity >= merge_threshold:
-				logger.info("Found pair with similarity %r: %r, %r", similarity, old, new)
-				new.inherit_from_previous(old)
-				old_clusters.remove(old)
-				new_clusters.remove(new)
-			else:
-				logger.info("Similarity hit %r, stopping inheritance", similarity)
-				break
-
-		return set(old.external_id for old in old_clusters)
+		similarities = cluster_similarity_matrix(old_clusters, new_clusters)
+		matches = match_cluster_pairs(similarities, merge_threshold, method=method)
+		for i, j, similarity in matches:
+			old, new = old_clusters[i], new_clusters[j]
+			logger.info("Found pair with similarity %r: %r, %r", similarity, old, new)
+			new.inherit_from_previous(old)
+		logger.info("Matched %i of %i previous clusters", len(matches), len(old_clusters))
+
+		inherited = set(i for i, j, similarity in matches)
+		return set(
+			old.external_id for i, old in enumerate(old_clusters) if i not in inherited
+		)
 
 	def update_cluster_signatures(self, use_pcp_adjustment=True):
+		with self.tracer.stage("signature_update", self.player_class_name):
+			self._update_cluster_signatures(use_pcp_adjustment)
+
+	def _update_cluster_signatures(self, use_pcp_adjustment):
 		logger.info("Updating Signatures For: %s" % self.player_class_name)
+		if USE_SIGNATURE_MATRIX:
+			self._update_cluster_signatures_matrix(use_pcp_adjustment)
+			return
+
+		# One pass over the decks feeds both the signatures and the CCP signatures
+		cluster_counts = calculate_cluster_prevalence_counts(
+			(c.cluster_id, c.data_points) for c in self.clusters
+		)
+		if use_pcp_adjustment:
+			pcp_weights = calculate_player_class_prevalence_from_counts(cluster_counts)
+		else:
+			pcp_weights = {}
+
 		signature_weights = calculate_signature_weights(
-			[(c.cluster_id, c.data_points) for c in self.clusters],
+			None,
+			use_ccp=False,
+			use_thresholds=USE_THRESHOLDS,
+			pcp_weights=pcp_weights,
+			cluster_counts=cluster_counts
+		)
+
+		for cluster in self.clusters:
+			cluster.signature = signature_weights.get(cluster.cluster_id, {})
+
+		self.update_ccp_signatures(cluster_counts=cluster_counts)
+
+	def _get_signature_matrix(self):
+		"""
+		Return the deck x card presence matrix of all data points in the class, which
+		is only rebuilt when the data points change (merging only regroups them).
+
+		Returns: presence, observations, dbf_ids, row index by data point id
+		"""
+		data_points = [d for c in self.clusters for d in c.data_points]
+		cached = getattr(self, "_signature_matrix", None)
+		if cached is not None:
+			rows = cached[3]
+			if len(rows) != len(data_points) or any(id(d) not in rows for d in data_points):
+				cached = None
+
+		if cached is None:
+			presence, observations, dbf_ids = to_presence_matrix(data_points)
+			rows = {id(d): i for i, d in enumerate(data_points)}
+			# Keep the data points, so that their ids can't be reused
+			cached = (presence, observations, dbf_ids, rows, data_points)
+			self._signature_matrix = cached
+
+		return cached[:4]
+
+	def _update_cluster_signatures_matrix(self, use_pcp_adjustment):
+		import numpy as np
+
+		presence, observations, dbf_ids, rows = self._get_signature_matrix()
+		cluster_ids = [c.cluster_id for c in self.clusters]
+		labels = np.full(len(rows), -1, dtype=np.int64)
+		ccp_labels = labels.copy()
+		for label, cluster in enumerate(self.clusters):
+			cluster_rows = [rows[id(d)] for d in cluster.data_points]
+			labels[cluster_rows] = label
+			if cluster.external_id and cluster.external_id != -1:
+				ccp_labels[cluster_rows] = label
+
+		signature_weights = calculate_signature_weights_matrix(
+			presence, observations, labels, dbf_ids, cluster_ids,
 			use_ccp=False,
 			use_thresholds=USE_THRESHOLDS,
 			use_pcp_adjustment=use_pcp_adjustment
 		)
+		ccp_signature_weights = calculate_signature_weights_matrix(
+			presence, observations, ccp_labels, dbf_ids, cluster_ids,
+			use_ccp=True,
+			use_thresholds=USE_THRESHOLDS
+		)
 
 		for cluster in self.clusters:
 			cluster.signature = signature_weights.get(cluster.cluster_id, {})
+			cluster.ccp_signature = ccp_signature_weights.get(cluster.cluster_id, {})
+
+	def update_ccp_signatures(self, use_pcp_adjustment=True, cluster_counts=None):
+		ccp_clusters = [c for c in self.clusters if c.external_id and c.external_id != -1]
+		if cluster_counts is None:
+			ccp_cluster_counts = calculate_cluster_prevalence_counts(
+				(c.cluster_id, c.data_points) for c in ccp_clusters
+			)
+		else:
+			ccp_cluster_counts = {c.cluster_id: cluster_counts[c.cluster_id] for c in ccp_clusters}
 
 		ccp_signature_weights = calculate_signature_weights(
-			[(c.cluster_id, c.data_points) for c in self.clusters if c.external_id and c.external_id != -1],
+			None,
 			use_ccp=True,
 			use_thresholds=USE_THRESHOLDS,
-			use_pcp_adjustment=use_pcp_adjustment
+			use_pcp_adjustment=use_pcp_adjustment,
+			cluster_counts=ccp_cluster_counts
 		)
 
 		for cluster in self.clusters:
@@ -459,14 +799,101 @@ class ClassClusters:
 	def consolidate_clusters(
 		self,
 		merge_similarity=SIMILARITY_THRESHOLD_FLOOR,
-		distance_function=cluster_similarity
+		distance_function=cluster_similarity,
+		record_history=False
 	):
+		"""
+		Repeatedly merge the most similar pair of clusters until no pair reaches
+		`merge_similarity`.
+
+		With `record_history`, merging continues until no pair of clusters can be
+		merged at all and every step is kept in `merge_history`; the clusters for
+		`merge_similarity` (or any other threshold, see `cut_at`) are then replayed
+		from that history.
+		"""
 		consolidation_successful = True
 		self.update_cluster_signatures()
-		similarity_threshold = merge_similarity
+		if record_history:
+			self.merge_history = []
+			self._dendrogram = {c.cluster_id: c for c in self.clusters}
+			self._dendrogram_leaves = list(self.clusters)
+			similarity_threshold = float("-inf")
+		else:
+			self.merge_history = None
+			self._dendrogram = None
+			similarity_threshold = merge_similarity
 		while consolidation_successful and len(self.clusters) > 1:
-			consolidation_successful = self._attempt_consolidation(similarity_threshold, distance_function)
-			self.update_cluster_signatures()
+			with self.tracer.stage("consolidation_iteration", self.player_class_name):
+				consolidation_successful = self._attempt_consolidation(
+					similarity_threshold, distance_function
+				)
+				self.update_cluster_signatures()
+
+		if record_history:
+			self.clusters = self._cut_at(merge_similarity, copy_data_points=False).clusters
+
+	def get_dendrogram_node(self, cluster_id):
+		"""Return the (possibly intermediate) cluster recorded under `cluster_id`."""
+		if self._dendrogram is None:
+			raise RuntimeError("No merge history has been recorded for %s" % self)
+		return self._dendrogram[cluster_id]
+
+	def cut_at(self, similarity):
+		"""
+		Return a new ClassClusters holding the clusters that consolidating with a
+		`merge_similarity` of `similarity` would have produced.
+
+		The merge order doesn't depend on the threshold, so this replays the recorded
+		history up to the first merge below `similarity` rather than recomputing it.
+		The clusters of the cut get their own copies of the data points, so labelling
+		them leaves these clusters untouched.
+		"""
+		return self._cut_at(similarity, copy_data_points=True)
+
+	def _cut_at(self, similarity, copy_data_points):
+		if self.merge_history is None:
+			raise RuntimeError(
+				"No merge history has been recorded for %s, "
+				"use consolidate_clusters(record_history=True)" % self
+			)
+
+		current_clusters = list(self._dendrogram_leaves)
+		for merge in self.merge_history:
+			if merge["similarity"] < similarity:
+				break
+			merged_ids = merge["cluster_ids"]
+			next_clusters_list = [self._dendrogram[merge["merged_cluster_id"]]]
+			for c in current_clusters:
+				if c.cluster_id not in merged_ids:
+					next_clusters_list.append(c)
+			current_clusters = next_clusters_list
+
+		cluster_set = self._cluster_set
+		clusters = []
+		for c in current_clusters:
+			clusters.append(Cluster.create(
+				cluster_set.CLUSTER_FACTORY,
+				cluster_set,
+				cluster_id=c.cluster_id,
+				data_points=[dict(d) if copy_data_points else d for d in c.data_points],
+				signature=c.signature,
+				external_id=c.external_id,
+				name=c.name,
+				required_cards=list(c.required_cards),
+				rules=list(c.rules),
+			))
+
+		class_cluster = ClassClusters.create(
+			self._factory,
+			cluster_set,
+			self.player_class,
+			clusters
+		)
+		class_cluster.merge_history = self.merge_history
+		class_cluster._dendrogram = self._dendrogram
+		class_cluster._dendrogram_leaves = self._dendrogram_leaves
+		class_cluster.update_ccp_signatures()
+		return class_cluster
 
 	def _attempt_consolidation(self, similarity_threshold, distance_function=cluster_similarity):
 		new_clusters = self._do_merge_clusters(distance_function, similarity_threshold)
@@ -504,6 +931,14 @@ class ClassClusters:
 		logger.info("Clusters will be merged into new cluster with ID: %i" % next_cluster_id)
 		c1, c2, sim_score = most_similar
 		new_cluster = merge_clusters(cluster_factory, cluster_set, next_cluster_id, [c1, c2])
+		if self.merge_history is not None:
+			self._dendrogram[next_cluster_id] = new_cluster
+			self.merge_history.append({
+				"cluster_ids": (c1.cluster_id, c2.cluster_id),
+				"merged_cluster_id": next_cluster_id,
+				"similarity": sim_score,
+			})
+
 		next_clusters_list = [new_cluster]
 		for c in current_clusters:
 			if c.cluster_id not in (c1.cluster_id, c2.cluster_id):
@@ -570,6 +1005,7 @@ class ClassClusters:
 			name=name,
 			required_cards=new_cluster_required_cards,
 			rules=new_cluster_rules,
+			merged_from=[external_cluster, to_be_merged],
 		)
 
 		next_clusters_list = [new_cluster]
@@ -588,6 +1024,8 @@ class ClusterSet:
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self._factory = None
+		self.tracer = NULL_TRACER
+		self.binary_file = None
 
 	def __str__(self):
 		ccs = sorted(self.class_clusters, key=lambda cc: cc.player_class)
@@ -603,7 +1041,7 @@ class ClusterSet:
 				return class_cluster
 		return None
 
-	def inherit_from_previous(self, previous_cluster_set, merge_threshold):
+	def inherit_from_previous(self, previous_cluster_set, merge_threshold, method="greedy"):
 		if previous_cluster_set:
 			uninherited_ids = []
 			for previous_cc in previous_cluster_set.class_clusters:
@@ -611,7 +1049,8 @@ class ClusterSet:
 					if current_cc.player_class == previous_cc.player_class:
 						uninherited_class_ids = current_cc.inherit_from_previous(
 							previous_cc,
-							merge_threshold
+							merge_threshold,
+							method=method
 						)
 				uninherited_ids.extend(uninherited_class_ids)
 			return set(uninherited_ids)
@@ -620,7 +1059,7 @@ class ClusterSet:
 		for class_cluster in self.class_clusters:
 			yield (class_cluster.player_class, class_cluster.clusters)
 
-	def to_json(self):
+	def _to_dict(self):
 		result = {
 			"as_of": self.as_of,
 			"game_format": self.game_format.name,
@@ -632,24 +1071,276 @@ class ClusterSet:
 		for class_cluster in self.class_clusters:
 			result["class_clusters"].append(class_cluster.to_json())
 
-		return json.dumps(result, indent=4)
+		return result
+
+	def to_json(self):
+		with self.tracer.stage("json_export"):
+			return json.dumps(self._to_dict(), indent=4)
+
+	def write_binary(self, path):
+		"""Write the cluster set to `path` in the binary format of hsarchetypes.storage."""
+		write_cluster_set(self._to_dict(), path)
+
+	@classmethod
+	def load_binary(cls, path, data_points=True):
+		"""
+		Load a ClusterSet written by `write_binary`.
+
+		The file stays memory-mapped as `binary_file`, so processes loading the same
+		file share its pages. The data points of each cluster are MappedDataPoints,
+		only decoded from the file once accessed. With data_points=False the file is
+		closed after reading its header and signatures, and clusters have no data points.
+		"""
+		f = ClusterSetFile(path)
+		cluster_set = cls.from_json(f.to_dict(data_points=False), data_points=False)
+		if not data_points:
+			f.close()
+			return cluster_set
+
+		clusters = [c for cc in cluster_set.class_clusters for c in cc.clusters]
+		for cluster, mapped_data_points in zip(clusters, f.data_points()):
+			# The data points were labelled with their cluster when written
+			cluster.data_points = mapped_data_points
+			cluster._observations = None
+			cluster._top_decks = None
+		cluster_set.binary_file = f
+		return cluster_set
+
+	@classmethod
+	def from_json(cls, data, data_points=True):
+		"""
+		Rebuild a ClusterSet from the output of `to_json` or `write_json`.
+
+		`data` is either the JSON text or the already decoded dict. The class clusters
+		and clusters are created through CLASS_CLUSTER_FACTORY and CLUSTER_FACTORY.
+		With data_points=False, clusters are created without their data points, which
+		is all classifying by signature needs; the data points in JSON text are then
+		skipped over without being decoded.
+		"""
+		if isinstance(data, bytes):
+			data = data.decode("utf-8")
+		if isinstance(data, str):
+			if not data_points:
+				data = skip_json_arrays(data, "data_points")
+			data = json.loads(data)
+
+		cluster_set = cls()
+		cluster_set._factory = cls
+		cluster_set.as_of = data["as_of"]
+		cluster_set.game_format = FormatType[data["game_format"]]
+		cluster_set.live_in_production = data["live_in_production"]
+		cluster_set.latest = data["latest"]
+
+		class_clusters = []
+		for class_cluster in data["class_clusters"]:
+			clusters = []
+			for c in class_cluster["clusters"]:
+				cluster = Cluster.create(
+					cls.CLUSTER_FACTORY,
+					cluster_set,
+					cluster_id=c["cluster_id"],
+					data_points=None,
+					signature=c["signature"],
+					ccp_signature=c["ccp_signature"],
+					name=c["name"],
+					external_id=c["external_id"],
+					required_cards=c["required_cards"],
+					rules=c["rules"],
+				)
+				if data_points and c.get("data_points"):
+					# The data points were labelled with their cluster when written
+					cluster.data_points = c["data_points"]
+					cluster.update_aggregates()
+				clusters.append(cluster)
+			class_clusters.append(ClassClusters.create(
+				cls.CLASS_CLUSTER_FACTORY,
+				cluster_set,
+				CardClass[class_cluster["player_class"]],
+				clusters
+			))
+		cluster_set.class_clusters = class_clusters
+		return cluster_set
+
+	@classmethod
+	def load(cls, path, data_points=True):
+		"""
+		Load a ClusterSet from a JSON file written by `to_json` or `write_json`.
+
+		With data_points=False only the signatures and cluster metadata are decoded,
+		see `from_json`. The whole file is still read, so files written with
+		include_data_points=False or `write_binary` load fastest.
+		"""
+		with open(path) as f:
+			return cls.from_json(f.read(), data_points=data_points)
+
+	def write_json(self, fp, indent=None, include_data_points=True, max_data_points=None):
+		"""
+		Stream the output of `to_json` to the file object `fp`, one data point at a time.
+
+		With include_data_points=False clusters are written without their data points;
+		otherwise max_data_points keeps only the N most observed data points of each cluster.
+		"""
+		def cluster_json(cluster):
+			result = cluster.to_json()
+			if not include_data_points:
+				del result["data_points"]
+				return result
+			data_points = cluster.data_points
+			if max_data_points is not None:
+				data_points = heapq.nlargest(
+					max_data_points, data_points, key=itemgetter("observations")
+				)
+			# A generator makes iter_json encode the data points one by one rather
+			# than the whole cluster at once
+			result["data_points"] = (d for d in data_points)
+			return result
+
+		result = {
+			"as_of": self.as_of,
+			"game_format": self.game_format.name,
+			"live_in_production": self.live_in_production,
+			"latest": self.latest,
+			"class_clusters": ({
+				"player_class": class_cluster.player_class_name,
+				"clusters": (cluster_json(cluster) for cluster in class_cluster.clusters)
+			} for class_cluster in self.class_clusters)
+		}
+
+		with self.tracer.stage("json_export"):
+			for chunk in iter_json(result, indent=indent):
+				fp.write(chunk)
+
+	def consolidate_clusters(self, merge_similarity, record_history=False, max_workers=None):
+		"""
+		Consolidate the clusters of every class.
+
+		With `max_workers` greater than 1, classes are consolidated concurrently in
+		that many worker processes (see `_map_class_clusters`). Recording the merge
+		history is only supported in process.
+		"""
+		if max_workers and max_workers > 1:
+			if record_history:
+				raise ValueError("record_history is not supported with max_workers")
+			self._map_class_clusters(
+				"consolidate",
+				[merge_similarity] * len(self.class_clusters),
+				max_workers,
+				header="****** Consolidating: %s ******"
+			)
+			return
 
-	def consolidate_clusters(self, merge_similarity):
 		for class_cluster in self.class_clusters:
 			class_cluster_name = CardClass(class_cluster.player_class).name
 			logger.info("****** Consolidating: %s ******", class_cluster_name)
-			class_cluster.consolidate_clusters(merge_similarity)
+			class_cluster.consolidate_clusters(merge_similarity, record_history=record_history)
 
-	def create_experimental_clusters(self, experimental_cluster_thresholds):
-		for class_cluster in self.class_clusters:
-			threshold = experimental_cluster_thresholds.get(
+	def create_experimental_clusters(self, experimental_cluster_thresholds, max_workers=None):
+		thresholds = [
+			experimental_cluster_thresholds.get(
 				class_cluster.player_class_name,
 				SMALL_CLUSTER_CUTOFF
 			)
+			for class_cluster in self.class_clusters
+		]
+
+		if max_workers and max_workers > 1:
+			self._map_class_clusters("experimental", thresholds, max_workers)
+			return
+
+		for class_cluster, threshold in zip(self.class_clusters, thresholds):
 			class_cluster.create_experimental_cluster(threshold)
 
+	def _map_class_clusters(self, operation, arguments, max_workers, header=None):
+		"""
+		Run `operation` on every class in a pool of worker processes.
+
+		Each class is shipped as its compact state (see `ClassClusters.to_state`) and
+		processed by the base Cluster and ClassClusters classes; the results are
+		loaded back here through the factories of this ClusterSet, around the
+		original data points. Results and log records are applied in class order, so the outcome
+		and the log don't depend on scheduling.
+		"""
+		tracer_config = None
+		if self.tracer.enabled:
+			tracer_config = (type(self.tracer), self.tracer.config())
+		all_data_points = []
+		tasks = []
+		for class_cluster, argument in zip(self.class_clusters, arguments):
+			data_points = [d for c in class_cluster.clusters for d in c.data_points]
+			all_data_points.append(data_points)
+			tasks.append((operation, class_cluster.to_state(), argument, tracer_config))
+
+		with ProcessPoolExecutor(
+			max_workers=max_workers,
+			initializer=_init_worker,
+			initargs=(logger.getEffectiveLevel(), )
+		) as executor:
+			results = executor.map(_process_class_clusters, tasks)
+			for class_cluster, data_points, (state, records, trace) in zip(
+				self.class_clusters, all_data_points, results
+			):
+				if header:
+					logger.info(header, class_cluster.player_class_name)
+				for record in records:
+					if logger.isEnabledFor(record.levelno):
+						logger.handle(record)
+				self.tracer.extend(trace)
+
+				class_cluster.load_state(state, data_points=data_points)
+
+	def classifier_clusters(self, use_ccp=True):
+		"""
+		Return the `clusters` argument of classify_deck for every class, keyed by
+		player class and then by external id. Clusters without an external id, the
+		experimental clusters and clusters without a signature are left out.
+		"""
+		result = {}
+		for class_cluster in self.class_clusters:
+			clusters = {}
+			for cluster in class_cluster.clusters:
+				if not cluster.external_id or cluster.external_id == -1:
+					continue
+				signature = cluster.ccp_signature if use_ccp else cluster.signature
+				if not signature:
+					continue
+				clusters[cluster.external_id] = {
+					"signature_weights": {
+						int(dbf_id): weight for dbf_id, weight in signature.items()
+					},
+					"required_cards": [int(dbf_id) for dbf_id in cluster.required_cards],
+					"rules": list(cluster.rules),
+				}
+			result[int(class_cluster.player_class)] = clusters
+		return result
+
+	def export_classifier(self, path, use_ccp=True):
+		"""Write a standalone classifier artifact, see hsarchetypes.compiled."""
+		game_format = getattr(self, "game_format", None)
+		write_classifier(
+			self.classifier_clusters(use_ccp=use_ccp),
+			path,
+			game_format=game_format.name if game_format is not None else None
+		)
+
 	def to_chart_data(self, with_external_ids=False, include_ccp_signature=False, as_of="", external_names={}):
-		result = []
+		return list(self.iter_chart_data(
+			with_external_ids=with_external_ids,
+			include_ccp_signature=include_ccp_signature,
+			as_of=as_of,
+			external_names=external_names
+		))
+
+	def iter_chart_data(
+		self, with_external_ids=False, include_ccp_signature=False, as_of="", external_names={},
+		max_points_per_cluster=None
+	):
+		"""
+		Yield the chart payload of each class, as returned by `to_chart_data`.
+
+		If max_points_per_cluster is set, only the most observed data points of each
+		cluster are included, and each payload gains "cluster_totals" holding the
+		number of data points and games of every cluster before downsampling.
+		"""
 		for player_class, clusters in self.items():
 			player_class_result = {
 				"player_class": CardClass(int(player_class)).name,
@@ -661,6 +1352,8 @@ class ClusterSet:
 				"cluster_required_cards": {},
 				"as_of": as_of
 			}
+			if max_points_per_cluster is not None:
+				player_class_result["cluster_totals"] = {}
 			for c in clusters:
 				if with_external_ids and (not c.external_id or c.external_id == -1):
 					continue
@@ -674,7 +1367,17 @@ class ClusterSet:
 					player_class_result["ccp_signatures"][c.cluster_id] = ccp_sig
 				player_class_result["cluster_map"][c.cluster_id] = c.external_id
 				player_class_result["cluster_required_cards"][c.cluster_id] = c.required_cards
-				for data_point in c.data_points:
+				data_points = c.data_points
+				if max_points_per_cluster is not None:
+					player_class_result["cluster_totals"][c.cluster_id] = {
+						"data_points": len(data_points),
+						"games": int(c.observations),
+					}
+					if len(data_points) > max_points_per_cluster:
+						data_points = heapq.nlargest(
+							max_points_per_cluster, data_points, key=itemgetter("observations")
+						)
+				for data_point in data_points:
 					external_name = external_names.get(c.external_id, "")
 					arch_name = data_point["archetype_name"]
 					cluster_id = data_point["cluster_id"]
@@ -692,9 +1395,120 @@ class ClusterSet:
 						"y": data_point["y"],
 						"metadata": metadata
 					})
-			result.append(player_class_result)
+			yield player_class_result
 
-		return result
+
+def _to_feature_vectors(
+	data_points,
+	player_class,
+	use_mana_curve=True,
+	use_tribes=True,
+	use_card_types=True,
+	use_mechanics=True,
+	mechanics=mechanics,
+):
+	X = []
+	base_vector = dbf_id_vector(player_class=player_class)
+	logger.info("Base Cluster Length: %s" % len(base_vector))
+	for data_point in data_points:
+		cards = data_point["cards"]
+		vector = [float(cards.get(str(dbf_id), 0)) / 2.0 for dbf_id in base_vector]
+
+		for rule_name, rule in FALSE_POSITIVE_RULES.items():
+			rule_outcome = rule(data_point)
+			vector.append(float(rule_outcome))
+
+		if use_mana_curve:
+			mana_curve_vector = to_mana_curve_vector(data_point)
+			vector.extend(mana_curve_vector)
+
+		if use_tribes:
+			# Murloc, Dragon, Pirate, etc.
+			tribe_vector = to_tribe_vector(data_point)
+			vector.extend(tribe_vector)
+
+		if use_card_types:
+			# Weapon, Spell, Minion, Hero, Secret
+			card_type_vector = to_card_type_vector(data_point)
+			vector.extend(card_type_vector)
+
+		if use_mechanics:
+			# Secret, Deathrattle, Battlecry, Lifesteal,
+			mechanic_vector = to_mechanic_vector(data_point, mechanics=mechanics)
+			vector.extend(mechanic_vector)
+
+		X.append(vector)
+
+	return X
+
+
+def _split_clusters_by_rules(cluster_factory, cluster_set, clusters, next_cluster_id):
+	next_clusters = []
+	for rule_name, rule in FALSE_POSITIVE_RULES.items():
+		for cluster in clusters:
+
+			# If any data points match the rule than split the cluster
+			if any(rule(d) for d in cluster.data_points):
+				data_point_matches = [d for d in cluster.data_points if rule(d)]
+				matches = Cluster.create(
+					cluster_factory,
+					cluster_set,
+					next_cluster_id,
+					data_point_matches
+				)
+				matches.rules.extend(cluster.rules)
+				if rule_name not in matches.rules:
+					matches.rules.append(rule_name)
+				next_clusters.append(matches)
+				next_cluster_id += 1
+
+				data_point_misses = [d for d in cluster.data_points if not rule(d)]
+				if len(data_point_misses):
+					misses = Cluster.create(
+						cluster_factory,
+						cluster_set,
+						next_cluster_id,
+						data_point_misses
+					)
+					misses.rules.extend(cluster.rules)
+					next_clusters.append(misses)
+					next_cluster_id += 1
+			else:
+				next_clusters.append(cluster)
+		clusters = next_clusters
+		next_clusters = []
+
+	return clusters
+
+
+def _deduplicate_data_points(data_points):
+	"""
+	Collapse data points with identical cards, ignoring card order and zero counts.
+
+	Return the unique data points, with canonical card maps and their observations
+	summed, the index of the unique data point of every data point, and the number
+	of data points collapsed into each unique data point.
+	"""
+	index = {}
+	unique = []
+	inverse = []
+	duplicates = []
+	for data_point in data_points:
+		key = tuple(sorted(
+			(int(dbf_id), count) for dbf_id, count in data_point["cards"].items() if count
+		))
+		i = index.get(key)
+		if i is None:
+			i = index[key] = len(unique)
+			unique.append({
+				"cards": {str(dbf_id): count for dbf_id, count in key},
+				"observations": 0,
+			})
+			duplicates.append(0)
+		unique[i]["observations"] += data_point["observations"]
+		duplicates[i] += 1
+		inverse.append(i)
+	return unique, inverse, duplicates
 
 
 def create_cluster_set(
@@ -709,124 +1523,142 @@ def create_cluster_set(
 	use_mechanics=True,
 	use_sample_weights: bool = False,
 	experimental_threshold_pct: Optional[float] = 0.01,
+	record_history: bool = False,
+	max_workers: Optional[int] = None,
+	tracer=None,
+	deduplicate: bool = False,
+	game_format: Optional[FormatType] = None,
+	random_state: Optional[int] = None,
 ):
+	import numpy as np
 	from sklearn import manifold
 	from sklearn.cluster import KMeans
 	from sklearn.preprocessing import StandardScaler
 
 	cluster_set = cls()
 	cluster_set._factory = cls
-
-	data = deepcopy(input_data)
+	if game_format is not None:
+		cluster_set.game_format = FormatType(game_format)
+	# Wild decks are described by the mechanics of the Wild-only sets as well
+	format_mechanics = mechanics_for_format(game_format)
+	if tracer is not None:
+		cluster_set.tracer = tracer
+	tracer = cluster_set.tracer
+
+	data = {}
+	for player_class, data_points in input_data.items():
+		# Columnar input is never modified, so it needn't be copied
+		if isinstance(data_points, DeckMatrix):
+			data[player_class] = data_points
+		else:
+			with tracer.stage("deepcopy_input", player_class):
+				data[player_class] = deepcopy(data_points)
 
 	class_clusters = []
 	for player_class, data_points in data.items():
 		logger.info("\nStarting Clustering For: %s" % player_class)
-		X = []
-		sample_weights = []
-
-		base_vector = dbf_id_vector(player_class=player_class)
-		logger.info("Base Cluster Length: %s" % len(base_vector))
-		for data_point in data_points:
-			cards = data_point["cards"]
-			vector = [float(cards.get(str(dbf_id), 0)) / 2.0 for dbf_id in base_vector]
 
-			for rule_name, rule in FALSE_POSITIVE_RULES.items():
-				rule_outcome = rule(data_point)
-				vector.append(float(rule_outcome))
-
-			if use_mana_curve:
-				mana_curve_vector = to_mana_curve_vector(data_point)
-				vector.extend(mana_curve_vector)
-
-			if use_tribes:
-				# Murloc, Dragon, Pirate, etc.
-				tribe_vector = to_tribe_vector(data_point)
-				vector.extend(tribe_vector)
-
-			if use_card_types:
-				# Weapon, Spell, Minion, Hero, Secret
-				card_type_vector = to_card_type_vector(data_point)
-				vector.extend(card_type_vector)
-
-			if use_mechanics:
-				# Secret, Deathrattle, Battlecry, Lifesteal,
-				mechanic_vector = to_mechanic_vector(data_point)
-				vector.extend(mechanic_vector)
-
-			X.append(vector)
-			sample_weights.append(int(data_point["observations"]))
-
-		logger.info("Full Feature Vector Length: %s" % len(X[0]))
-
-		if len(data_points) > 1:
-			tsne = manifold.TSNE(n_components=2, init='pca', random_state=0)
-			xy = tsne.fit_transform(deepcopy(X))
-			for (x, y), data_point in zip(xy, data_points):
-				data_point["x"] = float(x)
-				data_point["y"] = float(y)
-		elif len(data_points) == 1:
-			# Place a single deck at the origin by default
-			data_points[0]["x"] = 0.0
-			data_points[0]["y"] = 0.0
-		else:
+		if not len(data_points):
 			# No data points for this class so don't include it
 			continue
 
-		X = StandardScaler().fit_transform(X)
-		clusterizer = KMeans(n_clusters=min(int(num_clusters), len(X)))
+		if deduplicate:
+			# Cluster each distinct deck once and expand the labels back afterwards
+			with tracer.stage("deduplicate", player_class):
+				original_data_points = data_points
+				if isinstance(data_points, DeckMatrix):
+					data_points, inverse, duplicates = data_points.deduplicate()
+				else:
+					data_points, inverse, duplicates = _deduplicate_data_points(data_points)
+			logger.info("Deduplicated %i data points to %i" % (
+				len(original_data_points), len(data_points)
+			))
+
+		with tracer.stage("feature_build", player_class):
+			if isinstance(data_points, DeckMatrix):
+				X = data_points.feature_matrix(
+					player_class,
+					use_mana_curve=use_mana_curve,
+					use_tribes=use_tribes,
+					use_card_types=use_card_types,
+					use_mechanics=use_mechanics,
+					mechanics=format_mechanics,
+				)
+				sample_weights = [int(o) for o in data_points.observations.tolist()]
+			else:
+				X = _to_feature_vectors(
+					data_points,
+					player_class,
+					use_mana_curve=use_mana_curve,
+					use_tribes=use_tribes,
+					use_card_types=use_card_types,
+					use_mechanics=use_mechanics,
+					mechanics=format_mechanics,
+				)
+				sample_weights = [int(data_point["observations"]) for data_point in data_points]
 
-		if use_sample_weights:
-			clusterizer.fit(X, sample_weight=sample_weights)
-		else:
-			clusterizer.fit(X)
+		logger.info("Full Feature Vector Length: %s" % len(X[0]))
 
-		data_points_in_cluster = defaultdict(list)
-		for data_point, cluster_id in zip(data_points, clusterizer.labels_):
-			data_points_in_cluster[int(cluster_id)].append(data_point)
+		with tracer.stage("tsne", player_class):
+			if len(data_points) > 1:
+				tsne = manifold.TSNE(
+					n_components=2, init='pca', random_state=0 if random_state is None else random_state
+				)
+				# Newer scikit-learn versions only take arrays
+				xy = tsne.fit_transform(np.array(X, dtype=float))
+			else:
+				# Place a single deck at the origin by default
+				xy = [(0.0, 0.0)]
+			# Columnar input only becomes data points once the clusters are known
+			if not isinstance(data_points, DeckMatrix):
+				for (x, y), data_point in zip(xy, data_points):
+					data_point["x"] = float(x)
+					data_point["y"] = float(y)
+
+		with tracer.stage("scaling", player_class):
+			X = StandardScaler().fit_transform(X)
+
+		with tracer.stage("kmeans", player_class):
+			clusterizer = KMeans(n_clusters=min(int(num_clusters), len(X)), random_state=random_state)
+
+			if use_sample_weights:
+				clusterizer.fit(X, sample_weight=sample_weights)
+			elif deduplicate:
+				# Weigh every distinct deck as the data points it stands for
+				clusterizer.fit(X, sample_weight=duplicates)
+			else:
+				clusterizer.fit(X)
+			labels = clusterizer.labels_
+
+		with tracer.stage("rule_split", player_class):
+			if deduplicate:
+				labels = [labels[i] for i in inverse]
+				xy = [xy[i] for i in inverse]
+				data_points = original_data_points
+				if not isinstance(data_points, DeckMatrix):
+					for (x, y), data_point in zip(xy, data_points):
+						data_point["x"] = float(x)
+						data_point["y"] = float(y)
+			if isinstance(data_points, DeckMatrix):
+				data_points = data_points.to_data_points(xy)
+
+			data_points_in_cluster = defaultdict(list)
+			for data_point, cluster_id in zip(data_points, labels):
+				data_points_in_cluster[int(cluster_id)].append(data_point)
+
+			clusters = []
+			for id, cluster_data_points in data_points_in_cluster.items():
+				clusters.append(
+					Cluster.create(cls.CLUSTER_FACTORY, cluster_set, id, cluster_data_points)
+				)
 
-		clusters = []
-		for id, data_points in data_points_in_cluster.items():
-			clusters.append(
-				Cluster.create(cls.CLUSTER_FACTORY, cluster_set, id, data_points)
+			clusters = _split_clusters_by_rules(
+				cls.CLUSTER_FACTORY,
+				cluster_set,
+				clusters,
+				max(data_points_in_cluster.keys()) + 1
 			)
 
-		next_cluster_id = max(data_points_in_cluster.keys()) + 1
-		next_clusters = []
-		for rule_name, rule in FALSE_POSITIVE_RULES.items():
-			for cluster in clusters:
-
-				# If any data points match the rule than split the cluster
-				if any(rule(d) for d in cluster.data_points):
-					data_point_matches = [d for d in cluster.data_points if rule(d)]
-					matches = Cluster.create(
-						cls.CLUSTER_FACTORY,
-						cluster_set,
-						next_cluster_id,
-						data_point_matches
-					)
-					matches.rules.extend(cluster.rules)
-					if rule_name not in matches.rules:
-						matches.rules.append(rule_name)
-					next_clusters.append(matches)
-					next_cluster_id += 1
-
-					data_point_misses = [d for d in cluster.data_points if not rule(d)]
-					if len(data_point_misses):
-						misses = Cluster.create(
-							cls.CLUSTER_FACTORY,
-							cluster_set,
-							next_cluster_id,
-							data_point_misses
-						)
-						misses.rules.extend(cluster.rules)
-						next_clusters.append(misses)
-						next_cluster_id += 1
-				else:
-					next_clusters.append(cluster)
-			clusters = next_clusters
-			next_clusters = []
-
 		class_cluster = ClassClusters.create(
 			cls.CLASS_CLUSTER_FACTORY,
 			cluster_set,
@@ -839,15 +1671,25 @@ def create_cluster_set(
 	cluster_set.class_clusters = class_clusters
 
 	if consolidate:
-		cluster_set.consolidate_clusters(merge_similarity)
+		cluster_set.consolidate_clusters(
+			merge_similarity,
+			record_history=record_history,
+			max_workers=max_workers
+		)
 
 	if experimental_threshold_pct is not None:
 		experimental_thresholds = {}
 		for player_class_name, data_points in data.items():
-			observations_for_class = sum(d["observations"] for d in data_points)
+			if isinstance(data_points, DeckMatrix):
+				observations_for_class = data_points.observations.sum().item()
+			else:
+				observations_for_class = sum(d["observations"] for d in data_points)
 			threshold_for_class = int(observations_for_class * experimental_threshold_pct)
 			experimental_thresholds[player_class_name] = threshold_for_class
 
-		cluster_set.create_experimental_clusters(experimental_thresholds)
+		cluster_set.create_experimental_clusters(
+			experimental_thresholds,
+			max_workers=max_workers
+		)
 
 	return cluster_set
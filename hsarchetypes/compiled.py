@@ -0,0 +1,213 @@
+"""
+A standalone classifier artifact, compiled from the clusters of a ClusterSet.
+
+The artifact is a numpy .npz file holding, for every archetype cluster of every class,
+a dense row of signature weights over a shared dbf id vector, the normalizer and
+cutoff `classify_deck` would compute for the clusters of its class, and bitmasks of
+its required cards and false positive rules. Loading and classifying with it needs
+neither sklearn nor the clustering module.
+"""
+import time
+
+from .classification import calculate_archetype_normalizers
+from .rules import FALSE_POSITIVE_RULES
+
+
+def write_classifier(clusters_by_class, path, game_format=None):
+	"""
+	Write the classifier artifact to `path`.
+
+	`clusters_by_class` maps player classes to the `clusters` argument of classify_deck,
+	see ClusterSet.classifier_clusters.
+	"""
+	import numpy as np
+
+	dbf_ids = set()
+	rule_names = []
+	for clusters in clusters_by_class.values():
+		for cluster in clusters.values():
+			dbf_ids.update(cluster["signature_weights"])
+			dbf_ids.update(cluster.get("required_cards", []))
+			for rule in cluster.get("rules", []):
+				if rule not in rule_names:
+					rule_names.append(rule)
+	dbf_ids = sorted(dbf_ids)
+	columns = {dbf_id: i for i, dbf_id in enumerate(dbf_ids)}
+
+	num_clusters = sum(len(clusters) for clusters in clusters_by_class.values())
+	player_classes = np.zeros(num_clusters, dtype=np.int32)
+	archetype_ids = np.zeros(num_clusters, dtype=np.int64)
+	weights = np.zeros((num_clusters, len(dbf_ids)), dtype=np.float64)
+	normalizers = np.zeros(num_clusters, dtype=np.float64)
+	cutoffs = np.zeros(num_clusters, dtype=np.float64)
+	required_cards = np.zeros((num_clusters, len(dbf_ids)), dtype=bool)
+	rules = np.zeros((num_clusters, len(rule_names)), dtype=bool)
+
+	row = 0
+	for player_class, clusters in clusters_by_class.items():
+		if not clusters:
+			continue
+		class_normalizers, cutoff = calculate_archetype_normalizers(clusters)
+		for archetype_id, cluster in clusters.items():
+			player_classes[row] = int(player_class)
+			archetype_ids[row] = archetype_id
+			for dbf_id, weight in cluster["signature_weights"].items():
+				weights[row, columns[dbf_id]] = weight
+			normalizers[row] = class_normalizers[archetype_id]
+			cutoffs[row] = cutoff
+			for dbf_id in cluster.get("required_cards", []):
+				required_cards[row, columns[dbf_id]] = True
+			for rule in cluster.get("rules", []):
+				rules[row, rule_names.index(rule)] = True
+			row += 1
+
+	with open(path, "wb") as f:
+		np.savez_compressed(
+			f,
+			game_format=np.array(game_format or ""),
+			dbf_ids=np.array(dbf_ids, dtype=np.int32),
+			player_classes=player_classes,
+			archetype_ids=archetype_ids,
+			weights=weights,
+			normalizers=normalizers,
+			cutoffs=cutoffs,
+			required_cards=required_cards,
+			rule_names=np.array(rule_names, dtype=np.str_),
+			rules=rules,
+		)
+
+
+class CompiledClassifier:
+	"""
+	Classify decks with an artifact written by `write_classifier`.
+
+	`classify` returns the same archetype as classify_deck would for the clusters of
+	the deck's class, and invokes the failure callback under the same conditions.
+	"""
+
+	def __init__(self, arrays):
+		self.game_format = str(arrays["game_format"]) or None
+		self.dbf_ids = arrays["dbf_ids"]
+		self.player_classes = arrays["player_classes"]
+		self.archetype_ids = arrays["archetype_ids"]
+		self.weights = arrays["weights"]
+		self.normalizers = arrays["normalizers"]
+		self.cutoffs = arrays["cutoffs"]
+		self.required_cards = arrays["required_cards"]
+		self.rule_names = [str(rule) for rule in arrays["rule_names"]]
+		self.rules = arrays["rules"]
+
+		self._columns = {int(dbf_id): i for i, dbf_id in enumerate(self.dbf_ids)}
+		self._rows = {}
+		for row, player_class in enumerate(self.player_classes.tolist()):
+			self._rows.setdefault(player_class, []).append(row)
+
+	@classmethod
+	def load(cls, path):
+		import numpy as np
+
+		with np.load(path, allow_pickle=False) as arrays:
+			return cls({k: arrays[k] for k in arrays.files})
+
+	def _deck_vector(self, deck):
+		import numpy as np
+
+		vector = np.zeros(len(self.dbf_ids), dtype=np.float64)
+		for dbf_id, count in deck.items():
+			column = self._columns.get(int(dbf_id))
+			if column is not None:
+				vector[column] = count
+		return vector
+
+	def classify(self, deck, player_class, failure_callback=None, metrics=None):
+		"""
+		Classify `deck`, a map of dbf_id (int) to count, among the clusters of
+		`player_class`. Return the archetype id, or None.
+		"""
+		if metrics is not None:
+			start = time.perf_counter()
+			failure_callback = metrics.failure_callback(failure_callback)
+
+		result = None
+		rows = self._rows.get(int(player_class))
+		if rows:
+			vector = self._deck_vector(deck)
+			distances = self.weights[rows].dot(vector) * self.normalizers[rows]
+			result = self._select(deck, vector, rows, distances, failure_callback)
+
+		if metrics is not None:
+			metrics.observe(result, time.perf_counter() - start)
+		return result
+
+	def classify_batch(self, decks, player_class, failure_callback=None, metrics=None):
+		"""
+		Classify a sequence of decks of the same class, see `classify`. The metrics
+		record the average latency of the batch for every deck.
+		"""
+		import numpy as np
+
+		if metrics is not None:
+			start = time.perf_counter()
+			failure_callback = metrics.failure_callback(failure_callback)
+
+		rows = self._rows.get(int(player_class))
+		if rows:
+			vectors = np.zeros((len(decks), len(self.dbf_ids)), dtype=np.float64)
+			for i, deck in enumerate(decks):
+				vectors[i] = self._deck_vector(deck)
+			distances = vectors.dot(self.weights[rows].T) * self.normalizers[rows]
+			result = [
+				self._select(deck, vectors[i], rows, distances[i], failure_callback)
+				for i, deck in enumerate(decks)
+			]
+		else:
+			result = [None] * len(decks)
+
+		if metrics is not None and decks:
+			latency = (time.perf_counter() - start) / len(decks)
+			for archetype_id in result:
+				metrics.observe(archetype_id, latency)
+		return result
+
+	def _select(self, deck, vector, rows, distances, failure_callback):
+		best_id, best_distance = None, None
+		present = vector > 0
+		rule_outcomes = {}
+		for row, distance in zip(rows, distances.tolist()):
+			cutoff = self.cutoffs[row]
+			if not distance or distance < cutoff:
+				continue
+
+			missing = self.required_cards[row] & ~present
+			if missing.any():
+				if failure_callback:
+					failure_callback({
+						"archetype_id": int(self.archetype_ids[row]),
+						"reason": "missing_required_card",
+						"dbf_id": int(self.dbf_ids[missing.argmax()])
+					})
+				continue
+
+			failed_rule = None
+			for rule_index in self.rules[row].nonzero()[0].tolist():
+				rule = self.rule_names[rule_index]
+				if rule not in FALSE_POSITIVE_RULES:
+					continue
+				if rule not in rule_outcomes:
+					rule_outcomes[rule] = FALSE_POSITIVE_RULES[rule]({"cards": deck})
+				if not rule_outcomes[rule]:
+					failed_rule = rule
+					break
+			if failed_rule:
+				if failure_callback:
+					failure_callback({
+						"archetype_id": int(self.archetype_ids[row]),
+						"reason": "false_positive",
+						"rule": failed_rule
+					})
+				continue
+
+			if best_distance is None or distance > best_distance:
+				best_id, best_distance = int(self.archetype_ids[row]), distance
+
+		return best_id
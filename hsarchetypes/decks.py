@@ -0,0 +1,337 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from hearthstone.deckstrings import parse_deckstring
+from hearthstone.enums import CardType, GameTag, Race
+
+from .features import has_mechanic, mechanics, wild_mechanics
+from .rules import (
+	FALSE_POSITIVE_RULES, is_even_only_deck,
+	is_highlander_deck, is_odd_only_deck, is_quest_deck
+)
+from .utils import card_db, dbf_id_vector
+
+
+db = card_db()
+
+DECODE_CACHE_SIZE = 100000
+
+_CARD_ATTRIBUTES = {}
+_MECHANICS_OFFSET = 11 + len(Race) + len(CardType)
+
+
+def _card_attributes(dbf_id):
+	"""
+	Return the attributes the feature vectors are built from as a list of numbers:
+	11 mana cost columns, the Race and CardType columns, the Wild mechanics (which
+	start with the Standard ones), whether the card is a quest and whether its cost
+	is odd. The table is shared by the feature vectors of every format.
+	"""
+	if dbf_id not in _CARD_ATTRIBUTES:
+		card = db[dbf_id]
+		attributes = [float(card.cost == c) for c in range(0, 11)]
+		attributes += [float(card.race == r) for r in Race]
+		attributes += [float(card.type == t) for t in CardType]
+		attributes += [float(has_mechanic(card, m)) for m in wild_mechanics]
+		attributes.append(float(GameTag.QUEST in card.tags))
+		attributes.append(float(card.cost % 2 == 1))
+		_CARD_ATTRIBUTES[dbf_id] = attributes
+	return _CARD_ATTRIBUTES[dbf_id]
+
+
+class DeckMatrix:
+	"""
+	The decks of one class in columnar form, an alternative to a list of data points
+	as the input of `create_cluster_set`.
+
+	The cards of deck `i` are `dbf_ids[offsets[i]:offsets[i + 1]]`, with the matching
+	`counts`, as in a CSR matrix whose column indices are dbf ids. `observations` and
+	the optional `shortids` hold one value per deck.
+	"""
+
+	def __init__(self, offsets, dbf_ids, counts, observations, shortids=None):
+		import numpy as np
+
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self.dbf_ids = np.asarray(dbf_ids, dtype=np.int64)
+		self.counts = np.asarray(counts, dtype=np.int64)
+		self.observations = np.asarray(observations)
+		self.shortids = shortids
+		if len(self.offsets) != len(self.observations) + 1:
+			raise ValueError("Expected one more offset than observations")
+		if shortids is not None and len(shortids) != len(self.observations):
+			raise ValueError("Expected as many shortids as observations")
+
+	@classmethod
+	def from_csr(cls, matrix, columns, observations, shortids=None):
+		"""
+		Create a DeckMatrix from a scipy.sparse CSR matrix of card counts with one row per
+		deck, where `columns` holds the dbf id of every column.
+		"""
+		import numpy as np
+
+		matrix = matrix.tocsr()
+		return cls(
+			matrix.indptr,
+			np.asarray(columns)[matrix.indices],
+			matrix.data,
+			observations,
+			shortids=shortids
+		)
+
+	@classmethod
+	def from_data_points(cls, data_points):
+		offsets = [0]
+		dbf_ids = []
+		counts = []
+		for data_point in data_points:
+			for dbf_id, count in data_point["cards"].items():
+				dbf_ids.append(int(dbf_id))
+				counts.append(count)
+			offsets.append(len(dbf_ids))
+		shortids = [d.get("shortid") for d in data_points]
+		return cls(
+			offsets,
+			dbf_ids,
+			counts,
+			[d["observations"] for d in data_points],
+			shortids=shortids if any(s is not None for s in shortids) else None
+		)
+
+	def __len__(self):
+		return len(self.observations)
+
+	def to_data_points(self, xy=None):
+		"""
+		Return the decks as data points, optionally with "x" and "y" from the rows of `xy`.
+		"""
+		offsets = self.offsets.tolist()
+		dbf_ids = self.dbf_ids.tolist()
+		counts = self.counts.tolist()
+		observations = self.observations.tolist()
+		result = []
+		for i in range(len(observations)):
+			start, end = offsets[i], offsets[i + 1]
+			data_point = {
+				"cards": {
+					str(dbf_id): count for dbf_id, count in zip(dbf_ids[start:end], counts[start:end])
+				},
+				"observations": observations[i],
+			}
+			if self.shortids is not None:
+				data_point["shortid"] = self.shortids[i]
+			if xy is not None:
+				data_point["x"] = float(xy[i][0])
+				data_point["y"] = float(xy[i][1])
+			result.append(data_point)
+		return result
+
+	def deduplicate(self):
+		"""
+		Collapse decks with identical cards, ignoring card order and zero counts.
+
+		Return a DeckMatrix of the unique decks, with their observations summed and no
+		shortids, the index of the unique deck of every deck, and the number of decks
+		collapsed into each unique deck.
+		"""
+		import numpy as np
+
+		offsets = self.offsets.tolist()
+		dbf_ids = self.dbf_ids.tolist()
+		counts = self.counts.tolist()
+		index = {}
+		inverse = []
+		for i in range(len(self)):
+			start, end = offsets[i], offsets[i + 1]
+			key = tuple(sorted(
+				(dbf_id, count) for dbf_id, count in zip(dbf_ids[start:end], counts[start:end])
+				if count
+			))
+			inverse.append(index.setdefault(key, len(index)))
+
+		unique_offsets = [0]
+		unique_dbf_ids = []
+		unique_counts = []
+		for key in index:
+			for dbf_id, count in key:
+				unique_dbf_ids.append(dbf_id)
+				unique_counts.append(count)
+			unique_offsets.append(len(unique_dbf_ids))
+
+		inverse = np.array(inverse, dtype=np.int64)
+		observations = np.zeros(len(index), dtype=self.observations.dtype)
+		np.add.at(observations, inverse, self.observations)
+		duplicates = np.bincount(inverse, minlength=len(index))
+		unique = DeckMatrix(unique_offsets, unique_dbf_ids, unique_counts, observations)
+		return unique, inverse.tolist(), duplicates.tolist()
+
+	def _csr(self):
+		import numpy as np
+		from scipy import sparse
+
+		columns, indices = np.unique(self.dbf_ids, return_inverse=True)
+		matrix = sparse.csr_matrix(
+			(self.counts.astype(np.float64), indices.ravel(), self.offsets),
+			shape=(len(self), len(columns))
+		)
+		return matrix, columns.tolist()
+
+	def _rule_outcomes(self, rule, presence, attributes):
+		import numpy as np
+
+		if rule is is_highlander_deck:
+			return np.diff(self.offsets) == 30
+		if rule is is_quest_deck:
+			return presence.dot(attributes[:, -2]) > 0
+		if rule is is_even_only_deck:
+			return presence.dot(attributes[:, -1]) == 0
+		if rule is is_odd_only_deck:
+			return presence.dot(1 - attributes[:, -1]) == 0
+		return np.array([rule(d) for d in self.to_data_points()])
+
+	def feature_matrix(
+		self,
+		player_class,
+		use_mana_curve=True,
+		use_tribes=True,
+		use_card_types=True,
+		use_mechanics=True,
+		mechanics=mechanics,
+	):
+		"""
+		Return the feature vectors of the decks as a numpy array, equal to the
+		output of clustering._to_feature_vectors for the same decks as data points.
+		"""
+		import numpy as np
+
+		matrix, columns = self._csr()
+		presence = matrix.copy()
+		presence.data = np.ones_like(presence.data)
+		attributes = np.array([_card_attributes(dbf_id) for dbf_id in columns])
+		attributes = attributes.reshape((len(columns), -1))
+		num_cards = np.asarray(matrix.sum(axis=1)).reshape((-1, 1))
+
+		base_vector = dbf_id_vector(player_class=player_class)
+		base_index = {dbf_id: i for i, dbf_id in enumerate(base_vector)}
+		selected = [(i, base_index[dbf_id]) for i, dbf_id in enumerate(columns) if dbf_id in base_index]
+		card_features = np.zeros((len(self), len(base_vector)))
+		if selected:
+			source, target = (np.array(t) for t in zip(*selected))
+			card_features[:, target] = matrix[:, source].toarray() / 2.0
+
+		parts = [card_features]
+		for rule in FALSE_POSITIVE_RULES.values():
+			outcomes = self._rule_outcomes(rule, presence, attributes)
+			parts.append(outcomes.astype(np.float64).reshape((-1, 1)))
+
+		num_races = len(Race)
+		ranges = [
+			(use_mana_curve, 0, 11),
+			(use_tribes, 11, 11 + num_races),
+			(use_card_types, 11 + num_races, _MECHANICS_OFFSET),
+		]
+		for enabled, start, end in ranges:
+			if enabled:
+				parts.append(matrix.dot(attributes[:, start:end]) / num_cards)
+
+		if use_mechanics:
+			mechanic_attributes = np.zeros((len(columns), len(mechanics)))
+			for i, mechanic in enumerate(mechanics):
+				if mechanic in wild_mechanics:
+					column = _MECHANICS_OFFSET + wild_mechanics.index(mechanic)
+					mechanic_attributes[:, i] = attributes[:, column]
+				else:
+					mechanic_attributes[:, i] = [
+						float(has_mechanic(db[dbf_id], mechanic)) for dbf_id in columns
+					]
+			parts.append(matrix.dot(mechanic_attributes) / num_cards)
+
+		return np.hstack(parts)
+
+
+def _decode_deckstring(deckstring):
+	# parse_deckstring returns the sideboards as a fourth item in newer versions
+	cards = parse_deckstring(deckstring)[0]
+	return tuple((int(dbf_id), int(count)) for dbf_id, count in cards)
+
+
+class DeckstringDecoder:
+	"""
+	Decode batches of deckstrings, remembering the cards of the `cache_size` most
+	recently seen deckstrings. With max_workers, deckstrings missing from the cache
+	are decoded in a pool of that many processes, which is started on first use and
+	kept until `close` (or the end of a `with` block).
+	"""
+
+	def __init__(self, cache_size=DECODE_CACHE_SIZE, max_workers=None):
+		self.cache_size = cache_size
+		self.max_workers = max_workers
+		self._cache = OrderedDict()
+		self._executor = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def close(self):
+		"""Shut down the worker processes, if any."""
+		if self._executor is not None:
+			self._executor.shutdown()
+			self._executor = None
+
+	def _remember(self, deckstring, cards):
+		self._cache[deckstring] = cards
+		if len(self._cache) > self.cache_size:
+			self._cache.popitem(last=False)
+
+	def decode(self, deckstring):
+		"""Return the cards of `deckstring` as a tuple of (dbf_id, count) pairs."""
+		cards = self._cache.get(deckstring)
+		if cards is None:
+			cards = _decode_deckstring(deckstring)
+			self._remember(deckstring, cards)
+		else:
+			self._cache.move_to_end(deckstring)
+		return cards
+
+	def decode_all(self, deckstrings):
+		"""Return the cards of every deckstring in the iterable, see `decode`."""
+		deckstrings = list(deckstrings)
+		if self.max_workers:
+			missing = list(OrderedDict.fromkeys(d for d in deckstrings if d not in self._cache))
+			if missing:
+				chunksize = max(1, len(missing) // (self.max_workers * 4))
+				if self._executor is None:
+					self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+				decoded = dict(zip(
+					missing, self._executor.map(_decode_deckstring, missing, chunksize=chunksize)
+				))
+				for deckstring, cards in decoded.items():
+					self._remember(deckstring, cards)
+				return [
+					decoded[d] if d in decoded else self.decode(d) for d in deckstrings
+				]
+		return [self.decode(d) for d in deckstrings]
+
+	def to_dicts(self, deckstrings):
+		"""Return the decks as maps of dbf_id (int) to count, as classify_deck expects."""
+		return [dict(cards) for cards in self.decode_all(deckstrings)]
+
+	def to_matrix(self, deckstrings, observations=None, shortids=None):
+		"""
+		Return the decks as a DeckMatrix. Without `observations`, each deck is
+		observed once.
+		"""
+		offsets = [0]
+		dbf_ids = []
+		counts = []
+		for cards in self.decode_all(deckstrings):
+			for dbf_id, count in cards:
+				dbf_ids.append(dbf_id)
+				counts.append(count)
+			offsets.append(len(dbf_ids))
+		if observations is None:
+			observations = [1] * (len(offsets) - 1)
+		return DeckMatrix(offsets, dbf_ids, counts, observations, shortids=shortids)
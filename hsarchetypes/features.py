@@ -1,7 +1,7 @@
 from collections import defaultdict
 from random import randint, shuffle
 
-from hearthstone.enums import CardType, GameTag, Race
+from hearthstone.enums import CardType, FormatType, GameTag, Race
 
 from .utils import card_db, one_hot_encoding
 
@@ -61,14 +61,25 @@ wild_mechanics = mechanics + [
 ]
 
 
-def to_mechanic_vector(deck):
+def mechanics_for_format(game_format):
+	"""Return the mechanics the feature vectors of `game_format` (a FormatType) use."""
+	if game_format is not None and FormatType(game_format) == FormatType.FT_WILD:
+		return wild_mechanics
+	return mechanics
+
+
+def has_mechanic(card, mechanic):
+	return bool(card.tags.get(mechanic, 0) or card.referenced_tags.get(mechanic, 0))
+
+
+def to_mechanic_vector(deck, mechanics=mechanics):
 	num_cards = float(sum(deck["cards"].values()))
 	mechanics_count = []
 	for mechanic in mechanics:
 		num_occurs = float(0)
 		for dbf_id, count in deck["cards"].items():
 			card = db[int(dbf_id)]
-			if card.tags.get(mechanic, 0) or card.referenced_tags.get(mechanic, 0):
+			if has_mechanic(card, mechanic):
 				num_occurs += float(count)
 		mechanics_count.append(num_occurs / num_cards)
 
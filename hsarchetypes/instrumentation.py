@@ -0,0 +1,406 @@
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+try:
+	import resource
+except ImportError:  # pragma: no cover (Windows)
+	resource = None
+
+
+PROC_STATUS_PATH = "/proc/self/status"
+PROC_CLEAR_REFS_PATH = "/proc/self/clear_refs"
+
+
+def process_peak_rss():
+	"""
+	Return the peak resident set size of the current process in bytes, or None.
+
+	This is the high-water mark of the whole process lifetime.
+	"""
+	if resource is None:
+		return None
+	max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+	return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def current_rss():
+	"""
+	Return the current and peak resident set size of the process in bytes, as read
+	from /proc (VmRSS and VmHWM), or None where /proc is not available.
+	"""
+	try:
+		with open(PROC_STATUS_PATH) as f:
+			fields = dict(line.split(":", 1) for line in f if line.startswith("Vm"))
+		return int(fields["VmRSS"].split()[0]) * 1024, int(fields["VmHWM"].split()[0]) * 1024
+	except (OSError, KeyError, ValueError):
+		return None
+
+
+def reset_peak_rss():
+	"""Reset the peak RSS (VmHWM) of the process, on Linux. Return whether it was reset."""
+	try:
+		with open(PROC_CLEAR_REFS_PATH, "w") as f:
+			f.write("5")
+	except OSError:
+		return False
+	return True
+
+
+def _escape_label_value(value):
+	return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _prometheus_sample(name, labels, value):
+	if not labels:
+		return "%s %s" % (name, repr(float(value)))
+	label_str = ",".join(
+		'%s="%s"' % (k, _escape_label_value(v)) for k, v in labels.items()
+	)
+	return "%s{%s} %s" % (name, label_str, repr(float(value)))
+
+
+def _prometheus_metric(name, metric_type, help_text, samples):
+	lines = ["# HELP %s %s" % (name, help_text), "# TYPE %s %s" % (name, metric_type)]
+	for labels, value in samples:
+		lines.append(_prometheus_sample(name, labels, value))
+	return lines
+
+
+def write_textfile(path, text):
+	"""Atomically write `text` to `path`, as the Prometheus textfile collector expects."""
+	tmp_path = "%s.%i.tmp" % (path, os.getpid())
+	with open(tmp_path, "w") as f:
+		f.write(text)
+	os.replace(tmp_path, path)
+
+
+class Tracer:
+	"""
+	Record the wall time, CPU time and RSS of the stages of a clustering run.
+
+	Pass an instance as `tracer` to `create_cluster_set` (or set it as the `tracer`
+	of a ClusterSet) and export the result with `to_json` or `write_prometheus`.
+	Stages may nest, e.g. every consolidation iteration includes a signature update.
+
+	Each record has "peak_rss", the peak RSS of the process during the stage, and
+	"rss_delta", the RSS at the end of the stage relative to its start. The peak is
+	reset at the start of every stage where the kernel allows it (Linux, see
+	`reset_peak_rss`); elsewhere `peak_rss_scope` is "process" and "peak_rss" is the
+	peak of the process so far, and "rss_delta" is None without /proc.
+	"""
+
+	enabled = True
+
+	def __init__(self):
+		self.records = []
+		self.peak_rss_scope = (
+			"stage" if current_rss() is not None and reset_peak_rss() else "process"
+		)
+		self._rss_stack = []
+
+	def config(self):
+		"""
+		Return the keyword arguments that create a tracer like this one, e.g. in the
+		worker processes of ClusterSet.consolidate_clusters.
+		"""
+		return {}
+
+	def stop(self):
+		"""Release what the tracer holds on to; nothing for a plain Tracer."""
+		pass
+
+	def _enter_rss(self):
+		rss = current_rss()
+		frame = {"start": None, "peak": 0}
+		if rss is not None:
+			frame["start"], peak = rss
+			if self._rss_stack:
+				# The enclosing stage keeps the peak it saw before it is reset
+				self._rss_stack[-1]["peak"] = max(self._rss_stack[-1]["peak"], peak)
+			if self.peak_rss_scope == "stage":
+				reset_peak_rss()
+		self._rss_stack.append(frame)
+		return frame
+
+	def _exit_rss(self, frame):
+		self._rss_stack.pop()
+		rss = current_rss()
+		if rss is None or frame["start"] is None:
+			return process_peak_rss(), None
+		current, peak = rss
+		peak = max(frame["peak"], peak)
+		if self._rss_stack:
+			self._rss_stack[-1]["peak"] = max(self._rss_stack[-1]["peak"], peak)
+		return peak, current - frame["start"]
+
+	@contextmanager
+	def stage(self, name, player_class=None):
+		frame = self._enter_rss()
+		wall_start = time.perf_counter()
+		cpu_start = time.process_time()
+		try:
+			yield
+		finally:
+			wall_time = time.perf_counter() - wall_start
+			cpu_time = time.process_time() - cpu_start
+			peak_rss, rss_delta = self._exit_rss(frame)
+			self.records.append({
+				"stage": name,
+				"player_class": player_class,
+				"wall_time": wall_time,
+				"cpu_time": cpu_time,
+				"peak_rss": peak_rss,
+				"rss_delta": rss_delta,
+			})
+
+	def extend(self, records):
+		"""Add records collected elsewhere, e.g. by a Tracer in a worker process."""
+		self.records.extend(records)
+
+	def summary(self):
+		"""Aggregate the records per stage and player class, in order of first occurrence."""
+		result = OrderedDict()
+		for record in self.records:
+			key = (record["stage"], record["player_class"])
+			if key not in result:
+				result[key] = {
+					"stage": record["stage"],
+					"player_class": record["player_class"],
+					"calls": 0,
+					"wall_time": 0.0,
+					"cpu_time": 0.0,
+					"peak_rss": None,
+					"rss_delta": None,
+				}
+			entry = result[key]
+			entry["calls"] += 1
+			entry["wall_time"] += record["wall_time"]
+			entry["cpu_time"] += record["cpu_time"]
+			if record["peak_rss"] is not None:
+				entry["peak_rss"] = max(entry["peak_rss"] or 0, record["peak_rss"])
+			if record["rss_delta"] is not None:
+				entry["rss_delta"] = (entry["rss_delta"] or 0) + record["rss_delta"]
+		return list(result.values())
+
+	def to_json(self, indent=None):
+		return json.dumps({
+			"stages": self.summary(),
+			"records": self.records,
+			"peak_rss_scope": self.peak_rss_scope,
+			"process_peak_rss": process_peak_rss(),
+		}, indent=indent)
+
+	def write_json(self, path, indent=4):
+		with open(path, "w") as f:
+			f.write(self.to_json(indent=indent))
+
+	def to_prometheus(self, prefix="hsarchetypes_stage"):
+		summary = self.summary()
+
+		def samples(field):
+			for entry in summary:
+				if entry[field] is None:
+					continue
+				labels = OrderedDict([
+					("stage", entry["stage"]),
+					("player_class", entry["player_class"] or ""),
+				])
+				yield labels, entry[field]
+
+		lines = []
+		lines += _prometheus_metric(
+			prefix + "_calls_total", "counter",
+			"Number of times the stage ran.", samples("calls")
+		)
+		lines += _prometheus_metric(
+			prefix + "_wall_seconds_total", "counter",
+			"Wall time spent in the stage.", samples("wall_time")
+		)
+		lines += _prometheus_metric(
+			prefix + "_cpu_seconds_total", "counter",
+			"CPU time spent in the stage.", samples("cpu_time")
+		)
+		lines += _prometheus_metric(
+			prefix + "_peak_rss_bytes", "gauge",
+			"Peak resident set size of the process during the stage.", samples("peak_rss")
+		)
+		lines += _prometheus_metric(
+			prefix + "_rss_delta_bytes", "gauge",
+			"Resident set size added by the stage, summed over its calls.",
+			samples("rss_delta")
+		)
+		rss = process_peak_rss()
+		lines += _prometheus_metric(
+			prefix + "_process_peak_rss_bytes", "gauge",
+			"Peak resident set size of the process over the whole run.",
+			[({}, rss)] if rss is not None else []
+		)
+		return "\n".join(lines) + "\n"
+
+	def write_prometheus(self, path, prefix="hsarchetypes_stage"):
+		write_textfile(path, self.to_prometheus(prefix=prefix))
+
+
+class MemoryTracer(Tracer):
+	"""
+	A Tracer that also records the Python heap usage of every stage with tracemalloc.
+
+	Each record gains "memory_peak" (the peak traced memory during the stage),
+	"memory_delta" (the memory still allocated at the end of the stage, relative to
+	its start) and "top_allocations", the `top_n` source lines that allocated the most
+	of it. Snapshots are taken at the start and end of every stage, which is slow
+	on large heaps; pass top_n=0 to only record peaks. Call `stop` once done.
+	Before Python 3.9 tracemalloc peaks cannot be reset, so peaks are cumulative.
+	"""
+
+	def __init__(self, top_n=10, frames=1):
+		super().__init__()
+		self.top_n = top_n
+		self.frames = frames
+		self._started = not tracemalloc.is_tracing()
+		if self._started:
+			tracemalloc.start(frames)
+		self._stack = []
+
+	def config(self):
+		return {"top_n": self.top_n, "frames": self.frames}
+
+	def stop(self):
+		"""Stop tracemalloc, if this tracer started it."""
+		if self._started and tracemalloc.is_tracing():
+			tracemalloc.stop()
+		self._started = False
+
+	def _reset_peak(self):
+		current, peak = tracemalloc.get_traced_memory()
+		if self._stack:
+			# The enclosing stage keeps the peak it saw before it is reset
+			self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+		if hasattr(tracemalloc, "reset_peak"):
+			tracemalloc.reset_peak()
+		return current
+
+	def _snapshot(self):
+		if not self.top_n:
+			return None
+		return tracemalloc.take_snapshot().filter_traces([
+			tracemalloc.Filter(False, tracemalloc.__file__),
+			tracemalloc.Filter(False, __file__),
+		])
+
+	@contextmanager
+	def stage(self, name, player_class=None):
+		snapshot = self._snapshot()
+		frame = {"start": self._reset_peak(), "peak": 0}
+		self._stack.append(frame)
+		try:
+			with super().stage(name, player_class):
+				yield
+		finally:
+			self._stack.pop()
+			current, peak = tracemalloc.get_traced_memory()
+			peak = max(frame["peak"], peak)
+			if self._stack:
+				self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+			record = self.records[-1]
+			record["memory_peak"] = peak
+			record["memory_delta"] = current - frame["start"]
+			record["top_allocations"] = []
+			if snapshot is not None:
+				stats = self._snapshot().compare_to(snapshot, "lineno")
+				stats = sorted(stats, key=lambda s: s.size_diff, reverse=True)[:self.top_n]
+				record["top_allocations"] = [
+					{
+						"site": "%s:%i" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+						"size": stat.size_diff,
+						"count": stat.count_diff,
+					}
+					for stat in stats if stat.size_diff > 0
+				]
+
+	def summary(self):
+		result = super().summary()
+		by_key = {(entry["stage"], entry["player_class"]): entry for entry in result}
+		sites = {}
+		for record in self.records:
+			key = (record["stage"], record["player_class"])
+			entry = by_key[key]
+			if "memory_peak" in record:
+				entry["memory_peak"] = max(entry.get("memory_peak", 0), record["memory_peak"])
+			site_sizes = sites.setdefault(key, {})
+			for allocation in record.get("top_allocations", []):
+				site_sizes[allocation["site"]] = \
+					site_sizes.get(allocation["site"], 0) + allocation["size"]
+		for key, entry in by_key.items():
+			entry.setdefault("memory_peak", None)
+			site_sizes = sorted(sites.get(key, {}).items(), key=lambda t: t[1], reverse=True)
+			entry["top_allocations"] = [
+				{"site": site, "size": size} for site, size in site_sizes[:self.top_n]
+			]
+		return result
+
+	def memory_report(self):
+		"""Return a plain text report of the stages, the ones with the highest peak first."""
+		summary = sorted(
+			(e for e in self.summary() if e["memory_peak"] is not None),
+			key=lambda e: e["memory_peak"],
+			reverse=True
+		)
+		rss = process_peak_rss()
+		lines = ["process peak rss %s" % ("%.1f MiB" % (rss / 2 ** 20) if rss else "-")]
+		for entry in summary:
+			lines.append("%-24s %-12s peak %10.1f MiB  rss %10s" % (
+				entry["stage"],
+				entry["player_class"] or "",
+				entry["memory_peak"] / 2 ** 20,
+				"%.1f MiB" % (entry["peak_rss"] / 2 ** 20) if entry["peak_rss"] else "-",
+			))
+			for allocation in entry["top_allocations"]:
+				lines.append("    %10.1f KiB  %s" % (allocation["size"] / 2 ** 10, allocation["site"]))
+		return "\n".join(lines) + "\n"
+
+	def to_prometheus(self, prefix="hsarchetypes_stage"):
+		samples = []
+		for entry in self.summary():
+			if entry["memory_peak"] is not None:
+				labels = OrderedDict([
+					("stage", entry["stage"]),
+					("player_class", entry["player_class"] or ""),
+				])
+				samples.append((labels, entry["memory_peak"]))
+		lines = _prometheus_metric(
+			prefix + "_memory_peak_bytes", "gauge",
+			"Peak traced Python memory during the stage.", samples
+		)
+		return super().to_prometheus(prefix=prefix) + "\n".join(lines) + "\n"
+
+
+class _NullStage:
+	def __enter__(self):
+		return None
+
+	def __exit__(self, *exc_info):
+		return False
+
+
+class NullTracer:
+	"""A tracer that records nothing; the default when instrumentation is disabled."""
+
+	enabled = False
+	_stage = _NullStage()
+
+	def stage(self, name, player_class=None):
+		return self._stage
+
+	def extend(self, records):
+		pass
+
+
+NULL_TRACER = NullTracer()
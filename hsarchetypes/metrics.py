@@ -0,0 +1,184 @@
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+from .instrumentation import _prometheus_metric, _prometheus_sample, write_textfile
+
+
+# Upper bounds (in seconds) of the classification latency histogram buckets
+LATENCY_BUCKETS = (
+	0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+	0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, float("inf"),
+)
+
+
+class _MetricsState:
+	__slots__ = ("classified", "unclassified", "rejections", "latency_counts", "latency_sum")
+
+	def __init__(self, num_buckets):
+		self.classified = {}
+		self.unclassified = 0
+		self.rejections = {}
+		self.latency_counts = [0] * num_buckets
+		self.latency_sum = 0.0
+
+
+class ClassificationMetrics:
+	"""
+	Counters and a latency histogram for classifications, see the `metrics`
+	argument of classify_deck.
+
+	Every thread updates its own counters without locking; reads add them up.
+	Metrics of other processes can be combined with `to_dict`, `from_dict` and
+	`merge`, and the totals exported with `write_prometheus`.
+	"""
+
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.buckets = tuple(float(b) for b in buckets)
+		if self.buckets[-1] != float("inf"):
+			self.buckets += (float("inf"), )
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._states = []
+
+	def _state(self):
+		try:
+			return self._local.state
+		except AttributeError:
+			state = _MetricsState(len(self.buckets))
+			with self._lock:
+				self._states.append(state)
+			self._local.state = state
+			return state
+
+	def observe(self, archetype_id, latency):
+		"""Count a classification as `archetype_id` (None if unclassified) taking `latency` seconds."""
+		state = self._state()
+		if archetype_id is None:
+			state.unclassified += 1
+		else:
+			state.classified[archetype_id] = state.classified.get(archetype_id, 0) + 1
+		state.latency_counts[bisect_left(self.buckets, latency)] += 1
+		state.latency_sum += latency
+
+	def reject(self, failure):
+		"""Count a rejection, as passed to the failure callback of classify_deck."""
+		key = (failure["reason"], failure.get("rule"), failure.get("dbf_id"))
+		rejections = self._state().rejections
+		rejections[key] = rejections.get(key, 0) + 1
+
+	def failure_callback(self, callback=None):
+		"""Return a failure callback that counts rejections before invoking `callback`."""
+		def failure_callback(failure):
+			self.reject(failure)
+			if callback:
+				callback(failure)
+		return failure_callback
+
+	def merge(self, other):
+		"""Add the counts of another ClassificationMetrics with the same buckets."""
+		if other.buckets != self.buckets:
+			raise ValueError("Cannot merge metrics with different latency buckets")
+		totals = other._totals()
+		state = self._state()
+		for archetype_id, count in totals.classified.items():
+			state.classified[archetype_id] = state.classified.get(archetype_id, 0) + count
+		state.unclassified += totals.unclassified
+		for key, count in totals.rejections.items():
+			state.rejections[key] = state.rejections.get(key, 0) + count
+		for i, count in enumerate(totals.latency_counts):
+			state.latency_counts[i] += count
+		state.latency_sum += totals.latency_sum
+		return self
+
+	def _totals(self):
+		result = _MetricsState(len(self.buckets))
+		with self._lock:
+			states = list(self._states)
+		for state in states:
+			for archetype_id, count in list(state.classified.items()):
+				result.classified[archetype_id] = result.classified.get(archetype_id, 0) + count
+			result.unclassified += state.unclassified
+			for key, count in list(state.rejections.items()):
+				result.rejections[key] = result.rejections.get(key, 0) + count
+			for i, count in enumerate(state.latency_counts):
+				result.latency_counts[i] += count
+			result.latency_sum += state.latency_sum
+		return result
+
+	def to_dict(self):
+		totals = self._totals()
+		return {
+			"classified": [[k, v] for k, v in sorted(totals.classified.items())],
+			"unclassified": totals.unclassified,
+			"rejections": [
+				{"reason": reason, "rule": rule, "dbf_id": dbf_id, "count": count}
+				for (reason, rule, dbf_id), count in sorted(
+					totals.rejections.items(), key=lambda t: repr(t[0])
+				)
+			],
+			"latency": {
+				"buckets": [None if b == float("inf") else b for b in self.buckets],
+				"counts": totals.latency_counts,
+				"sum": totals.latency_sum,
+			},
+		}
+
+	@classmethod
+	def from_dict(cls, data):
+		latency = data["latency"]
+		self = cls(buckets=[float("inf") if b is None else b for b in latency["buckets"]])
+		state = self._state()
+		state.classified = {k: v for k, v in data["classified"]}
+		state.unclassified = data["unclassified"]
+		state.rejections = {
+			(r["reason"], r["rule"], r["dbf_id"]): r["count"] for r in data["rejections"]
+		}
+		state.latency_counts = list(latency["counts"])
+		state.latency_sum = latency["sum"]
+		return self
+
+	def to_prometheus(self, prefix="hsarchetypes_classification"):
+		totals = self._totals()
+		lines = []
+		lines += _prometheus_metric(
+			prefix + "_classified_total", "counter",
+			"Number of decks classified, per archetype.",
+			(
+				(OrderedDict([("archetype_id", archetype_id)]), count)
+				for archetype_id, count in sorted(totals.classified.items())
+			)
+		)
+		lines += _prometheus_metric(
+			prefix + "_unclassified_total", "counter",
+			"Number of decks that could not be classified.",
+			[(OrderedDict(), totals.unclassified)]
+		)
+		lines += _prometheus_metric(
+			prefix + "_rejections_total", "counter",
+			"Number of classifications blocked by a required card or a false positive rule.",
+			(
+				(OrderedDict([
+					("reason", reason),
+					("rule", rule or ""),
+					("dbf_id", "" if dbf_id is None else dbf_id),
+				]), count)
+				for (reason, rule, dbf_id), count in sorted(
+					totals.rejections.items(), key=lambda t: repr(t[0])
+				)
+			)
+		)
+
+		name = prefix + "_latency_seconds"
+		lines += _prometheus_metric(name, "histogram", "Time spent classifying a deck.", [])
+		cumulative = 0
+		for bucket, count in zip(self.buckets, totals.latency_counts):
+			cumulative += count
+			le = "+Inf" if bucket == float("inf") else repr(bucket)
+			lines.append(_prometheus_sample(name + "_bucket", OrderedDict([("le", le)]), cumulative))
+		lines.append(_prometheus_sample(name + "_sum", OrderedDict(), totals.latency_sum))
+		lines.append(_prometheus_sample(name + "_count", OrderedDict(), cumulative))
+		return "\n".join(lines) + "\n"
+
+	def write_prometheus(self, path, prefix="hsarchetypes_classification"):
+		write_textfile(path, self.to_prometheus(prefix=prefix))
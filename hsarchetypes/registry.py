@@ -0,0 +1,106 @@
+"""
+Compiled classifiers and feature configurations per game format and player class.
+"""
+from hearthstone.enums import CardClass, FormatType
+
+from .compiled import CompiledClassifier
+from .features import mechanics_for_format
+
+
+FEATURE_OPTIONS = ("use_mana_curve", "use_tribes", "use_card_types", "use_mechanics")
+
+
+def _format_type(game_format):
+	if isinstance(game_format, str):
+		return FormatType[game_format]
+	return FormatType(game_format)
+
+
+def _player_class(player_class):
+	if isinstance(player_class, str):
+		return CardClass[player_class]
+	return CardClass(player_class)
+
+
+class ClassifierRegistry:
+	"""
+	Hold a compiled classifier for every (game format, player class), so that a
+	deck is only scored against the clusters of its own format and class.
+
+	The feature options of every (game format, player class) are kept alongside, as
+	keyword arguments for clustering._to_feature_vectors and DeckMatrix.feature_matrix.
+	They default to the mechanics of the format, see features.mechanics_for_format.
+	Feature vectors of all formats are built from the same card attribute table.
+	"""
+
+	def __init__(self):
+		self._classifiers = {}
+		self._feature_options = {}
+
+	def __contains__(self, key):
+		game_format, player_class = key
+		return (_format_type(game_format), _player_class(player_class)) in self._classifiers
+
+	def register(self, classifier, game_format=None, player_classes=None):
+		"""
+		Register a CompiledClassifier for `player_classes`, all the classes it has
+		clusters for by default, in `game_format`, the format it was compiled for by
+		default.
+		"""
+		game_format = game_format if game_format is not None else classifier.game_format
+		if game_format is None:
+			raise ValueError("The game format of the classifier is unknown")
+		game_format = _format_type(game_format)
+		if player_classes is None:
+			player_classes = sorted(set(classifier.player_classes.tolist()))
+		for player_class in player_classes:
+			self._classifiers[(game_format, _player_class(player_class))] = classifier
+
+	def load(self, path, game_format=None, player_classes=None):
+		"""Load a classifier artifact written by write_classifier and register it."""
+		classifier = CompiledClassifier.load(path)
+		self.register(classifier, game_format=game_format, player_classes=player_classes)
+		return classifier
+
+	def configure(self, game_format, player_class=None, **options):
+		"""
+		Set feature options for `game_format`, for every class unless `player_class`
+		is given. Options for a class take precedence over those of its format.
+		"""
+		for option in options:
+			if option not in FEATURE_OPTIONS + ("mechanics", ):
+				raise TypeError("Unknown feature option: %r" % (option, ))
+		if player_class is not None:
+			player_class = _player_class(player_class)
+		key = (_format_type(game_format), player_class)
+		self._feature_options.setdefault(key, {}).update(options)
+
+	def feature_options(self, game_format, player_class):
+		game_format = _format_type(game_format)
+		result = {"mechanics": mechanics_for_format(game_format)}
+		result.update(self._feature_options.get((game_format, None), {}))
+		result.update(self._feature_options.get((game_format, _player_class(player_class)), {}))
+		return result
+
+	def classifier(self, game_format, player_class):
+		"""Return the classifier of `game_format` and `player_class`, or None."""
+		return self._classifiers.get((_format_type(game_format), _player_class(player_class)))
+
+	def classify(self, deck, game_format, player_class, failure_callback=None, metrics=None):
+		"""
+		Classify `deck`, a map of dbf_id (int) to count, among the clusters of its
+		format and class. Return the archetype id, or None.
+		"""
+		player_class = _player_class(player_class)
+		classifier = self.classifier(game_format, player_class)
+		if classifier is None:
+			return None
+		return classifier.classify(
+			deck, player_class, failure_callback=failure_callback, metrics=metrics
+		)
+
+	def feature_matrix(self, decks, game_format, player_class):
+		"""Return the feature vectors of `decks`, a DeckMatrix, for the format and class."""
+		return decks.feature_matrix(
+			_player_class(player_class).name, **self.feature_options(game_format, player_class)
+		)
@@ -0,0 +1,443 @@
+"""
+A local asyncio HTTP server classifying decks with a compiled classifier artifact,
+see hsarchetypes.compiled:
+
+	python -m hsarchetypes.server classifier.npz --port 8080
+
+Endpoints:
+
+	POST /classify
+		{"player_class": "PRIEST", "cards": {"<dbf_id>": count, ...}}
+		or {"player_class": "PRIEST", "deckstring": "..."}
+		returns {"archetype_id": <int or null>}
+	GET /health
+		returns {"status": "ok", "version": ..., "game_format": ...}
+	GET /metrics
+		Prometheus text exposition, when serving with metrics
+
+Classify requests arriving together are batched per player class into one
+CompiledClassifier.classify_batch call, run in an executor so that scoring never
+blocks the event loop. The artifact is reloaded when its modification time changes;
+batches already dispatched finish with the classifier they started with, so no
+request is dropped. Replace the artifact atomically (write a temporary file, then
+os.replace it over the old one) so that a partially written file is never loaded.
+"""
+import argparse
+import asyncio
+import functools
+import io
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from hearthstone.enums import CardClass
+
+from .compiled import CompiledClassifier
+from .decks import DeckstringDecoder
+
+
+logger = logging.getLogger("hsarchetypes")
+
+MAX_BATCH_SIZE = 256
+BATCH_DELAY = 0.002
+RELOAD_INTERVAL = 1.0
+MAX_BODY_SIZE = 1024 * 1024
+
+HTTP_REASONS = {
+	200: "OK",
+	400: "Bad Request",
+	404: "Not Found",
+	405: "Method Not Allowed",
+	413: "Payload Too Large",
+	500: "Internal Server Error",
+	503: "Service Unavailable",
+}
+
+
+# Classifiers loaded by worker processes, as {path: (version, classifier)}
+_WORKER_CLASSIFIERS = {}
+
+
+class StaleClassifierError(Exception):
+	"""Raised by a worker process that doesn't hold the requested classifier version."""
+
+
+def _worker_classify_batch(path, version, decks, player_class, artifact=None):
+	# Workers never read the file themselves: they load the artifact bytes the server
+	# validated, which it only sends to workers that don't have that version yet.
+	entry = _WORKER_CLASSIFIERS.get(path)
+	if entry is None or entry[0] != version:
+		if artifact is None:
+			raise StaleClassifierError(version)
+		entry = (version, CompiledClassifier.load(io.BytesIO(artifact)))
+		_WORKER_CLASSIFIERS[path] = entry
+	return entry[1].classify_batch(decks, player_class)
+
+
+class HTTPError(Exception):
+	def __init__(self, status, message):
+		super().__init__(message)
+		self.status = status
+		self.message = message
+
+
+class ClassificationServer:
+	"""
+	Serve classifications of the artifact at `path`.
+
+	Scoring runs in `executor`, the default thread pool of the event loop if None.
+	With a ProcessPoolExecutor, each worker process is sent the artifact once per
+	version the server loaded successfully, and otherwise only decks and archetype
+	ids cross the process boundary. `metrics` is an optional ClassificationMetrics,
+	exposed on /metrics.
+	"""
+
+	def __init__(
+		self,
+		path,
+		executor=None,
+		metrics=None,
+		max_batch_size=MAX_BATCH_SIZE,
+		batch_delay=BATCH_DELAY,
+		reload_interval=RELOAD_INTERVAL,
+	):
+		self.path = path
+		self.executor = executor
+		self.metrics = metrics
+		self.max_batch_size = max_batch_size
+		self.batch_delay = batch_delay
+		self.reload_interval = reload_interval
+		self.decoder = DeckstringDecoder()
+		self.address = None
+
+		# (version, classifier, artifact bytes), replaced as a whole on reload
+		self._current = None
+		self._queue = None
+		self._server = None
+		self._batcher = None
+		self._reloader = None
+		self._batches = set()
+		self._closing = False
+
+	@property
+	def classifier(self):
+		return self._current[1] if self._current else None
+
+	@property
+	def version(self):
+		return self._current[0] if self._current else None
+
+	def load(self):
+		"""
+		Load the artifact if it changed since the last load. Return True if it did.
+		If the artifact cannot be loaded, the current classifier is kept.
+		"""
+		if self._current and os.stat(self.path).st_mtime_ns == self._current[0]:
+			return False
+		with open(self.path, "rb") as f:
+			# The version of the file that was actually read, should it be replaced
+			version = os.fstat(f.fileno()).st_mtime_ns
+			artifact = f.read()
+		classifier = CompiledClassifier.load(io.BytesIO(artifact))
+		self._current = (version, classifier, artifact)
+		return True
+
+	async def start(self, host="127.0.0.1", port=0, unix_path=None):
+		"""Start listening on `host`:`port`, or on the Unix socket `unix_path`."""
+		loop = asyncio.get_event_loop()
+		if self._current is None:
+			await loop.run_in_executor(None, self.load)
+		if isinstance(self.executor, ProcessPoolExecutor):
+			# Start the workers before accepting connections: forked workers would
+			# otherwise inherit, and keep open, the sockets of the clients connected
+			# at the time.
+			await loop.run_in_executor(
+				self.executor, _worker_classify_batch,
+				self.path, self.version, [], 0, self._current[2]
+			)
+		self._closing = False
+		self._queue = asyncio.Queue()
+		self._batcher = loop.create_task(self._batch_loop())
+		self._reloader = loop.create_task(self._reload_loop())
+		if unix_path:
+			self._server = await asyncio.start_unix_server(
+				self._handle_connection, path=unix_path
+			)
+		else:
+			self._server = await asyncio.start_server(self._handle_connection, host, port)
+		self.address = self._server.sockets[0].getsockname()
+		return self._server
+
+	async def stop(self):
+		"""Stop listening, and finish the classify requests already received."""
+		self._closing = True
+		self._server.close()
+		await self._server.wait_closed()
+		self._reloader.cancel()
+		await asyncio.gather(self._reloader, return_exceptions=True)
+		await self._queue.put(None)
+		await self._batcher
+		if self._batches:
+			await asyncio.gather(*self._batches, return_exceptions=True)
+
+	async def classify(self, deck, player_class):
+		"""Classify `deck`, a map of dbf_id (int) to count, in the next batch."""
+		if self._closing:
+			raise HTTPError(503, "Server is shutting down")
+		future = asyncio.get_event_loop().create_future()
+		await self._queue.put((int(player_class), deck, future))
+		return await future
+
+	async def _reload_loop(self):
+		loop = asyncio.get_event_loop()
+		while True:
+			await asyncio.sleep(self.reload_interval)
+			try:
+				if await loop.run_in_executor(None, self.load):
+					logger.info("Reloaded classifier %s (version %s)", self.path, self.version)
+			except Exception:
+				logger.exception("Could not reload %s, keeping the current classifier", self.path)
+
+	async def _batch_loop(self):
+		loop = asyncio.get_event_loop()
+		running = True
+		while running:
+			batch = [await self._queue.get()]
+			deadline = loop.time() + self.batch_delay
+			while len(batch) < self.max_batch_size and batch[-1] is not None:
+				timeout = deadline - loop.time()
+				try:
+					if timeout > 0:
+						batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+					else:
+						batch.append(self._queue.get_nowait())
+				except (asyncio.TimeoutError, asyncio.QueueEmpty):
+					break
+
+			if batch[-1] is None:
+				running = False
+				batch.pop()
+
+			by_class = {}
+			for player_class, deck, future in batch:
+				by_class.setdefault(player_class, []).append((deck, future))
+			for player_class, requests in by_class.items():
+				task = loop.create_task(self._run_batch(player_class, requests))
+				self._batches.add(task)
+				task.add_done_callback(self._batches.discard)
+
+	async def _run_batch(self, player_class, requests):
+		loop = asyncio.get_event_loop()
+		version, classifier, artifact = self._current
+		decks = [deck for deck, future in requests]
+		try:
+			if isinstance(self.executor, ProcessPoolExecutor):
+				start = time.perf_counter()
+				args = (self.path, version, decks, player_class)
+				try:
+					results = await loop.run_in_executor(
+						self.executor, _worker_classify_batch, *args
+					)
+				except StaleClassifierError:
+					results = await loop.run_in_executor(
+						self.executor, _worker_classify_batch, *(args + (artifact, ))
+					)
+				if self.metrics is not None:
+					latency = (time.perf_counter() - start) / len(decks)
+					for archetype_id in results:
+						self.metrics.observe(archetype_id, latency)
+			else:
+				results = await loop.run_in_executor(self.executor, functools.partial(
+					classifier.classify_batch, decks, player_class, metrics=self.metrics
+				))
+		except Exception as e:
+			logger.exception("Could not classify a batch of %i decks", len(decks))
+			for deck, future in requests:
+				if not future.done():
+					future.set_exception(e)
+			return
+
+		for (deck, future), archetype_id in zip(requests, results):
+			# The client may have gone away in the meantime
+			if not future.done():
+				future.set_result(archetype_id)
+
+	def _parse_classify_request(self, body):
+		try:
+			request = json.loads(body.decode("utf-8"))
+		except ValueError:
+			raise HTTPError(400, "Invalid JSON")
+		if not isinstance(request, dict):
+			raise HTTPError(400, "Expected a JSON object")
+
+		player_class = request.get("player_class")
+		try:
+			if isinstance(player_class, str):
+				player_class = CardClass[player_class.upper()]
+			else:
+				player_class = CardClass(player_class)
+		except (KeyError, ValueError):
+			raise HTTPError(400, "Unknown player class: %r" % (player_class, ))
+
+		if "deckstring" in request:
+			try:
+				deck = dict(self.decoder.decode(request["deckstring"]))
+			except (TypeError, ValueError, EOFError):
+				raise HTTPError(400, "Invalid deckstring")
+		else:
+			cards = request.get("cards")
+			if not isinstance(cards, dict):
+				raise HTTPError(400, "Expected either cards or a deckstring")
+			try:
+				deck = {int(dbf_id): int(count) for dbf_id, count in cards.items()}
+			except (TypeError, ValueError):
+				raise HTTPError(400, "Invalid cards")
+
+		return deck, player_class
+
+	async def _dispatch(self, method, target, body):
+		path = target.split("?", 1)[0]
+		if path == "/classify":
+			if method != "POST":
+				raise HTTPError(405, "Use POST")
+			deck, player_class = self._parse_classify_request(body)
+			archetype_id = await self.classify(deck, player_class)
+			return "application/json", {"archetype_id": archetype_id}
+		elif path == "/health" and method == "GET":
+			return "application/json", {
+				"status": "ok",
+				"version": self.version,
+				"game_format": self.classifier.game_format,
+			}
+		elif path == "/metrics" and method == "GET" and self.metrics is not None:
+			return "text/plain; version=0.0.4", self.metrics.to_prometheus()
+		raise HTTPError(404, "Not found")
+
+	async def _read_request(self, reader):
+		line = await reader.readline()
+		if not line:
+			return None
+		try:
+			method, target, http_version = line.decode("latin-1").split()
+		except ValueError:
+			raise HTTPError(400, "Malformed request line")
+
+		headers = {}
+		while True:
+			line = await reader.readline()
+			if line in (b"\r\n", b"\n", b""):
+				break
+			name, _, value = line.decode("latin-1").partition(":")
+			headers[name.strip().lower()] = value.strip()
+
+		try:
+			length = int(headers.get("content-length") or 0)
+		except ValueError:
+			raise HTTPError(400, "Invalid Content-Length")
+		if length > MAX_BODY_SIZE:
+			raise HTTPError(413, "Request body too large")
+		body = await reader.readexactly(length) if length else b""
+
+		connection = headers.get("connection", "").lower()
+		if http_version == "HTTP/1.1":
+			keep_alive = connection != "close"
+		else:
+			keep_alive = connection == "keep-alive"
+		return method, target, body, keep_alive
+
+	async def _handle_connection(self, reader, writer):
+		try:
+			keep_alive = True
+			while keep_alive:
+				try:
+					request = await self._read_request(reader)
+					if request is None:
+						break
+					method, target, body, keep_alive = request
+					content_type, payload = await self._dispatch(method, target, body)
+					status = 200
+				except HTTPError as e:
+					content_type, payload = "application/json", {"error": e.message}
+					status = e.status
+					keep_alive = False
+				except Exception:
+					logger.exception("Could not handle a request")
+					content_type, payload = "application/json", {"error": "Internal error"}
+					status = 500
+					keep_alive = False
+				_write_response(writer, status, content_type, payload, keep_alive)
+				await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+
+def _write_response(writer, status, content_type, payload, keep_alive):
+	if isinstance(payload, str):
+		body = payload.encode("utf-8")
+	else:
+		body = json.dumps(payload).encode("utf-8")
+	head = (
+		"HTTP/1.1 %i %s\r\n"
+		"Content-Type: %s\r\n"
+		"Content-Length: %i\r\n"
+		"Connection: %s\r\n\r\n"
+	) % (
+		status, HTTP_REASONS[status], content_type, len(body),
+		"keep-alive" if keep_alive else "close"
+	)
+	writer.write(head.encode("latin-1") + body)
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("path", help="Classifier artifact written by write_classifier")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--unix-socket", help="Listen on this Unix socket instead")
+	parser.add_argument(
+		"--processes", type=int, default=0,
+		help="Score in a pool of this many processes instead of threads"
+	)
+	parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+	parser.add_argument("--batch-delay", type=float, default=BATCH_DELAY)
+	parser.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL)
+	parser.add_argument("--metrics", action="store_true", help="Serve /metrics")
+	args = parser.parse_args(args)
+
+	logging.basicConfig(level=logging.INFO)
+	executor = ProcessPoolExecutor(max_workers=args.processes) if args.processes else None
+	metrics = None
+	if args.metrics:
+		from .metrics import ClassificationMetrics
+		metrics = ClassificationMetrics()
+
+	server = ClassificationServer(
+		args.path,
+		executor=executor,
+		metrics=metrics,
+		max_batch_size=args.max_batch_size,
+		batch_delay=args.batch_delay,
+		reload_interval=args.reload_interval,
+	)
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(server.start(args.host, args.port, unix_path=args.unix_socket))
+	logger.info("Serving %s on %s", args.path, server.address)
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		loop.run_until_complete(server.stop())
+		if executor is not None:
+			executor.shutdown()
+		loop.close()
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,6 +1,6 @@
 import logging
+import time
 from collections import Counter
-from copy import copy
 
 from hearthstone.enums import CardSet
 
@@ -15,6 +15,9 @@ CCP_INPUT_CUTOFF = .3
 CCP_THRESHOLD = .1
 PCP_EVERGREEN_THRESHOLD = .6
 PCP_THRESHOLD = .7
+DECAY_HALF_LIFE = 3 * 24 * 3600
+# Rebase decayed counters before their scale factor grows past 2 ** 64
+DECAY_MAX_EXPONENT = 64
 
 
 default_thresholds = {
@@ -27,32 +30,57 @@ logger = logging.getLogger("hsarchetypes")
 db = card_db()
 
 
+def calculate_cluster_prevalence_counts(cluster_data):
+	"""
+	Count the observations of every card, and of all decks, in each cluster.
+
+	Returns: a map of cluster_id to (prevalence_counts, deck_occurrences)
+	"""
+	result = {}
+	for cluster_id, cluster_decks in cluster_data:
+		prevalence_counts = {}
+		deck_occurrences = 0
+		for deck in cluster_decks:
+			obs_count = deck["observations"]
+			deck_occurrences += obs_count
+			for dbf_id, count in deck["cards"].items():
+				if dbf_id not in prevalence_counts:
+					prevalence_counts[dbf_id] = 0
+				prevalence_counts[dbf_id] += obs_count
+		result[cluster_id] = (prevalence_counts, deck_occurrences)
+	return result
+
+
 def calculate_player_class_prevalence(cluster_data):
-		card_counter = Counter()
-		deck_occurrences = 0.0
-		for cluster_id, cluster_decks in cluster_data:
-			for deck in cluster_decks:
-				obs_count = deck["observations"]
-				deck_occurrences += obs_count
-				for dbf_id, count in deck["cards"].items():
-					card_counter[dbf_id] += obs_count
-
-		result = {}
-		logger.info("\nCalculating PCP Values")
-		for dbf_id in card_counter:
-			pcp_val = card_counter[dbf_id] / deck_occurrences
-			if db[int(dbf_id)].card_set in (CardSet.CORE, CardSet.EXPERT1):
-				# Evergreen card
-				if pcp_val >= PCP_EVERGREEN_THRESHOLD:
-					result[str(dbf_id)] = pcp_val
-			else:
-				if pcp_val >= PCP_THRESHOLD:
-					result[str(dbf_id)] = pcp_val
+	return calculate_player_class_prevalence_from_counts(
+		calculate_cluster_prevalence_counts(cluster_data)
+	)
+
+
+def calculate_player_class_prevalence_from_counts(cluster_counts):
+	card_counter = Counter()
+	deck_occurrences = 0.0
+	for prevalence_counts, cluster_occurrences in cluster_counts.values():
+		deck_occurrences += cluster_occurrences
+		card_counter.update(prevalence_counts)
 
+	result = {}
+	logger.info("\nCalculating PCP Values")
+	for dbf_id in card_counter:
+		pcp_val = card_counter[dbf_id] / deck_occurrences
+		if db[int(dbf_id)].card_set in (CardSet.CORE, CardSet.EXPERT1):
+			# Evergreen card
+			if pcp_val >= PCP_EVERGREEN_THRESHOLD:
+				result[str(dbf_id)] = pcp_val
+		else:
+			if pcp_val >= PCP_THRESHOLD:
+				result[str(dbf_id)] = pcp_val
+
+	if logger.isEnabledFor(logging.INFO):
 		for dbf_id, pcp_val in sorted(result.items(), key=lambda t: t[1], reverse=True):
-			logger.info("\t%s: %s" % (db[int(dbf_id)].name, str(pcp_val)))
+			logger.info("\t%s: %s", db[int(dbf_id)].name, pcp_val)
 
-		return result
+	return result
 
 
 def calculate_signature_weights(
@@ -60,41 +88,297 @@ def calculate_signature_weights(
 	thresholds=default_thresholds,
 	use_ccp=True,
 	use_thresholds=True,
-	use_pcp_adjustment=True
+	use_pcp_adjustment=True,
+	pcp_weights=None,
+	cluster_counts=None
 ):
-
-	if not use_ccp and use_pcp_adjustment:
-		pcp_weights = calculate_player_class_prevalence(cluster_data)
-	else:
-		pcp_weights = {}
+	"""
+	Calculate the signature of every cluster in `cluster_data`, an iterable of
+	(cluster_id, decks) pairs.
+
+	Callers that already made a pass over the decks can pass its results instead:
+	`cluster_counts` as returned by `calculate_cluster_prevalence_counts` (in which
+	case `cluster_data` is not used) and `pcp_weights` as returned by
+	`calculate_player_class_prevalence_from_counts`.
+	"""
+
+	if cluster_counts is None:
+		cluster_counts = calculate_cluster_prevalence_counts(cluster_data)
+
+	if pcp_weights is None:
+		if not use_ccp and use_pcp_adjustment:
+			pcp_weights = calculate_player_class_prevalence_from_counts(cluster_counts)
+		else:
+			pcp_weights = {}
 
 	# For each archetype generate new signatures.
 	raw_new_weights = {}
-	for cluster_id, cluster_decks in cluster_data:
-		raw_new_weights[cluster_id] = calculate_signature_weights_for_cluster(
-			cluster_decks,
-			thresholds=thresholds,
-			use_thresholds=use_thresholds,
-			pcp_weights=pcp_weights
+	for cluster_id, (prevalence_counts, deck_occurrences) in cluster_counts.items():
+		if not deck_occurrences:
+			# Could not find any matching deck
+			raw_new_weights[cluster_id] = []
+			continue
+
+		raw_new_weights[cluster_id] = calculate_prevalences(
+			prevalence_counts, deck_occurrences, thresholds, use_thresholds, pcp_weights
 		)
 
 	if use_ccp:
 		ccp_input_weights = generate_ccp_input_weights(raw_new_weights)
-		final_new_weights = {}
 
 		# Then apply the cross-cluster-prevalence scaling
-		for cluster_id, weights in ccp_input_weights.items():
-			weights_copy = copy(ccp_input_weights)
-			del weights_copy[cluster_id]
-			final_new_weights[cluster_id] = apply_cross_cluster_prevalence(
-				weights,
-				weights_copy
-			)
-		return final_new_weights
+		return calculate_cross_cluster_prevalence(ccp_input_weights)
 	else:
 		return raw_new_weights
 
 
+class SignatureAccumulator:
+	"""
+	Accumulate a stream of (cluster_id, cards, observations) records, e.g. from a
+	database cursor, and calculate signatures from it.
+
+	Only the observation count of every card and the total observations are kept
+	per cluster (and for the class as a whole, for the PCP adjustment), so memory
+	doesn't grow with the number of decks. The options have the same meaning as for
+	`calculate_signature_weights`.
+
+	Accumulators over separate shards of the decks can be combined with `merge`, in
+	any order, and shipped between processes or machines with `to_dict` and
+	`from_dict`.
+	"""
+
+	def __init__(
+		self,
+		thresholds=default_thresholds,
+		use_thresholds=True,
+		use_pcp_adjustment=True
+	):
+		self.thresholds = thresholds
+		self.use_thresholds = use_thresholds
+		self.use_pcp_adjustment = use_pcp_adjustment
+		self.cluster_counts = {}
+		self.class_counts = [{}, 0]
+
+	def add(self, cluster_id, cards, observations):
+		"""Add a deck, given as an iterable of dbf_ids (such as a map of dbf_id to count)."""
+		if cluster_id not in self.cluster_counts:
+			self.cluster_counts[cluster_id] = [{}, 0]
+		cluster_counts = self.cluster_counts[cluster_id][0]
+		class_counts = self.class_counts[0]
+		for dbf_id in cards:
+			if dbf_id not in cluster_counts:
+				cluster_counts[dbf_id] = 0
+			cluster_counts[dbf_id] += observations
+			if dbf_id not in class_counts:
+				class_counts[dbf_id] = 0
+			class_counts[dbf_id] += observations
+		self.cluster_counts[cluster_id][1] += observations
+		self.class_counts[1] += observations
+
+	def merge(self, other):
+		"""Add the counts of another accumulator (e.g. of another shard) to this one."""
+		options = (self.thresholds, self.use_thresholds, self.use_pcp_adjustment)
+		if options != (other.thresholds, other.use_thresholds, other.use_pcp_adjustment):
+			raise ValueError("Cannot merge accumulators with different options")
+
+		self._merge(other)
+		return self
+
+	def _merge(self, other, factor=1):
+		for cluster_id, (prevalence_counts, deck_occurrences) in other.cluster_counts.items():
+			if cluster_id not in self.cluster_counts:
+				self.cluster_counts[cluster_id] = [{}, 0]
+			self._merge_counts(
+				self.cluster_counts[cluster_id], prevalence_counts, deck_occurrences, factor
+			)
+		self._merge_counts(self.class_counts, *other.class_counts, factor)
+
+	@staticmethod
+	def _merge_counts(entry, prevalence_counts, deck_occurrences, factor=1):
+		counts = entry[0]
+		for dbf_id, count in prevalence_counts.items():
+			if dbf_id not in counts:
+				counts[dbf_id] = 0
+			counts[dbf_id] += count * factor
+		entry[1] += deck_occurrences * factor
+
+	def to_dict(self):
+		"""Return the state of the accumulator as JSON serializable data."""
+		return {
+			"thresholds": [[k, v] for k, v in self.thresholds.items()],
+			"use_thresholds": self.use_thresholds,
+			"use_pcp_adjustment": self.use_pcp_adjustment,
+			"clusters": [
+				[cluster_id, list(prevalence_counts.items()), deck_occurrences]
+				for cluster_id, (prevalence_counts, deck_occurrences) in self.cluster_counts.items()
+			],
+			"class_counts": [list(self.class_counts[0].items()), self.class_counts[1]],
+		}
+
+	@classmethod
+	def from_dict(cls, data):
+		self = cls(
+			thresholds={k: v for k, v in data["thresholds"]},
+			use_thresholds=data["use_thresholds"],
+			use_pcp_adjustment=data["use_pcp_adjustment"],
+		)
+		for cluster_id, prevalence_counts, deck_occurrences in data["clusters"]:
+			self.cluster_counts[cluster_id] = [
+				{dbf_id: count for dbf_id, count in prevalence_counts}, deck_occurrences
+			]
+		class_counts, deck_occurrences = data["class_counts"]
+		self.class_counts = [{dbf_id: count for dbf_id, count in class_counts}, deck_occurrences]
+		return self
+
+	def update(self, records):
+		for cluster_id, cards, observations in records:
+			self.add(cluster_id, cards, observations)
+		return self
+
+	def _get_cluster_counts(self, cluster_ids=None):
+		if cluster_ids is None:
+			return self.cluster_counts
+		return {
+			cluster_id: self.cluster_counts[cluster_id]
+			for cluster_id in cluster_ids if cluster_id in self.cluster_counts
+		}
+
+	def signature_weights(self, cluster_ids=None):
+		"""
+		Return the signatures of all clusters, or of only those in `cluster_ids`.
+		The PCP adjustment always uses the prevalence across the whole class.
+		"""
+		if self.use_pcp_adjustment:
+			pcp_weights = calculate_player_class_prevalence_from_counts(
+				{None: self.class_counts}
+			)
+		else:
+			pcp_weights = {}
+
+		return calculate_signature_weights(
+			None,
+			thresholds=self.thresholds,
+			use_ccp=False,
+			use_thresholds=self.use_thresholds,
+			pcp_weights=pcp_weights,
+			cluster_counts=self._get_cluster_counts(cluster_ids)
+		)
+
+	def ccp_signature_weights(self, cluster_ids=None):
+		"""Return the CCP signatures across all clusters, or across those in `cluster_ids`."""
+		return calculate_signature_weights(
+			None,
+			thresholds=self.thresholds,
+			use_ccp=True,
+			use_thresholds=self.use_thresholds,
+			use_pcp_adjustment=self.use_pcp_adjustment,
+			cluster_counts=self._get_cluster_counts(cluster_ids)
+		)
+
+
+class DecayedSignatureAccumulator(SignatureAccumulator):
+	"""
+	A SignatureAccumulator whose counts decay exponentially with the age of the
+	records, halving every `half_life` seconds, so that the signatures follow the
+	meta as classified games are folded in.
+
+	Rather than decaying every counter on each update, new records are weighted by
+	2 ** ((timestamp - reference_time) / half_life). Signatures only depend on
+	ratios of counts, which a common factor doesn't change; the counters are rebased
+	onto a later reference time before that factor grows too large.
+	"""
+
+	def __init__(self, *args, half_life=DECAY_HALF_LIFE, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.half_life = half_life
+		self.reference_time = None
+
+	def add(self, cluster_id, cards, observations, timestamp=None):
+		if timestamp is None:
+			timestamp = time.time()
+		if self.reference_time is None:
+			self.reference_time = timestamp
+
+		exponent = (timestamp - self.reference_time) / self.half_life
+		if exponent > DECAY_MAX_EXPONENT:
+			self.rebase(timestamp)
+			exponent = 0
+		super().add(cluster_id, cards, observations * 2 ** exponent)
+
+	def update(self, records):
+		"""Add (cluster_id, cards, observations, timestamp) records."""
+		for cluster_id, cards, observations, timestamp in records:
+			self.add(cluster_id, cards, observations, timestamp)
+		return self
+
+	def rebase(self, reference_time):
+		"""Rescale all counters relative to `reference_time`."""
+		if self.reference_time is not None:
+			factor = 2 ** ((self.reference_time - reference_time) / self.half_life)
+			for entry in list(self.cluster_counts.values()) + [self.class_counts]:
+				counts = entry[0]
+				for dbf_id in counts:
+					counts[dbf_id] *= factor
+				entry[1] *= factor
+		self.reference_time = reference_time
+
+	def observations(self, cluster_id=None, at=None):
+		"""
+		Return the decayed observations of a cluster (or of the whole class) as of
+		`at` (default: now).
+		"""
+		if at is None:
+			at = time.time()
+		if cluster_id is None:
+			deck_occurrences = self.class_counts[1]
+		else:
+			deck_occurrences = self.cluster_counts[cluster_id][1]
+		if self.reference_time is None:
+			return deck_occurrences
+		return deck_occurrences * 2 ** ((self.reference_time - at) / self.half_life)
+
+	def prune(self, min_prevalence):
+		"""
+		Forget cards whose prevalence in a cluster, or in the whole class, has decayed
+		below `min_prevalence`.
+		"""
+		for prevalence_counts, deck_occurrences in (
+			list(self.cluster_counts.values()) + [self.class_counts]
+		):
+			for dbf_id in [
+				dbf_id for dbf_id, count in prevalence_counts.items()
+				if count < min_prevalence * deck_occurrences
+			]:
+				del prevalence_counts[dbf_id]
+
+	def merge(self, other):
+		if self.half_life != other.half_life:
+			raise ValueError("Cannot merge accumulators with different half lives")
+		if self.reference_time is None:
+			self.reference_time = other.reference_time
+		elif other.reference_time is not None and other.reference_time > self.reference_time:
+			self.rebase(other.reference_time)
+		return super().merge(other)
+
+	def _merge(self, other, factor=1):
+		if other.reference_time is not None:
+			factor = 2 ** ((other.reference_time - self.reference_time) / self.half_life)
+		super()._merge(other, factor)
+
+	def to_dict(self):
+		result = super().to_dict()
+		result["half_life"] = self.half_life
+		result["reference_time"] = self.reference_time
+		return result
+
+	@classmethod
+	def from_dict(cls, data):
+		self = super().from_dict(data)
+		self.half_life = data["half_life"]
+		self.reference_time = data["reference_time"]
+		return self
+
+
 def generate_ccp_input_weights(input_weights, cutoff=CCP_INPUT_CUTOFF):
 	result = {}
 	for cluster_id, weights in input_weights.items():
@@ -155,6 +439,39 @@ def calculate_prevalences(
 	return ret
 
 
+def calculate_cross_cluster_prevalence(weights_by_cluster):
+	"""
+	Apply the cross cluster prevalence scaling to the weights of every cluster.
+
+	This is equivalent to calling `apply_cross_cluster_prevalence` for every cluster
+	against all the others, but counts the clusters each card is prevalent in once,
+	and then only subtracts the cluster's own contribution.
+	"""
+	prevalent_cluster_counts = Counter()
+	for weights in weights_by_cluster.values():
+		for dbf_id, weight in weights.items():
+			if weight > CCP_THRESHOLD:
+				prevalent_cluster_counts[dbf_id] += 1
+
+	num_other_archetypes = len(weights_by_cluster) - 1
+	result = {}
+	for cluster_id, weights in weights_by_cluster.items():
+		ret = {}
+		for dbf_id, weight in weights.items():
+			count_in_other_archetypes = prevalent_cluster_counts[dbf_id]
+			if weight > CCP_THRESHOLD:
+				count_in_other_archetypes -= 1
+
+			cluster_freq_modifier = _calc_cross_cluster_modifier(
+				count_in_other_archetypes,
+				num_other_archetypes
+			)
+			ret[dbf_id] = weight * cluster_freq_modifier
+		result[cluster_id] = ret
+
+	return result
+
+
 def apply_cross_cluster_prevalence(weights, all_other_weights):
 	ret = {}
 
@@ -183,3 +500,172 @@ def _calc_cross_cluster_modifier(count_in_other_archetypes, num_other_archetypes
 	p = (1 - count_in_other_archetypes / num_other_archetypes)
 	cluster_freq_modifier = p * p
 	return cluster_freq_modifier
+
+
+def to_presence_matrix(decks, dbf_ids=None):
+	"""
+	Build a sparse deck x card presence matrix and an observations vector for `decks`.
+
+	Columns follow `dbf_ids` if given (cards outside of it are ignored), otherwise
+	the order in which the cards are first seen.
+
+	Returns: presence, observations, dbf_ids
+	"""
+	import numpy as np
+	from scipy import sparse
+
+	if dbf_ids is None:
+		column_index = {}
+	else:
+		column_index = {dbf_id: i for i, dbf_id in enumerate(dbf_ids)}
+	extend = dbf_ids is None
+
+	indptr = [0]
+	indices = []
+	observations = []
+	for deck in decks:
+		for dbf_id in deck["cards"]:
+			column = column_index.get(dbf_id)
+			if column is None:
+				if not extend:
+					continue
+				column = column_index[dbf_id] = len(column_index)
+			indices.append(column)
+		indptr.append(len(indices))
+		observations.append(deck["observations"])
+
+	presence = sparse.csr_matrix(
+		(np.ones(len(indices)), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+		shape=(len(observations), len(column_index))
+	)
+	return presence, np.array(observations, dtype=float), list(column_index)
+
+
+def to_signature_matrix(cluster_data):
+	"""
+	Build the inputs of `calculate_signature_weights_matrix` from (cluster_id, decks)
+	pairs, as passed to `calculate_signature_weights`.
+
+	Returns: presence, observations, labels, dbf_ids, cluster_ids
+	"""
+	import numpy as np
+
+	cluster_ids = []
+	labels = []
+	decks = []
+	for label, (cluster_id, cluster_decks) in enumerate(cluster_data):
+		cluster_ids.append(cluster_id)
+		for deck in cluster_decks:
+			decks.append(deck)
+			labels.append(label)
+
+	presence, observations, dbf_ids = to_presence_matrix(decks)
+	return presence, observations, np.array(labels, dtype=np.int64), dbf_ids, cluster_ids
+
+
+def calculate_signature_weights_matrix(
+	presence,
+	observations,
+	labels,
+	dbf_ids,
+	cluster_ids,
+	thresholds=default_thresholds,
+	use_ccp=True,
+	use_thresholds=True,
+	use_pcp_adjustment=True,
+	pcp_weights=None
+):
+	"""
+	Matrix equivalent of `calculate_signature_weights`.
+
+	:param presence: a sparse deck x card matrix, nonzero where the deck has the card
+	:param observations: the observations of each deck
+	:param labels: the index into `cluster_ids` of each deck; decks with a negative
+		label are left out
+	:param dbf_ids: the card of each column
+	:param cluster_ids: the cluster of each label
+	:return: a map of cluster_id to signature weights, as `calculate_signature_weights`
+	"""
+	import numpy as np
+	from scipy import sparse
+
+	presence = sparse.csr_matrix(presence)
+	presence = (presence != 0).astype(float)
+	observations = np.asarray(observations, dtype=float)
+	labels = np.asarray(labels)
+
+	rows = np.flatnonzero(labels >= 0)
+	membership = sparse.csr_matrix(
+		(np.ones(len(rows)), (labels[rows], rows)),
+		shape=(len(cluster_ids), presence.shape[0])
+	)
+
+	# Observations of every card (and whether it is present at all) per cluster
+	card_counts = np.asarray((membership @ sparse.diags(observations) @ presence).todense())
+	present = np.asarray((membership @ presence).todense()) > 0
+	deck_occurrences = membership @ observations
+
+	if pcp_weights is None:
+		if not use_ccp and use_pcp_adjustment:
+			pcp_modifiers = _player_class_prevalence_modifiers(card_counts, deck_occurrences, dbf_ids)
+		else:
+			pcp_modifiers = np.ones(len(dbf_ids))
+	else:
+		pcp_modifiers = np.array([
+			1 - pcp_weights[dbf_id] ** 3 if dbf_id in pcp_weights else 1.0
+			for dbf_id in dbf_ids
+		])
+
+	has_decks = deck_occurrences != 0
+	prevalences = np.zeros_like(card_counts)
+	prevalences[has_decks] = card_counts[has_decks] / deck_occurrences[has_decks, None]
+
+	if use_thresholds:
+		weights = np.zeros_like(prevalences)
+		included = np.zeros_like(present)
+		for threshold in sorted(thresholds.keys(), reverse=True):
+			matches = present & ~included & (prevalences >= threshold)
+			weights[matches] = float(thresholds[threshold]) * prevalences[matches]
+			included |= matches
+	else:
+		weights = prevalences
+		included = present
+	weights = weights * pcp_modifiers
+
+	if use_ccp:
+		included = included & (weights >= CCP_INPUT_CUTOFF)
+		num_other_archetypes = int(has_decks.sum()) - 1
+		if num_other_archetypes > 0:
+			above_threshold = included & (weights > CCP_THRESHOLD)
+			count_in_other_archetypes = above_threshold.sum(axis=0) - above_threshold
+			p = 1 - count_in_other_archetypes / num_other_archetypes
+			weights = weights * (p * p)
+
+	result = {}
+	for label, cluster_id in enumerate(cluster_ids):
+		if not has_decks[label]:
+			if not use_ccp:
+				result[cluster_id] = []
+			continue
+		columns = np.flatnonzero(included[label])
+		result[cluster_id] = {
+			dbf_ids[column]: float(weights[label, column]) for column in columns
+		}
+
+	return result
+
+
+def _player_class_prevalence_modifiers(card_counts, deck_occurrences, dbf_ids):
+	import numpy as np
+
+	total_occurrences = float(deck_occurrences.sum())
+	if not total_occurrences:
+		return np.ones(len(dbf_ids))
+
+	pcp_values = card_counts.sum(axis=0) / total_occurrences
+	evergreen = np.array([
+		db[int(dbf_id)].card_set in (CardSet.CORE, CardSet.EXPERT1) for dbf_id in dbf_ids
+	], dtype=bool)
+	pcp_thresholds = np.where(evergreen, PCP_EVERGREEN_THRESHOLD, PCP_THRESHOLD)
+
+	return np.where(pcp_values >= pcp_thresholds, 1 - pcp_values ** 3, 1.0)
@@ -0,0 +1,411 @@
+"""
+A compact binary format for cluster sets, opened with mmap.
+
+The file starts with MAGIC, the length of the header as a little-endian uint64 and a
+JSON header holding the metadata of the cluster set, its class clusters and its
+clusters. The header is followed by the arrays it lists, each aligned to
+ALIGNMENT bytes from the start of the data section:
+
+- signature_offsets, signature_dbf_ids, signature_weights: the signatures of all
+	clusters as a CSR matrix, one row per cluster (ccp_signature_* likewise)
+- data_point_offsets: the range of data points of every cluster
+- card_offsets, card_dbf_ids, card_counts: the cards of all data points as a CSR
+	matrix, one row per data point
+- observations, x, y: one value per data point, NaN where a coordinate is missing
+- layouts: an index per data point into the header's "layouts", the few distinct
+	key orders of the data points, which also tell which of their numbers were ints
+- key_<i>_codes, key_<i>_offsets, key_<i>_values: the values of the i-th of the
+	header's "data_point_keys", the other keys of the data points (such as shortids
+	and cluster labels). Each data point has an index into a table of the distinct
+	values of the key, stored as JSON in a utf-8 blob; -1 where it lacks the key
+
+The header only holds cluster-level metadata, so opening a file doesn't read
+anything proportional to the number of data points.
+
+The data of a cluster set is exchanged in the form produced by `ClusterSet.to_json`,
+see ClusterSet.write_binary and ClusterSet.load_binary. `MappedDataPoints` decodes
+the data points of a single cluster from the mapped arrays on demand.
+"""
+import json
+import mmap
+import struct
+from collections.abc import Sequence
+
+
+MAGIC = b"HSACSET1"
+ALIGNMENT = 8
+
+_COLUMNS = ("cards", "observations", "x", "y")
+
+
+def _column_type(value):
+	# Numeric columns are stored as floats when any value is one
+	if isinstance(value, int) and not isinstance(value, bool):
+		return "int"
+	return None
+
+
+class _ValueTable:
+	def __init__(self, num_data_points):
+		self.codes = [-1] * num_data_points
+		self.offsets = [0]
+		self.values = bytearray()
+		self._indices = {}
+
+	def append(self, value):
+		encoded = json.dumps(value).encode("utf-8")
+		index = self._indices.get(encoded)
+		if index is None:
+			index = self._indices[encoded] = len(self.offsets) - 1
+			self.values += encoded
+			self.offsets.append(len(self.values))
+		self.codes.append(index)
+
+
+def _parse_dbf_id(key):
+	dbf_id = int(key)
+	if str(dbf_id) != key:
+		raise ValueError("Cannot store non-canonical dbf id key: %r" % (key, ))
+	return dbf_id
+
+
+class _SparseRows:
+	def __init__(self):
+		self.offsets = [0]
+		self.dbf_ids = []
+		self.values = []
+
+	def append(self, mapping):
+		for key, value in mapping.items():
+			self.dbf_ids.append(_parse_dbf_id(key))
+			self.values.append(value)
+		self.offsets.append(len(self.dbf_ids))
+
+
+def _signature_type(signature):
+	if signature is None:
+		return None
+	if isinstance(signature, dict):
+		return "dict"
+	if signature:
+		raise ValueError("Cannot store signature: %r" % (signature, ))
+	return "list"
+
+
+def write_cluster_set(data, path):
+	"""Write `data`, a cluster set in the form of `ClusterSet.to_json`, to `path`."""
+	import numpy as np
+
+	signatures = _SparseRows()
+	ccp_signatures = _SparseRows()
+	cards = _SparseRows()
+	data_point_offsets = [0]
+	observations = []
+	xs = []
+	ys = []
+	layouts = []
+	layout_indices = {}
+	data_point_layouts = []
+	value_tables = {}
+
+	class_clusters = []
+	for class_cluster in data["class_clusters"]:
+		clusters = []
+		for cluster in class_cluster["clusters"]:
+			clusters.append({
+				"cluster_id": cluster["cluster_id"],
+				"name": cluster["name"],
+				"external_id": cluster["external_id"],
+				"required_cards": cluster["required_cards"],
+				"rules": cluster["rules"],
+				"signature": _signature_type(cluster["signature"]),
+				"ccp_signature": _signature_type(cluster["ccp_signature"]),
+			})
+			signatures.append(cluster["signature"] or {})
+			ccp_signatures.append(cluster["ccp_signature"] or {})
+
+			for data_point in cluster.get("data_points") or []:
+				cards.append(data_point["cards"])
+				observations.append(data_point["observations"])
+				xs.append(data_point.get("x"))
+				ys.append(data_point.get("y"))
+				layout = tuple(
+					(k, _column_type(v) if k in _COLUMNS else None) for k, v in data_point.items()
+				)
+				if layout not in layout_indices:
+					layout_indices[layout] = len(layouts)
+					layouts.append([list(t) for t in layout])
+				data_point_layouts.append(layout_indices[layout])
+				for key in data_point:
+					if key not in _COLUMNS and key not in value_tables:
+						value_tables[key] = _ValueTable(len(data_point_layouts) - 1)
+				for key, table in value_tables.items():
+					if key in data_point:
+						table.append(data_point[key])
+					else:
+						table.codes.append(-1)
+			data_point_offsets.append(len(observations))
+		class_clusters.append({
+			"player_class": class_cluster["player_class"],
+			"clusters": clusters,
+		})
+
+	if all(isinstance(o, int) for o in observations):
+		observations_dtype = "<i8"
+	else:
+		observations_dtype = "<f8"
+
+	def coordinates(values):
+		return np.array(
+			[float("nan") if v is None else v for v in values], dtype="<f8"
+		)
+
+	arrays = [
+		("signature_offsets", np.array(signatures.offsets, dtype="<i8")),
+		("signature_dbf_ids", np.array(signatures.dbf_ids, dtype="<i4")),
+		("signature_weights", np.array(signatures.values, dtype="<f8")),
+		("ccp_signature_offsets", np.array(ccp_signatures.offsets, dtype="<i8")),
+		("ccp_signature_dbf_ids", np.array(ccp_signatures.dbf_ids, dtype="<i4")),
+		("ccp_signature_weights", np.array(ccp_signatures.values, dtype="<f8")),
+		("data_point_offsets", np.array(data_point_offsets, dtype="<i8")),
+		("card_offsets", np.array(cards.offsets, dtype="<i8")),
+		("card_dbf_ids", np.array(cards.dbf_ids, dtype="<i4")),
+		("card_counts", np.array(cards.values, dtype="<i4")),
+		("observations", np.array(observations, dtype=observations_dtype)),
+		("x", coordinates(xs)),
+		("y", coordinates(ys)),
+		("layouts", np.array(data_point_layouts, dtype="<i4")),
+	]
+	for i, table in enumerate(value_tables.values()):
+		arrays += [
+			("key_%i_codes" % (i), np.array(table.codes, dtype="<i4")),
+			("key_%i_offsets" % (i), np.array(table.offsets, dtype="<i8")),
+			("key_%i_values" % (i), np.frombuffer(bytes(table.values), dtype="u1")),
+		]
+
+	array_headers = {}
+	offset = 0
+	for name, array in arrays:
+		array_headers[name] = {
+			"dtype": array.dtype.str,
+			"length": len(array),
+			"offset": offset,
+		}
+		offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+	header = json.dumps({
+		"as_of": data["as_of"],
+		"game_format": data["game_format"],
+		"live_in_production": data["live_in_production"],
+		"latest": data["latest"],
+		"class_clusters": class_clusters,
+		"layouts": layouts,
+		"data_point_keys": list(value_tables),
+		"arrays": array_headers,
+	}).encode("utf-8")
+
+	prefix_length = len(MAGIC) + 8 + len(header)
+	with open(path, "wb") as f:
+		f.write(MAGIC)
+		f.write(struct.pack("<Q", len(header)))
+		f.write(header)
+		f.write(b"\0" * (-prefix_length % ALIGNMENT))
+		for name, array in arrays:
+			f.write(array.tobytes())
+			f.write(b"\0" * (-array.nbytes % ALIGNMENT))
+
+
+class ClusterSetFile:
+	"""
+	A cluster set file written by `write_cluster_set`, memory-mapped read-only.
+
+	`array(name)` returns a view of one of the arrays backed by the page cache, which
+	processes opening the same file share. Pages are only read once accessed, so
+	reading the signatures does not touch the data points. Views must be released
+	before the file is closed.
+	"""
+
+	def __init__(self, path):
+		with open(path, "rb") as f:
+			self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if self._mmap[:len(MAGIC)] != MAGIC:
+			self._mmap.close()
+			raise ValueError("%r is not a cluster set file" % (path, ))
+		header_start = len(MAGIC) + 8
+		header_length, = struct.unpack("<Q", self._mmap[len(MAGIC):header_start])
+		self.header = json.loads(
+			self._mmap[header_start:header_start + header_length].decode("utf-8")
+		)
+		prefix_length = header_start + header_length
+		self._data_start = prefix_length + (-prefix_length % ALIGNMENT)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def close(self):
+		self._mmap.close()
+
+	def array(self, name):
+		import numpy as np
+
+		info = self.header["arrays"][name]
+		return np.frombuffer(
+			self._mmap,
+			dtype=info["dtype"],
+			count=info["length"],
+			offset=self._data_start + info["offset"]
+		)
+
+	def _signatures(self, prefix, types):
+		offsets = self.array(prefix + "_offsets").tolist()
+		dbf_ids = self.array(prefix + "_dbf_ids").tolist()
+		weights = self.array(prefix + "_weights").tolist()
+		result = []
+		for i, signature_type in enumerate(types):
+			if signature_type == "dict":
+				start, end = offsets[i], offsets[i + 1]
+				result.append({
+					str(dbf_id): weight
+					for dbf_id, weight in zip(dbf_ids[start:end], weights[start:end])
+				})
+			else:
+				result.append(None if signature_type is None else [])
+		return result
+
+	def _key_values(self, index, start, end):
+		"""Return the values of the index-th data point key for a range of data points."""
+		codes = self.array("key_%i_codes" % (index))[start:end].tolist()
+		offsets = self.array("key_%i_offsets" % (index))
+		blob = self.array("key_%i_values" % (index))
+		values = {}
+		result = []
+		for code in codes:
+			if code >= 0 and code not in values:
+				value_start, value_end = int(offsets[code]), int(offsets[code + 1])
+				values[code] = json.loads(blob[value_start:value_end].tobytes().decode("utf-8"))
+			result.append(values.get(code))
+		return result
+
+	def _iter_data_points(self, start, end):
+		card_offsets = self.array("card_offsets")[start:end + 1].tolist()
+		card_start, card_end = card_offsets[0], card_offsets[-1]
+		card_dbf_ids = self.array("card_dbf_ids")[card_start:card_end].tolist()
+		card_counts = self.array("card_counts")[card_start:card_end].tolist()
+		columns = {
+			"observations": self.array("observations")[start:end].tolist(),
+			"x": self.array("x")[start:end].tolist(),
+			"y": self.array("y")[start:end].tolist(),
+		}
+		for index, key in enumerate(self.header["data_point_keys"]):
+			columns[key] = self._key_values(index, start, end)
+		layouts = self.header["layouts"]
+		for i, layout_index in enumerate(self.array("layouts")[start:end].tolist()):
+			cards_start = card_offsets[i] - card_start
+			cards_end = card_offsets[i + 1] - card_start
+			data_point = {}
+			for key, column_type in layouts[layout_index]:
+				if key == "cards":
+					value = {
+						str(dbf_id): count for dbf_id, count in zip(
+							card_dbf_ids[cards_start:cards_end], card_counts[cards_start:cards_end]
+						)
+					}
+				elif key in _COLUMNS:
+					value = columns[key][i]
+					if value != value:
+						value = None
+					elif column_type == "int":
+						value = int(value)
+				else:
+					value = columns[key][i]
+				data_point[key] = value
+			yield data_point
+
+	def data_points(self):
+		"""Return the data points of every cluster, in file order, as MappedDataPoints."""
+		offsets = self.array("data_point_offsets").tolist()
+		return [MappedDataPoints(self, offsets[i], offsets[i + 1]) for i in range(len(offsets) - 1)]
+
+	def to_dict(self, data_points=True):
+		"""
+		Return the cluster set in the form of `ClusterSet.to_json`.
+
+		With data_points=False clusters have no "data_points" and the data point
+		arrays are not read at all.
+		"""
+		header = self.header
+		clusters = [c for cc in header["class_clusters"] for c in cc["clusters"]]
+		signatures = self._signatures("signature", [c["signature"] for c in clusters])
+		ccp_signatures = self._signatures(
+			"ccp_signature", [c["ccp_signature"] for c in clusters]
+		)
+		if data_points:
+			all_data_points = self._iter_data_points(0, len(self.array("layouts")))
+			data_point_offsets = self.array("data_point_offsets").tolist()
+
+		index = 0
+		class_clusters = []
+		for class_cluster in header["class_clusters"]:
+			result_clusters = []
+			for cluster in class_cluster["clusters"]:
+				result = dict(
+					cluster,
+					experimental=cluster["cluster_id"] == -1,
+					signature=signatures[index],
+					ccp_signature=ccp_signatures[index],
+				)
+				if data_points:
+					num_data_points = data_point_offsets[index + 1] - data_point_offsets[index]
+					result["data_points"] = [
+						next(all_data_points) for i in range(num_data_points)
+					]
+				result_clusters.append(result)
+				index += 1
+			class_clusters.append({
+				"player_class": class_cluster["player_class"],
+				"clusters": result_clusters,
+			})
+
+		return {
+			"as_of": header["as_of"],
+			"game_format": header["game_format"],
+			"live_in_production": header["live_in_production"],
+			"latest": header["latest"],
+			"class_clusters": class_clusters,
+		}
+
+
+class MappedDataPoints(Sequence):
+	"""
+	The data points of one cluster of a ClusterSetFile, which must stay open.
+
+	The data points are only decoded from the mapped arrays when first accessed, and
+	are kept from then on so that repeated access returns the same dicts.
+	"""
+
+	def __init__(self, cluster_set_file, start, end):
+		self.file = cluster_set_file
+		self.start = start
+		self.end = end
+		self._items = None
+
+	def __len__(self):
+		return self.end - self.start
+
+	def _decoded(self):
+		if self._items is None:
+			self._items = list(self.file._iter_data_points(self.start, self.end))
+		return self._items
+
+	def __getitem__(self, index):
+		return self._decoded()[index]
+
+	def __iter__(self):
+		return iter(self._decoded())
+
+	@property
+	def decoded(self):
+		return self._items is not None
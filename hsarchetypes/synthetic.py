@@ -0,0 +1,98 @@
+"""
+Generate synthetic, archetype-like clustering input from the local card database.
+
+Every archetype is a core of cards that nearly all of its decks play plus a pool
+of flex cards its decks are filled up from, so decks of one archetype share most
+of their cards. Observations follow a heavy-tailed (Pareto) distribution, as deck
+popularity does.
+"""
+import random
+
+from hearthstone.enums import CardClass, Rarity
+
+from .utils import card_db, dbf_id_vector
+
+
+PLAYER_CLASSES = [
+	CardClass.DRUID,
+	CardClass.HUNTER,
+	CardClass.MAGE,
+	CardClass.PALADIN,
+	CardClass.PRIEST,
+	CardClass.ROGUE,
+	CardClass.SHAMAN,
+	CardClass.WARLOCK,
+	CardClass.WARRIOR,
+]
+
+DECK_SIZE = 30
+CORE_SIZE = 10
+FLEX_POOL_SIZE = 20
+CORE_DROP_PROBABILITY = 0.05
+OBSERVATIONS_ALPHA = 1.2
+MAX_OBSERVATIONS = 10000
+
+
+def _max_copies(dbf_id):
+	return 1 if card_db()[dbf_id].rarity == Rarity.LEGENDARY else 2
+
+
+def generate_archetype(player_class, rng):
+	"""Return the (core, flex pool) dbf ids of a random archetype of `player_class`."""
+	candidates = dbf_id_vector(player_class=CardClass(player_class).name)
+	cards = rng.sample(candidates, CORE_SIZE + FLEX_POOL_SIZE)
+	return cards[:CORE_SIZE], cards[CORE_SIZE:]
+
+
+def generate_deck(archetype, rng):
+	"""Return a deck of the archetype, as a map of dbf_id (str) to count."""
+	core, flex = archetype
+	deck = {}
+	num_cards = 0
+	for dbf_id in core:
+		if rng.random() >= CORE_DROP_PROBABILITY:
+			deck[dbf_id] = _max_copies(dbf_id)
+			num_cards += deck[dbf_id]
+
+	for dbf_id in rng.sample(flex, len(flex)):
+		if num_cards >= DECK_SIZE:
+			break
+		count = min(rng.randint(1, _max_copies(dbf_id)), DECK_SIZE - num_cards)
+		deck[dbf_id] = count
+		num_cards += count
+
+	return {str(dbf_id): count for dbf_id, count in deck.items()}
+
+
+def generate_observations(rng):
+	return min(int(rng.paretovariate(OBSERVATIONS_ALPHA)), MAX_OBSERVATIONS)
+
+
+def generate_input_data(
+	num_classes=len(PLAYER_CLASSES),
+	clusters_per_class=5,
+	decks_per_cluster=50,
+	seed=None,
+):
+	"""
+	Return synthetic input for `create_cluster_set`: a map of player class name to
+	data points, `decks_per_cluster` for each of `clusters_per_class` archetypes.
+
+	Every data point has a "shortid" and the index of its archetype as "archetype".
+	Passing the same `seed` always generates the same data.
+	"""
+	rng = random.Random(seed)
+	result = {}
+	for player_class in PLAYER_CLASSES[:num_classes]:
+		data_points = []
+		for archetype_index in range(clusters_per_class):
+			archetype = generate_archetype(player_class, rng)
+			for i in range(decks_per_cluster):
+				data_points.append({
+					"cards": generate_deck(archetype, rng),
+					"observations": generate_observations(rng),
+					"shortid": "%s-%i-%i" % (player_class.name, archetype_index, i),
+					"archetype": archetype_index,
+				})
+		result[player_class.name] = data_points
+	return result
@@ -1,3 +1,7 @@
+import json
+import re
+from types import GeneratorType
+
 from hearthstone.cardxml import load_dbf
 from hearthstone.enums import CardClass
 
@@ -41,6 +45,100 @@ def to_prediction_vector_from_dbf_map(dbf_map):
 	return result
 
 
+def _json_key(key):
+	if isinstance(key, str):
+		return key
+	if key is True:
+		return "true"
+	if key is False:
+		return "false"
+	if key is None:
+		return "null"
+	if isinstance(key, int):
+		return int.__repr__(key)
+	return json.dumps(key)
+
+
+def iter_json(obj, indent=None, _level=0):
+	"""
+	Encode `obj` as JSON chunk by chunk, producing the same text as json.dumps(obj, indent=indent).
+
+	Generators are encoded as lists without being materialized, and dicts holding a
+	generator are written key by key; everything else is passed to json.dumps whole.
+	"""
+	lazy_dict = isinstance(obj, dict) and any(isinstance(v, GeneratorType) for v in obj.values())
+	if not lazy_dict and not isinstance(obj, GeneratorType):
+		chunk = json.dumps(obj, indent=indent)
+		if indent is not None and _level:
+			chunk = chunk.replace("\n", "\n" + _indent_str(indent) * _level)
+		yield chunk
+		return
+
+	if indent is None:
+		first_separator, separator, closing = "", ", ", ""
+	else:
+		first_separator = "\n" + _indent_str(indent) * (_level + 1)
+		separator = "," + first_separator
+		closing = "\n" + _indent_str(indent) * _level
+
+	yield "{" if lazy_dict else "["
+	empty = True
+	for item in (obj.items() if lazy_dict else obj):
+		yield first_separator if empty else separator
+		empty = False
+		if lazy_dict:
+			key, item = item
+			yield json.dumps(_json_key(key)) + ": "
+		yield from iter_json(item, indent, _level + 1)
+	if not empty:
+		yield closing
+	yield "}" if lazy_dict else "]"
+
+
+def _indent_str(indent):
+	return indent if isinstance(indent, str) else " " * indent
+
+
+_JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]]')
+
+
+def _json_array_end(text, pos):
+	end = text.find("]", pos)
+	segment = text[pos + 1:end]
+	# Without nested arrays or escapes, the first "]" outside a string closes the array
+	if end >= 0 and "[" not in segment and "\\" not in segment and not segment.count('"') % 2:
+		return end + 1
+	depth = 0
+	for token in _JSON_TOKEN.finditer(text, pos):
+		if token.group() == "[":
+			depth += 1
+		elif token.group() == "]":
+			depth -= 1
+			if not depth:
+				return token.end()
+	raise ValueError("Unterminated JSON array at %i" % (pos))
+
+
+def skip_json_arrays(text, key):
+	"""
+	Return `text`, a JSON document, with every array under `key` replaced by an empty
+	one. The arrays are skipped over rather than decoded, which is much faster than
+	decoding the whole document when they make up most of it.
+	"""
+	pattern = re.compile(re.escape(json.dumps(key)) + r"\s*:\s*(?=\[)")
+	parts = []
+	start = 0
+	while True:
+		match = pattern.search(text, start)
+		if match is None:
+			break
+		parts.append(text[start:match.end()])
+		parts.append("[]")
+		start = _json_array_end(text, match.end())
+	parts.append(text[start:])
+	return "".join(parts)
+
+
 def plot_loss_graph(history, player_class, output_path):
 	import matplotlib
 	matplotlib.use("Agg")
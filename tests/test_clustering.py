@@ -1,13 +1,20 @@
 import json
+import logging
 import os
+from operator import itemgetter
 
 import pytest
-from hearthstone.enums import CardClass
+from hearthstone.enums import CardClass, FormatType
 
 from hsarchetypes.clustering import (
-	ClassClusters, Cluster, ClusterSet, create_cluster_set, merge_clusters
+	ClassClusters, Cluster, ClusterSet, _init_worker, _process_class_clusters,
+	_to_feature_vectors, create_cluster_set, logger, match_cluster_pairs, merge_clusters
 )
-from hsarchetypes.utils import card_db
+from hsarchetypes.decks import DeckMatrix
+from hsarchetypes.features import mechanics, wild_mechanics
+from hsarchetypes.instrumentation import Tracer
+from hsarchetypes.synthetic import generate_input_data
+from hsarchetypes.utils import card_db, skip_json_arrays
 
 from .conftest import CLUSTERING_DATA
 from .utils import get_deck_from_deckstring
@@ -241,6 +248,32 @@ def test_merge_clusters_failure():
 		merge_clusters(Cluster, cs, 5, [cluster1, cluster2])
 
 
+def test_match_cluster_pairs_greedy():
+	similarities = [
+		[0.9, 0.8],
+		[0.85, 0.1],
+	]
+	assert match_cluster_pairs(similarities, 0.5) == [(0, 0, 0.9)]
+	assert match_cluster_pairs(similarities, 0.95) == []
+	assert match_cluster_pairs([], 0.5) == []
+	assert match_cluster_pairs([[], []], 0.5) == []
+
+
+def test_match_cluster_pairs_optimal():
+	similarities = [
+		[0.9, 0.8],
+		[0.85, 0.1],
+	]
+	assert match_cluster_pairs(similarities, 0.5, method="optimal") == [
+		(1, 0, 0.85), (0, 1, 0.8)
+	]
+	assert match_cluster_pairs(similarities, 0.86, method="optimal") == [(0, 0, 0.9)]
+	assert match_cluster_pairs([[0.2]], 0.5, method="optimal") == []
+
+	with pytest.raises(ValueError):
+		match_cluster_pairs(similarities, 0.5, method="unknown")
+
+
 class TestClassClusters:
 	def test_merge_cluster_into_external_cluster(self):
 		cs = ClusterSet()
@@ -290,8 +323,148 @@ class TestClassClusters:
 		with pytest.raises(RuntimeError):
 			class_clusters.merge_cluster_into_external_cluster(clusters[1], clusters[0])
 
+	def test_inherit_from_previous(self):
+		cs = ClusterSet()
+		previous_clusters = [
+			Cluster.create(
+				Cluster, cs, 1, [_create_datapoint(TAUNT_DRUID)],
+				external_id=10, name="Taunt Druid"
+			),
+			Cluster.create(
+				Cluster, cs, 2, [_create_datapoint(MECHATHUN_DRUID_1)],
+				external_id=20, name="Mecha'thun Druid"
+			),
+		]
+		previous = ClassClusters.create(ClassClusters, cs, CardClass.DRUID, previous_clusters)
+		previous.update_cluster_signatures()
+
+		for method in ("greedy", "optimal"):
+			current = self._druid_class_clusters()
+			current.clusters = current.clusters[:2]
+			current.update_cluster_signatures()
+
+			uninherited = current.inherit_from_previous(previous, 0.9, method=method)
+
+			assert uninherited == set()
+			assert current.clusters[0].external_id == 10
+			assert current.clusters[1].external_id == 20
+			assert current.clusters[1].name == "Mecha'thun Druid"
+
+	def _druid_class_clusters(self):
+		cs = ClusterSet()
+		clusters = [
+			Cluster.create(Cluster, cs, i, [_create_datapoint(deck)])
+			for i, deck in enumerate([
+				TAUNT_DRUID, MECHATHUN_DRUID_1, MECHATHUN_DRUID_2, MECHATHUN_DRUID_1
+			])
+		]
+		return ClassClusters.create(ClassClusters, cs, CardClass.DRUID, clusters)
+
+	def test_consolidate_clusters_record_history(self):
+		class_clusters = self._druid_class_clusters()
+		class_clusters.consolidate_clusters(0.5, record_history=True)
+
+		assert len(class_clusters.merge_history) == 3
+		similarities = [m["similarity"] for m in class_clusters.merge_history]
+		assert similarities[0] == pytest.approx(1.0)
+
+		for threshold in similarities + [0.5, 0.0, 1.1]:
+			expected = self._druid_class_clusters()
+			expected.consolidate_clusters(threshold)
+			cut = class_clusters.cut_at(threshold)
+
+			assert [c.cluster_id for c in cut.clusters] == \
+				[c.cluster_id for c in expected.clusters]
+			for actual_cluster, expected_cluster in zip(cut.clusters, expected.clusters):
+				assert actual_cluster.signature == expected_cluster.signature
+				assert actual_cluster.ccp_signature == expected_cluster.ccp_signature
+				assert len(actual_cluster.data_points) == len(expected_cluster.data_points)
+
+		first_merge = class_clusters.merge_history[0]
+		node = class_clusters.get_dendrogram_node(first_merge["merged_cluster_id"])
+		assert len(node.data_points) == 2
+		assert node.signature
+
+	def test_update_cluster_signatures_matrix(self, monkeypatch):
+		expected = self._druid_class_clusters()
+		expected.clusters[0].external_id = 1
+		expected.clusters[1].external_id = 2
+		expected.update_cluster_signatures()
+
+		monkeypatch.setattr("hsarchetypes.clustering.USE_SIGNATURE_MATRIX", True)
+		class_clusters = self._druid_class_clusters()
+		class_clusters.clusters[0].external_id = 1
+		class_clusters.clusters[1].external_id = 2
+		class_clusters.consolidate_clusters(1.1)
+
+		for cluster, expected_cluster in zip(class_clusters.clusters, expected.clusters):
+			assert cluster.signature.keys() == expected_cluster.signature.keys()
+			for dbf_id, weight in expected_cluster.signature.items():
+				assert cluster.signature[dbf_id] == pytest.approx(weight)
+			assert cluster.ccp_signature.keys() == expected_cluster.ccp_signature.keys()
+			for dbf_id, weight in expected_cluster.ccp_signature.items():
+				assert cluster.ccp_signature[dbf_id] == pytest.approx(weight)
+
+	def test_cut_at_leaves_clusters_unchanged(self):
+		class_clusters = self._druid_class_clusters()
+		class_clusters.consolidate_clusters(0.5, record_history=True)
+		for i, cluster in enumerate(class_clusters.clusters):
+			cluster.external_id = 100 + i
+			cluster.name = "Archetype %i" % (i)
+			cluster._augment_data_points()
+
+		def labels():
+			return [
+				[(d["cluster_id"], d["archetype_name"], d["external_id"]) for d in c.data_points]
+				for c in class_clusters.clusters
+			]
+
+		expected = labels()
+		cut = class_clusters.cut_at(1.1)
+		assert len(cut.clusters) > len(class_clusters.clusters)
+		assert labels() == expected
+
+	def test_cut_at_without_history(self):
+		class_clusters = self._druid_class_clusters()
+		class_clusters.consolidate_clusters(0.5)
+
+		with pytest.raises(RuntimeError):
+			class_clusters.cut_at(0.5)
+
 
 class TestCluster:
+	def test_aggregates(self):
+		cs = ClusterSet()
+
+		def data_point(deck, observations, decklist):
+			result = _create_datapoint(deck)
+			result["observations"] = observations
+			result["decklist"] = decklist
+			return result
+
+		cluster1 = Cluster.create(Cluster, cs, 1, [
+			data_point(MECHATHUN_DRUID_1, 5, "a"),
+			data_point(MECHATHUN_DRUID_2, 20, "b"),
+		])
+		cluster2 = Cluster.create(Cluster, cs, 2, [
+			data_point(MECHATHUN_DRUID_1, 20, "c"),
+			data_point(MECHATHUN_DRUID_2, 1, "d"),
+			data_point(MECHATHUN_DRUID_1, 7, "e"),
+		])
+
+		assert cluster1.observations == 25
+		assert cluster1.most_popular_deck["decklist"] == "b"
+
+		merged = merge_clusters(Cluster, cs, 3, [cluster1, cluster2])
+		assert merged.observations == 53
+		assert merged.single_deck_max_observations == 20
+		assert merged.pretty_decklists == ["b", "c", "e", "a", "d"]
+
+		merged.data_points.append(data_point(TAUNT_DRUID, 100, "f"))
+		merged.update_aggregates()
+		assert merged.observations == 153
+		assert merged.most_popular_deck["decklist"] == "f"
+
 	def test_can_merge_true(self):
 		cs = ClusterSet()
 
@@ -342,6 +515,186 @@ class TestCluster:
 
 
 class TestClusterSet:
+	def _cluster_set(self):
+		cluster_set = ClusterSet()
+		class_clusters = []
+		for player_class in (CardClass.DRUID, CardClass.HUNTER):
+			clusters = [
+				Cluster.create(Cluster, cluster_set, i, [_create_datapoint(deck)])
+				for i, deck in enumerate([
+					TAUNT_DRUID, MECHATHUN_DRUID_1, MECHATHUN_DRUID_2, MECHATHUN_DRUID_1
+				])
+			]
+			class_clusters.append(
+				ClassClusters.create(ClassClusters, cluster_set, player_class, clusters)
+			)
+		setattr(cluster_set, "class_clusters", class_clusters)
+		return cluster_set
+
+	def test_consolidate_clusters_max_workers(self):
+		expected = self._cluster_set()
+		expected.consolidate_clusters(0.5)
+		expected.create_experimental_clusters({"DRUID": 3})
+
+		cluster_set = self._cluster_set()
+		data_points = [
+			d for cc in cluster_set.class_clusters for c in cc.clusters for d in c.data_points
+		]
+		cluster_set.consolidate_clusters(0.5, max_workers=2)
+		cluster_set.create_experimental_clusters({"DRUID": 3}, max_workers=2)
+
+		for class_cluster, expected_class_cluster in zip(
+			cluster_set.class_clusters, expected.class_clusters
+		):
+			assert class_cluster.player_class == expected_class_cluster.player_class
+			assert [c.cluster_id for c in class_cluster.clusters] == \
+				[c.cluster_id for c in expected_class_cluster.clusters]
+			for cluster, expected_cluster in zip(
+				class_cluster.clusters, expected_class_cluster.clusters
+			):
+				assert cluster.signature == expected_cluster.signature
+				assert cluster.ccp_signature == expected_cluster.ccp_signature
+				assert cluster.observations == expected_cluster.observations
+				for data_point in cluster.data_points:
+					assert data_point["cluster_id"] == cluster.cluster_id
+
+		# The original data points are kept rather than the copies from the workers
+		assert sorted(map(id, data_points)) == sorted(
+			id(d) for cc in cluster_set.class_clusters for c in cc.clusters for d in c.data_points
+		)
+
+	def test_process_class_clusters(self):
+		class_cluster = self._cluster_set().class_clusters[0]
+		state = class_cluster.to_state()
+
+		handlers, propagate, level = logger.handlers, logger.propagate, logger.level
+		try:
+			_init_worker(logging.DEBUG)
+			result, records, trace = _process_class_clusters(("consolidate", state, 0.5, None))
+		finally:
+			logger.handlers, logger.propagate = handlers, propagate
+			logger.setLevel(level)
+
+		# Only the indices of the data points are sent back
+		assert "data_points" not in result
+		assert sorted(i for c in result["clusters"] for i in c["data_points"]) == \
+			list(range(len(state["data_points"])))
+		assert all(c["signature"] for c in result["clusters"])
+		assert records
+		assert trace == []
+
+	def test_consolidate_clusters_max_workers_record_history(self):
+		cluster_set = self._cluster_set()
+		with pytest.raises(ValueError):
+			cluster_set.consolidate_clusters(0.5, record_history=True, max_workers=2)
+
+	def _consolidated_cluster_set(self):
+		cluster_set = self._cluster_set()
+		cluster_set.as_of = "2019-01-01T00:00:00"
+		cluster_set.game_format = FormatType.FT_STANDARD
+		cluster_set.live_in_production = True
+		cluster_set.latest = False
+		cluster_set.consolidate_clusters(0.5)
+		return cluster_set
+
+	def test_write_json(self, tmpdir):
+		cluster_set = self._consolidated_cluster_set()
+		for i, data_point in enumerate(cluster_set.class_clusters[0].clusters[0].data_points):
+			data_point["observations"] = i + 1
+
+		path = str(tmpdir.join("clusters.json"))
+		with open(path, "w") as f:
+			cluster_set.write_json(f, indent=4)
+		with open(path) as f:
+			assert f.read() == cluster_set.to_json()
+
+		with open(path, "w") as f:
+			cluster_set.write_json(f)
+		with open(path) as f:
+			assert json.load(f) == json.loads(cluster_set.to_json())
+
+		with open(path, "w") as f:
+			cluster_set.write_json(f, include_data_points=False)
+		with open(path) as f:
+			result = json.load(f)
+		for class_cluster in result["class_clusters"]:
+			for cluster in class_cluster["clusters"]:
+				assert "data_points" not in cluster
+
+		with open(path, "w") as f:
+			cluster_set.write_json(f, max_data_points=1)
+		with open(path) as f:
+			result = json.load(f)
+		clusters = result["class_clusters"][0]["clusters"]
+		assert all(len(cluster["data_points"]) == 1 for cluster in clusters)
+		data_points = cluster_set.class_clusters[0].clusters[0].data_points
+		assert clusters[0]["data_points"][0]["observations"] == len(data_points)
+
+		# Every chunk written holds at most one data point
+		class ChunkWriter:
+			def __init__(self):
+				self.chunks = []
+
+			def write(self, chunk):
+				self.chunks.append(chunk)
+
+		writer = ChunkWriter()
+		cluster_set.write_json(writer)
+		assert len(data_points) > 1
+		assert max(chunk.count('"cards"') for chunk in writer.chunks) == 1
+
+	def test_from_json(self, tmpdir):
+		cluster_set = self._consolidated_cluster_set()
+		cluster_set.create_experimental_clusters({"DRUID": 2})
+		text = cluster_set.to_json()
+
+		loaded = ClusterSet.from_json(text)
+		assert loaded.to_json() == text
+		assert loaded.game_format == FormatType.FT_STANDARD
+		druid = loaded.get_class_cluster_by_name("DRUID")
+		assert druid.player_class == CardClass.DRUID
+		assert [c.observations for c in druid.clusters] == \
+			[c.observations for c in cluster_set.class_clusters[0].clusters]
+		assert druid.clusters[-1].experimental
+
+		path = str(tmpdir.join("clusters.json"))
+		with open(path, "w") as f:
+			f.write(text)
+		signatures_only = ClusterSet.load(path, data_points=False)
+		for class_cluster, expected in zip(
+			signatures_only.class_clusters, cluster_set.class_clusters
+		):
+			for cluster, expected_cluster in zip(class_cluster.clusters, expected.clusters):
+				assert cluster.data_points == []
+				assert cluster.signature == expected_cluster.signature
+				assert cluster.ccp_signature == expected_cluster.ccp_signature
+				assert cluster.external_id == expected_cluster.external_id
+
+	def test_load_signatures_only(self, tmpdir):
+		cluster_set = self._consolidated_cluster_set()
+		data_points = [
+			d for cc in cluster_set.class_clusters for c in cc.clusters for d in c.data_points
+		]
+		for data_point, shortid in zip(data_points, ["a]b", 'c"[d', "e\\f]"]):
+			data_point["shortid"] = shortid
+		data_points[0]["decklist"] = [[1, 2], "]"]
+		path = str(tmpdir.join("clusters.json"))
+		with open(path, "w") as f:
+			cluster_set.write_json(f, indent=4)
+
+		expected = json.loads(cluster_set.to_json())
+		for class_cluster in expected["class_clusters"]:
+			for cluster in class_cluster["clusters"]:
+				cluster["data_points"] = []
+
+		# The data points of a full file are skipped rather than decoded
+		with open(path) as f:
+			skipped = skip_json_arrays(f.read(), "data_points")
+		assert '"cards"' not in skipped
+		assert json.loads(skipped) == expected
+
+		signatures_only = ClusterSet.load(path, data_points=False)
+		assert json.loads(signatures_only.to_json()) == expected
 
 	def test_to_chart_series(self):
 		cluster_set = ClusterSet()
@@ -386,3 +739,115 @@ class TestClusterSet:
 			"player_class": "DRUID",
 			"signatures": {2: []}
 		}]
+
+	def test_iter_chart_data_downsampled(self):
+		cluster_set = ClusterSet()
+
+		data_points = []
+		for i, deck in enumerate([TAUNT_DRUID, MECHATHUN_DRUID_1, MECHATHUN_DRUID_2]):
+			data_point = _create_datapoint(deck)
+			data_point["observations"] = [5, 20, 10][i]
+			data_points.append(data_point)
+		cluster = Cluster.create(Cluster, cluster_set, 2, data_points, signature={})
+		class_cluster = ClassClusters.create(ClassClusters, cluster_set, CardClass.DRUID, [cluster])
+		setattr(cluster_set, "class_clusters", [class_cluster])
+
+		chart_data = cluster_set.iter_chart_data()
+		assert not isinstance(chart_data, list)
+		assert list(chart_data) == cluster_set.to_chart_data()
+
+		payload, = cluster_set.iter_chart_data(max_points_per_cluster=2)
+		assert [d["metadata"]["games"] for d in payload["data"]] == [20, 10]
+		assert payload["cluster_totals"] == {2: {"data_points": 3, "games": 35}}
+
+
+class TestCreateClusterSet:
+	def _input_data(self):
+		return generate_input_data(num_classes=2, clusters_per_class=3, decks_per_cluster=12, seed=1)
+
+	def _create_cluster_set(self, input_data, **kwargs):
+		pytest.importorskip("sklearn")
+		return create_cluster_set(input_data, num_clusters=4, random_state=0, **kwargs)
+
+	def _clusters(self, cluster_set):
+		# The fields every kind of input keeps
+		fields = ("shortid", "cards", "observations", "x", "y")
+		return [
+			[
+				(c.cluster_id, c.signature, sorted(
+					({k: d[k] for k in fields} for d in c.data_points), key=itemgetter("shortid")
+				))
+				for c in class_cluster.clusters
+			]
+			for class_cluster in cluster_set.class_clusters
+		]
+
+	def test_deck_matrix_input(self):
+		input_data = self._input_data()
+		expected = self._create_cluster_set(input_data)
+		actual = self._create_cluster_set({
+			player_class: DeckMatrix.from_data_points(data_points)
+			for player_class, data_points in input_data.items()
+		})
+
+		assert [c.player_class for c in actual.class_clusters] == [CardClass.DRUID, CardClass.HUNTER]
+		assert self._clusters(actual) == self._clusters(expected)
+
+	def test_deduplicate(self):
+		input_data = self._input_data()
+		for player_class, data_points in input_data.items():
+			input_data[player_class] = data_points + [
+				dict(d, shortid=d["shortid"] + "-copy", observations=d["observations"] + 1)
+				for d in data_points[::3]
+			]
+		cluster_set = self._create_cluster_set(input_data, deduplicate=True)
+
+		for class_cluster in cluster_set.class_clusters:
+			data_points = input_data[class_cluster.player_class_name]
+			labels = {
+				d["shortid"]: c.cluster_id for c in class_cluster.clusters for d in c.data_points
+			}
+			# Every data point is kept, in the same cluster as its duplicates
+			assert len(labels) == len(data_points)
+			for shortid, cluster_id in labels.items():
+				if shortid.endswith("-copy"):
+					assert labels[shortid[:-len("-copy")]] == cluster_id
+			assert sum(c.observations for c in class_cluster.clusters) == \
+				sum(d["observations"] for d in data_points)
+
+		deck_matrix_cluster_set = self._create_cluster_set({
+			player_class: DeckMatrix.from_data_points(data_points)
+			for player_class, data_points in input_data.items()
+		}, deduplicate=True)
+		assert self._clusters(deck_matrix_cluster_set) == self._clusters(cluster_set)
+
+	def test_wild(self, caplog):
+		input_data = self._input_data()
+		with caplog.at_level(logging.INFO, logger="hsarchetypes"):
+			cluster_set = self._create_cluster_set(input_data, game_format=FormatType.FT_WILD)
+
+		assert cluster_set.game_format == FormatType.FT_WILD
+		lengths = [
+			int(record.getMessage().split(": ")[1]) for record in caplog.records
+			if record.getMessage().startswith("Full Feature Vector Length")
+		]
+		assert lengths == [
+			len(_to_feature_vectors(data_points[:1], player_class, mechanics=wild_mechanics)[0])
+			for player_class, data_points in input_data.items()
+		]
+		assert lengths[0] == len(_to_feature_vectors(input_data["DRUID"][:1], "DRUID")[0]) + \
+			len(wild_mechanics) - len(mechanics)
+
+	def test_tracer(self):
+		tracer = Tracer()
+		cluster_set = self._create_cluster_set(self._input_data(), tracer=tracer, deduplicate=True)
+
+		assert cluster_set.tracer is tracer
+		stages = set((r["stage"], r["player_class"]) for r in tracer.records)
+		for player_class in ("DRUID", "HUNTER"):
+			for stage in (
+				"deepcopy_input", "deduplicate", "feature_build", "tsne", "scaling", "kmeans",
+				"rule_split", "signature_update", "consolidation_iteration", "experimental_clusters",
+			):
+				assert (stage, player_class) in stages
+		assert all(r["wall_time"] >= 0 and r["peak_rss"] for r in tracer.records)
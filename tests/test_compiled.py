@@ -0,0 +1,109 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from hearthstone.enums import CardClass, FormatType
+
+import hsarchetypes
+from hsarchetypes.classification import classify_deck
+from hsarchetypes.clustering import ClassClusters, Cluster, ClusterSet
+from hsarchetypes.compiled import CompiledClassifier, write_classifier
+
+from .test_classification import (
+	MECHATHUN_PRIEST_DECK, MECHATHUN_PRIEST_ID, MECHATHUN_PRIEST_REQUIRED_CARDS,
+	MECHATHUN_PRIEST_SIGNATURE, MECHATHUN_QUEST_PRIEST_DECK, MECHATHUN_QUEST_PRIEST_ID,
+	MECHATHUN_QUEST_PRIEST_REQUIRED_CARDS, MECHATHUN_QUEST_PRIEST_SIGNATURE
+)
+from .utils import DECKSTRINGS, get_deck_from_deckstring
+
+
+pytest.importorskip("numpy")
+
+
+PRIEST_CLUSTERS = {
+	MECHATHUN_PRIEST_ID: {
+		"signature_weights": MECHATHUN_PRIEST_SIGNATURE,
+		"required_cards": MECHATHUN_PRIEST_REQUIRED_CARDS
+	},
+	MECHATHUN_QUEST_PRIEST_ID: {
+		"signature_weights": MECHATHUN_QUEST_PRIEST_SIGNATURE,
+		"required_cards": MECHATHUN_QUEST_PRIEST_REQUIRED_CARDS,
+		"rules": ["is_quest_deck"]
+	},
+}
+
+
+def _classify_all(classifier, clusters, decks, player_class):
+	expected = []
+	actual = []
+	for deck in decks:
+		expected_failures = []
+		failures = []
+		expected.append(
+			(classify_deck(deck, clusters, expected_failures.append), expected_failures)
+		)
+		actual.append(
+			(classifier.classify(deck, player_class, failures.append), failures)
+		)
+	return actual, expected
+
+
+def test_compiled_classifier(tmpdir):
+	path = str(tmpdir.join("classifier.npz"))
+	write_classifier({CardClass.PRIEST: PRIEST_CLUSTERS}, path, game_format="FT_STANDARD")
+	classifier = CompiledClassifier.load(path)
+	assert classifier.game_format == "FT_STANDARD"
+
+	decks = [
+		get_deck_from_deckstring(MECHATHUN_PRIEST_DECK),
+		get_deck_from_deckstring(MECHATHUN_QUEST_PRIEST_DECK),
+		{},
+	]
+	actual, expected = _classify_all(classifier, PRIEST_CLUSTERS, decks, CardClass.PRIEST)
+	assert actual == expected
+	assert actual[0][0] == MECHATHUN_PRIEST_ID
+	assert actual[1][0] == MECHATHUN_QUEST_PRIEST_ID
+
+	assert classifier.classify_batch(decks, CardClass.PRIEST) == [a for a, f in actual]
+	assert classifier.classify(decks[0], CardClass.MAGE) is None
+
+
+def test_export_classifier(tmpdir):
+	cluster_set = ClusterSet()
+	cluster_set.game_format = FormatType.FT_WILD
+	decks = [get_deck_from_deckstring(d) for d in DECKSTRINGS]
+	clusters = []
+	for i, deck in enumerate(decks):
+		data_point = {"cards": {str(k): v for k, v in deck.items()}, "observations": 1}
+		clusters.append(Cluster.create(
+			Cluster, cluster_set, i, [data_point],
+			external_id=100 + i, rules=["is_highlander_deck"] if i else []
+		))
+	clusters.append(Cluster.create(Cluster, cluster_set, 3, [], external_id=None))
+	class_cluster = ClassClusters.create(ClassClusters, cluster_set, CardClass.DRUID, clusters)
+	cluster_set.class_clusters = [class_cluster]
+	class_cluster.update_cluster_signatures()
+
+	path = str(tmpdir.join("classifier.npz"))
+	cluster_set.export_classifier(path)
+	classifier = CompiledClassifier.load(path)
+	assert classifier.game_format == "FT_WILD"
+
+	druid_clusters = cluster_set.classifier_clusters()[CardClass.DRUID]
+	assert sorted(druid_clusters) == [100, 101, 102]
+
+	# Partial decks exercise the cutoff
+	test_decks = decks + [dict(list(deck.items())[:n]) for deck in decks for n in (5, 10)]
+	actual, expected = _classify_all(classifier, druid_clusters, test_decks, CardClass.DRUID)
+	assert actual == expected
+
+
+def test_compiled_classifier_imports():
+	code = (
+		"import sys; import hsarchetypes.compiled; "
+		"assert 'sklearn' not in sys.modules; "
+		"assert 'hsarchetypes.clustering' not in sys.modules"
+	)
+	env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(hsarchetypes.__file__)))
+	subprocess.check_call([sys.executable, "-c", code], env=env)
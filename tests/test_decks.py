@@ -0,0 +1,151 @@
+import pytest
+from hearthstone.enums import GameTag
+
+from hsarchetypes import rules
+from hsarchetypes.clustering import _deduplicate_data_points, _to_feature_vectors
+from hsarchetypes.decks import DeckMatrix, DeckstringDecoder
+from hsarchetypes.features import wild_mechanics
+
+from .utils import DECKSTRINGS, get_deck_from_deckstring
+
+
+np = pytest.importorskip("numpy")
+sparse = pytest.importorskip("scipy.sparse")
+
+
+@pytest.fixture
+def data_points():
+	result = []
+	for i, deckstring in enumerate(DECKSTRINGS):
+		deck = get_deck_from_deckstring(deckstring)
+		result.append({
+			"cards": {str(k): v for k, v in deck.items()},
+			"observations": i + 1,
+			"shortid": "deck%i" % i,
+		})
+	return result
+
+
+@pytest.mark.parametrize("use_extra_features", [True, False])
+def test_feature_matrix(data_points, use_extra_features):
+	options = {
+		"use_mana_curve": use_extra_features,
+		"use_tribes": use_extra_features,
+		"use_card_types": True,
+		"use_mechanics": use_extra_features,
+	}
+	expected = _to_feature_vectors(data_points, "DRUID", **options)
+	actual = DeckMatrix.from_data_points(data_points).feature_matrix("DRUID", **options)
+
+	assert actual.tolist() == expected
+
+
+def test_feature_matrix_wild_mechanics(data_points):
+	expected = _to_feature_vectors(data_points, "DRUID", mechanics=wild_mechanics)
+	actual = DeckMatrix.from_data_points(data_points).feature_matrix(
+		"DRUID", mechanics=wild_mechanics
+	)
+	assert actual.tolist() == expected
+
+	# Mechanics missing from the card attribute table are looked up
+	mechanics = [GameTag.TAUNT, GameTag.TRIGGER_VISUAL]
+	expected = _to_feature_vectors(data_points, "DRUID", mechanics=mechanics)
+	actual = DeckMatrix.from_data_points(data_points).feature_matrix("DRUID", mechanics=mechanics)
+	assert actual.tolist() == expected
+
+
+def test_feature_matrix_custom_rule(data_points, monkeypatch):
+	monkeypatch.setitem(
+		rules.FALSE_POSITIVE_RULES, "is_big_deck", lambda d: len(d["cards"]) > 16
+	)
+
+	expected = _to_feature_vectors(data_points, "DRUID")
+	actual = DeckMatrix.from_data_points(data_points).feature_matrix("DRUID")
+	assert actual.tolist() == expected
+
+
+def test_from_csr(data_points):
+	columns = sorted(set(int(dbf_id) for d in data_points for dbf_id in d["cards"]))
+	rows = []
+	for data_point in data_points:
+		row = [0] * len(columns)
+		for dbf_id, count in data_point["cards"].items():
+			row[columns.index(int(dbf_id))] = count
+		rows.append(row)
+
+	matrix = DeckMatrix.from_csr(
+		sparse.csr_matrix(rows),
+		columns,
+		np.array([1, 2, 3]),
+		shortids=["deck0", "deck1", "deck2"]
+	)
+	assert len(matrix) == 3
+
+	result = matrix.to_data_points(xy=[(0.5, 1), (2, 3), (4, 5)])
+	assert [d["observations"] for d in result] == [1, 2, 3]
+	assert [d["shortid"] for d in result] == ["deck0", "deck1", "deck2"]
+	assert [(d["x"], d["y"]) for d in result] == [(0.5, 1.0), (2.0, 3.0), (4.0, 5.0)]
+	for data_point, expected in zip(result, data_points):
+		assert data_point["cards"] == expected["cards"]
+
+
+def test_invalid_deck_matrix():
+	with pytest.raises(ValueError):
+		DeckMatrix([0, 1], [1], [1], [1, 2])
+
+
+@pytest.mark.parametrize("max_workers", [None, 2])
+def test_deckstring_decoder(max_workers):
+	decoder = DeckstringDecoder(cache_size=2, max_workers=max_workers)
+	deckstrings = DECKSTRINGS + DECKSTRINGS[:1]
+
+	decks = decoder.to_dicts(deckstrings)
+	assert decks == [get_deck_from_deckstring(d) for d in deckstrings]
+	assert len(decoder._cache) == 2
+	assert decoder.decode(DECKSTRINGS[2]) is decoder.decode(DECKSTRINGS[2])
+
+	matrix = decoder.to_matrix(deckstrings, shortids=["a", "b", "c", "d"])
+	data_points = matrix.to_data_points()
+	assert [d["observations"] for d in data_points] == [1, 1, 1, 1]
+	assert [d["shortid"] for d in data_points] == ["a", "b", "c", "d"]
+	for data_point, deck in zip(data_points, decks):
+		assert data_point["cards"] == {str(k): v for k, v in deck.items()}
+	decoder.close()
+
+
+def test_deckstring_decoder_executor():
+	with DeckstringDecoder(cache_size=1, max_workers=2) as decoder:
+		decoder.decode_all(DECKSTRINGS)
+		executor = decoder._executor
+		decoder.decode_all(DECKSTRINGS)
+		# The pool is kept across calls
+		assert executor is not None
+		assert decoder._executor is executor
+	assert decoder._executor is None
+
+	# The decoder can still be used once closed
+	assert decoder.to_dicts(DECKSTRINGS[:1]) == [get_deck_from_deckstring(DECKSTRINGS[0])]
+	decoder.close()
+
+
+def test_deckstring_decoder_invalid():
+	with pytest.raises(ValueError):
+		DeckstringDecoder().decode("not a deckstring")
+
+
+def test_deduplicate(data_points):
+	duplicate = dict(data_points[0], observations=10, shortid="copy")
+	duplicate["cards"] = dict(reversed(list(duplicate["cards"].items())), **{"1": 0})
+	matrix = DeckMatrix.from_data_points(data_points + [duplicate])
+
+	unique, inverse, duplicates = matrix.deduplicate()
+	assert inverse == [0, 1, 2, 0]
+	assert duplicates == [2, 1, 1]
+	assert unique.observations.tolist() == [11, 2, 3]
+	assert unique.shortids is None
+
+	expected_unique, expected_inverse, expected_duplicates = \
+		_deduplicate_data_points(data_points + [duplicate])
+	assert expected_inverse == inverse
+	assert expected_duplicates == duplicates
+	assert unique.to_data_points() == expected_unique
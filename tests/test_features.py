@@ -2,9 +2,13 @@ import json
 import os
 
 import pytest
+from hearthstone.enums import FormatType, GameTag
 
 from hsarchetypes.clustering import create_cluster_set
-from hsarchetypes.features import to_neural_net_training_data
+from hsarchetypes.features import (
+	mechanics, mechanics_for_format, to_mechanic_vector,
+	to_neural_net_training_data, wild_mechanics
+)
 
 from .conftest import CLUSTERING_DATA
 
@@ -26,3 +30,18 @@ def test_clustering_aug12_to_aug19_standard():
 			num_examples=num_examples
 		)
 		assert len(train_x) == num_examples
+
+
+def test_wild_mechanic_vector():
+	# Patches the Pirate and Jade Spirit
+	deck = {"cards": {"40465": 2, "40527": 2}}
+	standard = to_mechanic_vector(deck)
+	wild = to_mechanic_vector(deck, mechanics=wild_mechanics)
+
+	assert len(standard) == len(mechanics)
+	assert len(wild) == len(wild_mechanics)
+	assert wild[:len(mechanics)] == standard
+	assert wild[wild_mechanics.index(GameTag.JADE_GOLEM)] == 0.5
+	assert mechanics_for_format(FormatType.FT_WILD) is wild_mechanics
+	assert mechanics_for_format(FormatType.FT_STANDARD) is mechanics
+	assert mechanics_for_format(None) is mechanics
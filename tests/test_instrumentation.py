@@ -0,0 +1,144 @@
+import json
+
+from hearthstone.enums import FormatType
+
+from hsarchetypes.clustering import ClusterSet
+from hsarchetypes.instrumentation import NULL_TRACER, MemoryTracer, Tracer
+
+from .utils import build_cluster_set
+
+
+def test_tracer_stage():
+	tracer = Tracer()
+	with tracer.stage("feature_build", "DRUID"):
+		pass
+	with tracer.stage("feature_build", "DRUID"):
+		pass
+	with tracer.stage("tsne"):
+		pass
+
+	assert [r["stage"] for r in tracer.records] == ["feature_build", "feature_build", "tsne"]
+	summary = tracer.summary()
+	assert [(e["stage"], e["player_class"], e["calls"]) for e in summary] == [
+		("feature_build", "DRUID", 2),
+		("tsne", None, 1),
+	]
+	assert all(e["wall_time"] >= 0 and e["cpu_time"] >= 0 for e in summary)
+
+	report = json.loads(tracer.to_json())
+	assert report["stages"] == json.loads(json.dumps(summary))
+	assert len(report["records"]) == 3
+	assert report["process_peak_rss"] > 0
+
+
+def test_tracer_rss():
+	tracer = Tracer()
+	with tracer.stage("outer"):
+		with tracer.stage("allocate"):
+			data = b"\1" * 64 * 2 ** 20
+		del data
+	with tracer.stage("idle"):
+		pass
+
+	allocate, outer, idle = tracer.records
+	assert allocate["peak_rss"] >= 64 * 2 ** 20
+	assert outer["peak_rss"] >= allocate["peak_rss"]
+	summary = {e["stage"]: e for e in tracer.summary()}
+	assert summary["allocate"]["peak_rss"] == allocate["peak_rss"]
+	assert 'hsarchetypes_stage_peak_rss_bytes{stage="idle"' in tracer.to_prometheus()
+	if tracer.peak_rss_scope == "stage":
+		# The peak is reset at the start of every stage
+		assert allocate["rss_delta"] >= 63 * 2 ** 20
+		assert idle["peak_rss"] < allocate["peak_rss"] - 32 * 2 ** 20
+
+
+def test_tracer_prometheus(tmpdir):
+	tracer = Tracer()
+	with tracer.stage("kmeans", "MAGE"):
+		pass
+
+	text = tracer.to_prometheus()
+	assert "# TYPE hsarchetypes_stage_wall_seconds_total counter" in text
+	assert 'hsarchetypes_stage_calls_total{stage="kmeans",player_class="MAGE"} 1.0' in text
+	assert "hsarchetypes_stage_process_peak_rss_bytes " in text
+
+	path = str(tmpdir.join("clustering.prom"))
+	tracer.write_prometheus(path)
+	with open(path) as f:
+		assert f.read() == text
+
+
+def test_consolidation_stages():
+	tracer = Tracer()
+	cluster_set = build_cluster_set(tracer=tracer)
+	cluster_set.consolidate_clusters(0.5)
+	cluster_set.create_experimental_clusters({"DRUID": 0})
+
+	stages = set((r["stage"], r["player_class"]) for r in tracer.records)
+	assert stages == {
+		("signature_update", "DRUID"),
+		("consolidation_iteration", "DRUID"),
+		("experimental_clusters", "DRUID"),
+	}
+
+
+def test_null_tracer():
+	cluster_set = build_cluster_set(tracer=NULL_TRACER)
+	cluster_set.consolidate_clusters(0.5)
+
+	assert not NULL_TRACER.enabled
+	assert ClusterSet().tracer is NULL_TRACER
+
+
+def test_memory_tracer():
+	tracer = MemoryTracer(top_n=5)
+	try:
+		with tracer.stage("outer", "DRUID"):
+			with tracer.stage("allocate", "DRUID"):
+				kept = [bytearray(1024) for i in range(1000)]
+			del kept
+		with tracer.stage("idle"):
+			pass
+	finally:
+		tracer.stop()
+
+	allocate, outer, idle = tracer.records
+	assert allocate["memory_peak"] >= 1024 * 1000
+	assert allocate["memory_delta"] >= 1024 * 1000
+	assert allocate["top_allocations"][0]["site"].startswith(__file__)
+	assert outer["memory_peak"] >= allocate["memory_peak"]
+
+	summary = {e["stage"]: e for e in tracer.summary()}
+	assert summary["allocate"]["memory_peak"] == allocate["memory_peak"]
+	assert summary["allocate"]["top_allocations"][0]["size"] >= 1024 * 1000
+
+	report = tracer.memory_report()
+	assert report.index("outer") < report.index("idle")
+	assert 'hsarchetypes_stage_memory_peak_bytes{stage="allocate"' in tracer.to_prometheus()
+
+
+def test_memory_tracer_max_workers():
+	tracer = MemoryTracer(top_n=3)
+	try:
+		cluster_set = build_cluster_set(tracer=tracer)
+		cluster_set.consolidate_clusters(0.5, max_workers=2)
+	finally:
+		tracer.stop()
+
+	# Workers trace with the same kind of tracer as the caller
+	assert tracer.records
+	assert all("memory_peak" in r for r in tracer.records)
+	assert all(len(r["top_allocations"]) <= 3 for r in tracer.records)
+	assert tracer.memory_report().count("signature_update") == 1
+
+
+def test_json_export_stage():
+	tracer = Tracer()
+	cluster_set = build_cluster_set(tracer=tracer)
+	cluster_set.as_of = None
+	cluster_set.game_format = FormatType.FT_STANDARD
+	cluster_set.live_in_production = False
+	cluster_set.latest = True
+	cluster_set.to_json()
+
+	assert [r["stage"] for r in tracer.records] == ["json_export"]
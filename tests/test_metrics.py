@@ -0,0 +1,107 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from hsarchetypes.classification import classify_deck
+from hsarchetypes.metrics import ClassificationMetrics
+
+from .test_classification import (
+	MECHATHUN_PRIEST_DECK, MECHATHUN_PRIEST_ID, MECHATHUN_PRIEST_REQUIRED_CARDS,
+	MECHATHUN_PRIEST_SIGNATURE, MECHATHUN_QUEST_PRIEST_DECK, MECHATHUN_QUEST_PRIEST_ID,
+	MECHATHUN_QUEST_PRIEST_REQUIRED_CARDS, MECHATHUN_QUEST_PRIEST_SIGNATURE
+)
+from .utils import get_deck_from_deckstring
+
+
+CLUSTERS = {
+	MECHATHUN_PRIEST_ID: {
+		"signature_weights": MECHATHUN_PRIEST_SIGNATURE,
+		"required_cards": MECHATHUN_PRIEST_REQUIRED_CARDS
+	},
+	MECHATHUN_QUEST_PRIEST_ID: {
+		"signature_weights": MECHATHUN_QUEST_PRIEST_SIGNATURE,
+		"required_cards": MECHATHUN_QUEST_PRIEST_REQUIRED_CARDS
+	},
+}
+
+
+def _classify_decks(metrics, repeat=1):
+	decks = [
+		get_deck_from_deckstring(MECHATHUN_PRIEST_DECK),
+		get_deck_from_deckstring(MECHATHUN_QUEST_PRIEST_DECK),
+		{},
+	]
+	failures = []
+	for i in range(repeat):
+		for deck in decks:
+			classify_deck(deck, CLUSTERS, failure_callback=failures.append, metrics=metrics)
+	return failures
+
+
+def test_classification_metrics():
+	metrics = ClassificationMetrics()
+	failures = _classify_decks(metrics)
+	assert len(failures) == 1
+
+	result = metrics.to_dict()
+	assert result["classified"] == [[MECHATHUN_PRIEST_ID, 1], [MECHATHUN_QUEST_PRIEST_ID, 1]]
+	assert result["unclassified"] == 1
+	assert result["rejections"] == [{
+		"reason": "missing_required_card", "rule": None, "dbf_id": 41494, "count": 1
+	}]
+	assert sum(result["latency"]["counts"]) == 3
+	assert result["latency"]["sum"] > 0
+
+
+def test_classification_metrics_threads():
+	metrics = ClassificationMetrics()
+	with ThreadPoolExecutor(max_workers=4) as executor:
+		list(executor.map(lambda i: _classify_decks(metrics, repeat=10), range(4)))
+
+	result = metrics.to_dict()
+	assert result["unclassified"] == 40
+	assert sum(result["latency"]["counts"]) == 120
+	assert result["rejections"][0]["count"] == 40
+
+
+def test_classification_metrics_merge():
+	metrics = ClassificationMetrics()
+	_classify_decks(metrics)
+	other = ClassificationMetrics.from_dict(json.loads(json.dumps(metrics.to_dict())))
+	_classify_decks(other)
+
+	merged = ClassificationMetrics().merge(metrics).merge(other)
+	result = merged.to_dict()
+	assert result["classified"] == [[MECHATHUN_PRIEST_ID, 3], [MECHATHUN_QUEST_PRIEST_ID, 3]]
+	assert result["unclassified"] == 3
+	assert sum(result["latency"]["counts"]) == 9
+
+	with pytest.raises(ValueError):
+		merged.merge(ClassificationMetrics(buckets=[0.1, 1]))
+
+
+def test_classification_metrics_prometheus(tmpdir):
+	metrics = ClassificationMetrics(buckets=[0.001, 1])
+	metrics.observe(5, 0.0001)
+	metrics.observe(None, 0.5)
+	metrics.reject({"archetype_id": 5, "reason": "false_positive", "rule": "is_quest_deck"})
+
+	text = metrics.to_prometheus()
+	lines = text.splitlines()
+	assert 'hsarchetypes_classification_classified_total{archetype_id="5"} 1.0' in lines
+	assert "hsarchetypes_classification_unclassified_total 1.0" in lines
+	assert (
+		"hsarchetypes_classification_rejections_total"
+		'{reason="false_positive",rule="is_quest_deck",dbf_id=""} 1.0'
+	) in lines
+	assert "# TYPE hsarchetypes_classification_latency_seconds histogram" in lines
+	assert 'hsarchetypes_classification_latency_seconds_bucket{le="0.001"} 1.0' in lines
+	assert 'hsarchetypes_classification_latency_seconds_bucket{le="1.0"} 2.0' in lines
+	assert 'hsarchetypes_classification_latency_seconds_bucket{le="+Inf"} 2.0' in lines
+	assert "hsarchetypes_classification_latency_seconds_count 2.0" in lines
+
+	path = str(tmpdir.join("classification.prom"))
+	metrics.write_prometheus(path)
+	with open(path) as f:
+		assert f.read() == text
@@ -0,0 +1,87 @@
+import pytest
+from hearthstone.enums import CardClass, FormatType
+
+from hsarchetypes.compiled import write_classifier
+from hsarchetypes.decks import DeckMatrix
+from hsarchetypes.features import mechanics, wild_mechanics
+from hsarchetypes.registry import ClassifierRegistry
+
+from .test_classification import (
+	MECHATHUN_PRIEST_DECK, MECHATHUN_PRIEST_ID, MECHATHUN_QUEST_PRIEST_ID
+)
+from .test_compiled import PRIEST_CLUSTERS
+from .utils import DECKSTRINGS, get_deck_from_deckstring
+
+
+pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def registry(tmpdir):
+	standard_path = str(tmpdir.join("standard.npz"))
+	write_classifier({CardClass.PRIEST: PRIEST_CLUSTERS}, standard_path, game_format="FT_STANDARD")
+	wild_path = str(tmpdir.join("wild.npz"))
+	write_classifier({CardClass.PRIEST: {
+		MECHATHUN_QUEST_PRIEST_ID: PRIEST_CLUSTERS[MECHATHUN_QUEST_PRIEST_ID]
+	}}, wild_path, game_format="FT_WILD")
+
+	result = ClassifierRegistry()
+	result.load(standard_path)
+	result.load(wild_path)
+	return result
+
+
+def test_classify(registry):
+	deck = get_deck_from_deckstring(MECHATHUN_PRIEST_DECK)
+	failures = []
+
+	assert registry.classify(deck, FormatType.FT_STANDARD, CardClass.PRIEST) == MECHATHUN_PRIEST_ID
+	assert registry.classify(deck, "FT_STANDARD", "PRIEST") == MECHATHUN_PRIEST_ID
+	assert registry.classify(deck, FormatType.FT_WILD, CardClass.PRIEST, failures.append) is None
+	# Only the Wild clusters were scored
+	assert [f["archetype_id"] for f in failures] == [MECHATHUN_QUEST_PRIEST_ID]
+	assert registry.classify(deck, FormatType.FT_STANDARD, CardClass.MAGE) is None
+
+	assert (FormatType.FT_WILD, CardClass.PRIEST) in registry
+	assert (FormatType.FT_WILD, CardClass.MAGE) not in registry
+
+
+def test_register_unknown_format(tmpdir):
+	path = str(tmpdir.join("classifier.npz"))
+	write_classifier({CardClass.PRIEST: PRIEST_CLUSTERS}, path)
+
+	registry = ClassifierRegistry()
+	with pytest.raises(ValueError):
+		registry.load(path)
+	registry.load(path, game_format=FormatType.FT_WILD, player_classes=[CardClass.PRIEST])
+	assert registry.classifier(FormatType.FT_WILD, CardClass.PRIEST) is not None
+
+
+def test_feature_options(registry):
+	assert registry.feature_options(FormatType.FT_STANDARD, CardClass.DRUID) == {
+		"mechanics": mechanics
+	}
+	assert registry.feature_options(FormatType.FT_WILD, CardClass.DRUID) == {
+		"mechanics": wild_mechanics
+	}
+
+	registry.configure(FormatType.FT_WILD, use_tribes=False)
+	registry.configure(FormatType.FT_WILD, CardClass.DRUID, use_mechanics=False)
+	assert registry.feature_options(FormatType.FT_WILD, CardClass.DRUID) == {
+		"mechanics": wild_mechanics, "use_tribes": False, "use_mechanics": False
+	}
+	assert registry.feature_options(FormatType.FT_WILD, CardClass.PRIEST) == {
+		"mechanics": wild_mechanics, "use_tribes": False
+	}
+	with pytest.raises(TypeError):
+		registry.configure(FormatType.FT_WILD, use_everything=True)
+
+
+def test_feature_matrix(registry):
+	decks = DeckMatrix.from_data_points([
+		{"cards": {str(k): v for k, v in get_deck_from_deckstring(d).items()}, "observations": 1}
+		for d in DECKSTRINGS
+	])
+	standard = registry.feature_matrix(decks, FormatType.FT_STANDARD, CardClass.DRUID)
+	wild = registry.feature_matrix(decks, FormatType.FT_WILD, CardClass.DRUID)
+	assert wild.shape[1] - standard.shape[1] == len(wild_mechanics) - len(mechanics)
@@ -0,0 +1,274 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from hearthstone.enums import CardClass
+
+from hsarchetypes.compiled import write_classifier
+from hsarchetypes.metrics import ClassificationMetrics
+from hsarchetypes.server import (
+	ClassificationServer, StaleClassifierError, _worker_classify_batch
+)
+
+from .test_classification import (
+	MECHATHUN_PRIEST_DECK, MECHATHUN_PRIEST_ID,
+	MECHATHUN_QUEST_PRIEST_DECK, MECHATHUN_QUEST_PRIEST_ID
+)
+from .test_compiled import PRIEST_CLUSTERS
+from .utils import get_deck_from_deckstring
+
+
+pytest.importorskip("numpy")
+
+
+def _run(coroutine):
+	loop = asyncio.new_event_loop()
+	try:
+		return loop.run_until_complete(coroutine)
+	finally:
+		loop.close()
+
+
+def _write_artifact(path, clusters):
+	# Replace the artifact atomically, and make sure its mtime changes
+	tmp_path = path + ".tmp"
+	write_classifier({CardClass.PRIEST: clusters}, tmp_path)
+	if os.path.exists(path):
+		mtime_ns = os.stat(path).st_mtime_ns + 10 ** 9
+		os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+	os.replace(tmp_path, path)
+
+
+async def _request(server, method, target, payload=None, unix_path=None):
+	if unix_path:
+		reader, writer = await asyncio.open_unix_connection(unix_path)
+	else:
+		reader, writer = await asyncio.open_connection(*server.address[:2])
+	body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+	writer.write((
+		"%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %i\r\n"
+		"Connection: close\r\n\r\n" % (method, target, len(body))
+	).encode("latin-1") + body)
+	response = await reader.read()
+	writer.close()
+
+	head, _, body = response.partition(b"\r\n\r\n")
+	status = int(head.split()[1])
+	if b"application/json" in head:
+		return status, json.loads(body.decode("utf-8"))
+	return status, body.decode("utf-8")
+
+
+def _classify_request(deckstring):
+	deck = get_deck_from_deckstring(deckstring)
+	return {"player_class": "PRIEST", "cards": {str(k): v for k, v in deck.items()}}
+
+
+@pytest.fixture
+def artifact(tmpdir):
+	path = str(tmpdir.join("classifier.npz"))
+	_write_artifact(path, PRIEST_CLUSTERS)
+	return path
+
+
+def test_classify(artifact):
+	metrics = ClassificationMetrics()
+	server = ClassificationServer(artifact, metrics=metrics, batch_delay=0.05)
+	batch_sizes = []
+
+	async def run():
+		await server.start()
+		classify_batch = server.classifier.classify_batch
+
+		def record_batch(decks, *args, **kwargs):
+			batch_sizes.append(len(decks))
+			return classify_batch(decks, *args, **kwargs)
+
+		server.classifier.classify_batch = record_batch
+
+		requests = [
+			_classify_request(MECHATHUN_PRIEST_DECK),
+			_classify_request(MECHATHUN_QUEST_PRIEST_DECK),
+			{"player_class": CardClass.PRIEST.value, "deckstring": MECHATHUN_PRIEST_DECK},
+			{"player_class": "MAGE", "deckstring": MECHATHUN_PRIEST_DECK},
+		] * 5
+		responses = await asyncio.gather(*[
+			_request(server, "POST", "/classify", r) for r in requests
+		])
+		health = await _request(server, "GET", "/health")
+		prometheus = await _request(server, "GET", "/metrics")
+		await server.stop()
+		return responses, health, prometheus
+
+	responses, health, prometheus = _run(run())
+	assert responses == [
+		(200, {"archetype_id": MECHATHUN_PRIEST_ID}),
+		(200, {"archetype_id": MECHATHUN_QUEST_PRIEST_ID}),
+		(200, {"archetype_id": MECHATHUN_PRIEST_ID}),
+		(200, {"archetype_id": None}),
+	] * 5
+
+	# Concurrent requests were scored in batches
+	assert sum(batch_sizes) == 20
+	assert len(batch_sizes) < 20
+
+	assert health == (200, {"status": "ok", "version": server.version, "game_format": None})
+	assert prometheus[0] == 200
+	assert "hsarchetypes_classification_unclassified_total 5.0" in prometheus[1]
+	assert sum(metrics.to_dict()["latency"]["counts"]) == 20
+
+
+def test_invalid_requests(artifact):
+	server = ClassificationServer(artifact)
+
+	async def run():
+		await server.start()
+		responses = [
+			await _request(server, "GET", "/classify"),
+			await _request(server, "POST", "/classify", ["not", "an", "object"]),
+			await _request(server, "POST", "/classify", {"player_class": "NOBODY", "cards": {}}),
+			await _request(server, "POST", "/classify", {"player_class": "PRIEST"}),
+			await _request(server, "POST", "/classify", {"player_class": "PRIEST", "deckstring": "?"}),
+			await _request(server, "GET", "/metrics"),
+			await _request(server, "GET", "/nothing"),
+		]
+		await server.stop()
+		return [status for status, body in responses]
+
+	assert _run(run()) == [405, 400, 400, 400, 400, 404, 404]
+
+
+def test_hot_reload(artifact):
+	server = ClassificationServer(artifact, reload_interval=0.01)
+	request = _classify_request(MECHATHUN_PRIEST_DECK)
+
+	async def run():
+		await server.start()
+		old_version = server.version
+		results = []
+
+		async def client():
+			while server.version == old_version or len(results) < 10:
+				results.append(await _request(server, "POST", "/classify", request))
+
+		task = asyncio.get_event_loop().create_task(client())
+		await asyncio.sleep(0.05)
+		_write_artifact(artifact, {
+			MECHATHUN_QUEST_PRIEST_ID: PRIEST_CLUSTERS[MECHATHUN_QUEST_PRIEST_ID]
+		})
+		await asyncio.wait_for(task, 10)
+		results.append(await _request(server, "POST", "/classify", request))
+		await server.stop()
+		return old_version, results
+
+	old_version, results = _run(run())
+	assert server.version != old_version
+	# No request failed while the classifier was swapped
+	assert all(status == 200 for status, body in results)
+	assert results[0][1] == {"archetype_id": MECHATHUN_PRIEST_ID}
+	assert results[-1][1] == {"archetype_id": None}
+
+
+def test_reload_keeps_classifier_on_error(artifact):
+	server = ClassificationServer(artifact)
+	server.load()
+	version, classifier = server.version, server.classifier
+
+	with open(artifact, "wb") as f:
+		f.write(b"truncated")
+	os.utime(artifact, ns=(version + 10 ** 9, version + 10 ** 9))
+	with pytest.raises(Exception):
+		server.load()
+	assert server.version == version
+	assert server.classifier is classifier
+
+
+def test_process_pool(artifact):
+	executor = ProcessPoolExecutor(max_workers=1)
+	server = ClassificationServer(artifact, executor=executor)
+
+	async def run():
+		await server.start()
+		responses = await asyncio.gather(
+			_request(server, "POST", "/classify", _classify_request(MECHATHUN_PRIEST_DECK)),
+			_request(server, "POST", "/classify", _classify_request(MECHATHUN_QUEST_PRIEST_DECK)),
+		)
+		await server.stop()
+		return responses
+
+	try:
+		assert _run(run()) == [
+			(200, {"archetype_id": MECHATHUN_PRIEST_ID}),
+			(200, {"archetype_id": MECHATHUN_QUEST_PRIEST_ID}),
+		]
+	finally:
+		executor.shutdown()
+
+
+def test_worker_classify_batch(artifact):
+	with open(artifact, "rb") as f:
+		data = f.read()
+	with open(artifact, "wb") as f:
+		f.write(b"truncated")
+	deck = get_deck_from_deckstring(MECHATHUN_PRIEST_DECK)
+
+	# Workers only ever load the artifact bytes they are sent
+	with pytest.raises(StaleClassifierError):
+		_worker_classify_batch(artifact, 1, [deck], CardClass.PRIEST)
+	assert _worker_classify_batch(artifact, 1, [deck], CardClass.PRIEST, data) == [
+		MECHATHUN_PRIEST_ID
+	]
+	assert _worker_classify_batch(artifact, 1, [deck], CardClass.PRIEST) == [MECHATHUN_PRIEST_ID]
+	with pytest.raises(StaleClassifierError):
+		_worker_classify_batch(artifact, 2, [deck], CardClass.PRIEST)
+
+
+def test_process_pool_keeps_classifier_on_error(artifact):
+	executor = ProcessPoolExecutor(max_workers=2)
+	server = ClassificationServer(artifact, executor=executor, reload_interval=0.01)
+	requests = [
+		_classify_request(MECHATHUN_PRIEST_DECK), _classify_request(MECHATHUN_QUEST_PRIEST_DECK)
+	] * 4
+
+	async def run():
+		await server.start()
+		version = server.version
+		with open(artifact, "wb") as f:
+			f.write(b"truncated")
+		os.utime(artifact, ns=(version + 10 ** 9, version + 10 ** 9))
+		# Let the server fail to reload the artifact
+		await asyncio.sleep(0.1)
+		responses = await asyncio.gather(*[
+			_request(server, "POST", "/classify", r) for r in requests
+		])
+		await server.stop()
+		return version, responses
+
+	try:
+		version, responses = _run(run())
+	finally:
+		executor.shutdown()
+	assert server.version == version
+	assert responses == [
+		(200, {"archetype_id": MECHATHUN_PRIEST_ID}),
+		(200, {"archetype_id": MECHATHUN_QUEST_PRIEST_ID}),
+	] * 4
+
+
+@pytest.mark.skipif(not hasattr(asyncio, "start_unix_server"), reason="No Unix sockets")
+def test_unix_socket(artifact, tmpdir):
+	unix_path = str(tmpdir.join("server.sock"))
+	server = ClassificationServer(artifact)
+
+	async def run():
+		await server.start(unix_path=unix_path)
+		response = await _request(
+			server, "POST", "/classify", _classify_request(MECHATHUN_PRIEST_DECK),
+			unix_path=unix_path
+		)
+		await server.stop()
+		return response
+
+	assert _run(run()) == (200, {"archetype_id": MECHATHUN_PRIEST_ID})
@@ -0,0 +1,240 @@
+import json
+import random
+from multiprocessing import Pool
+
+import pytest
+
+from hsarchetypes.signatures import (
+	DecayedSignatureAccumulator, SignatureAccumulator, apply_cross_cluster_prevalence,
+	calculate_cluster_prevalence_counts, calculate_cross_cluster_prevalence,
+	calculate_player_class_prevalence, calculate_player_class_prevalence_from_counts,
+	calculate_signature_weights, calculate_signature_weights_matrix,
+	generate_ccp_input_weights, to_signature_matrix
+)
+
+from .utils import DECKSTRINGS, get_deck_from_deckstring
+
+
+@pytest.fixture(scope="module")
+def cluster_data():
+	rng = random.Random(42)
+	decks = [get_deck_from_deckstring(d) for d in DECKSTRINGS]
+	result = []
+	for cluster_id in range(6):
+		cluster_decks = []
+		for i in range(rng.randint(1, 8)):
+			deck = dict(rng.choice(decks))
+			for dbf_id in rng.sample(sorted(deck), 3):
+				del deck[dbf_id]
+			cluster_decks.append({
+				"cards": {str(k): v for k, v in deck.items()},
+				"observations": rng.randint(1, 100),
+			})
+		result.append((cluster_id, cluster_decks))
+	return result
+
+
+def test_cluster_prevalence_counts(cluster_data):
+	counts = calculate_cluster_prevalence_counts(cluster_data)
+
+	assert list(counts.keys()) == [cluster_id for cluster_id, decks in cluster_data]
+	for cluster_id, decks in cluster_data:
+		prevalence_counts, deck_occurrences = counts[cluster_id]
+		assert deck_occurrences == sum(d["observations"] for d in decks)
+		for dbf_id, count in prevalence_counts.items():
+			assert count == sum(d["observations"] for d in decks if dbf_id in d["cards"])
+
+
+@pytest.mark.parametrize("use_ccp", [True, False])
+@pytest.mark.parametrize("use_thresholds", [True, False])
+def test_signature_weights_from_counts(cluster_data, use_ccp, use_thresholds):
+	expected = calculate_signature_weights(
+		cluster_data, use_ccp=use_ccp, use_thresholds=use_thresholds
+	)
+
+	counts = calculate_cluster_prevalence_counts(cluster_data)
+	pcp_weights = calculate_player_class_prevalence_from_counts(counts)
+	assert pcp_weights == calculate_player_class_prevalence(cluster_data)
+
+	actual = calculate_signature_weights(
+		None,
+		use_ccp=use_ccp,
+		use_thresholds=use_thresholds,
+		pcp_weights={} if use_ccp else pcp_weights,
+		cluster_counts=counts
+	)
+	assert actual == expected
+
+
+def assert_signatures_equal(actual, expected):
+	assert actual.keys() == expected.keys()
+	for cluster_id, weights in expected.items():
+		assert actual[cluster_id].keys() == weights.keys()
+		for dbf_id, weight in weights.items():
+			assert actual[cluster_id][dbf_id] == pytest.approx(weight, rel=1e-12)
+
+
+@pytest.mark.parametrize("use_ccp", [True, False])
+@pytest.mark.parametrize("use_thresholds", [True, False])
+@pytest.mark.parametrize("use_pcp_adjustment", [True, False])
+def test_signature_weights_matrix(cluster_data, use_ccp, use_thresholds, use_pcp_adjustment):
+	expected = calculate_signature_weights(
+		cluster_data,
+		use_ccp=use_ccp,
+		use_thresholds=use_thresholds,
+		use_pcp_adjustment=use_pcp_adjustment
+	)
+
+	actual = calculate_signature_weights_matrix(
+		*to_signature_matrix(cluster_data),
+		use_ccp=use_ccp,
+		use_thresholds=use_thresholds,
+		use_pcp_adjustment=use_pcp_adjustment
+	)
+	assert_signatures_equal(actual, expected)
+
+
+def test_signature_weights_matrix_excluded_decks(cluster_data):
+	presence, observations, labels, dbf_ids, cluster_ids = to_signature_matrix(cluster_data)
+	labels[labels % 2 == 1] = -1
+
+	expected = calculate_signature_weights(cluster_data[::2])
+	actual = calculate_signature_weights_matrix(
+		presence, observations, labels, dbf_ids, cluster_ids
+	)
+	assert_signatures_equal(actual, expected)
+
+
+def test_cross_cluster_prevalence(cluster_data):
+	raw_weights = calculate_signature_weights(cluster_data, use_ccp=False)
+	ccp_input_weights = generate_ccp_input_weights(raw_weights)
+
+	expected = {}
+	for cluster_id, weights in ccp_input_weights.items():
+		others = {k: v for k, v in ccp_input_weights.items() if k != cluster_id}
+		expected[cluster_id] = apply_cross_cluster_prevalence(weights, others)
+
+	assert calculate_cross_cluster_prevalence(ccp_input_weights) == expected
+	assert calculate_cross_cluster_prevalence({1: {"1": 0.5}}) == {1: {"1": 0.5}}
+	assert calculate_cross_cluster_prevalence({}) == {}
+
+
+def _records(cluster_data):
+	for cluster_id, decks in cluster_data:
+		for deck in decks:
+			yield cluster_id, deck["cards"], deck["observations"]
+
+
+@pytest.mark.parametrize("use_thresholds", [True, False])
+@pytest.mark.parametrize("use_pcp_adjustment", [True, False])
+def test_signature_accumulator(cluster_data, use_thresholds, use_pcp_adjustment):
+	accumulator = SignatureAccumulator(
+		use_thresholds=use_thresholds,
+		use_pcp_adjustment=use_pcp_adjustment
+	)
+	# Interleave the clusters, as an unordered cursor would
+	records = sorted(_records(cluster_data), key=lambda t: t[2])
+	accumulator.update(iter(records))
+
+	for use_ccp, actual in (
+		(False, accumulator.signature_weights()),
+		(True, accumulator.ccp_signature_weights()),
+	):
+		expected = calculate_signature_weights(
+			cluster_data,
+			use_ccp=use_ccp,
+			use_thresholds=use_thresholds,
+			use_pcp_adjustment=use_pcp_adjustment
+		)
+		assert_signatures_equal(actual, expected)
+
+	expected = calculate_signature_weights(cluster_data[:3], use_thresholds=use_thresholds)
+	assert_signatures_equal(accumulator.ccp_signature_weights(cluster_ids=[0, 1, 2]), expected)
+
+
+def _shard_state(records):
+	accumulator = SignatureAccumulator(use_thresholds=False)
+	accumulator.update(records)
+	return json.dumps(accumulator.to_dict())
+
+
+def test_signature_accumulator_merge(cluster_data):
+	records = list(_records(cluster_data))
+	shards = [records[i::3] for i in range(3)]
+
+	with Pool(3) as pool:
+		states = pool.map(_shard_state, shards)
+
+	partials = [SignatureAccumulator.from_dict(json.loads(state)) for state in states]
+	merged = SignatureAccumulator(use_thresholds=False)
+	for partial in reversed(partials):
+		merged.merge(partial)
+
+	single = SignatureAccumulator(use_thresholds=False).update(records)
+	assert merged.cluster_counts == single.cluster_counts
+	assert merged.class_counts == single.class_counts
+
+	for use_ccp, actual in (
+		(False, merged.signature_weights()),
+		(True, merged.ccp_signature_weights()),
+	):
+		expected = calculate_signature_weights(
+			cluster_data, use_ccp=use_ccp, use_thresholds=False
+		)
+		assert_signatures_equal(actual, expected)
+
+	with pytest.raises(ValueError):
+		merged.merge(SignatureAccumulator(use_thresholds=True))
+
+
+@pytest.mark.parametrize("half_life", [3600, 30])
+def test_decayed_signature_accumulator(cluster_data, half_life):
+	records = [
+		(cluster_id, cards, observations, 1000 + 120 * i)
+		for i, (cluster_id, cards, observations) in enumerate(_records(cluster_data))
+	]
+	now = records[-1][3]
+
+	accumulator = DecayedSignatureAccumulator(half_life=half_life, use_thresholds=False)
+	accumulator.update(records)
+	if half_life == 30:
+		# The counters have been rebased along the way
+		assert accumulator.reference_time > records[0][3]
+
+	expected = SignatureAccumulator(use_thresholds=False)
+	for cluster_id, cards, observations, timestamp in records:
+		expected.add(cluster_id, cards, observations * 2 ** ((timestamp - now) / half_life))
+
+	assert_signatures_equal(accumulator.signature_weights(), expected.signature_weights())
+	assert_signatures_equal(accumulator.ccp_signature_weights(), expected.ccp_signature_weights())
+	assert accumulator.observations(0, at=now) == pytest.approx(expected.cluster_counts[0][1])
+	assert accumulator.observations(at=now + half_life) == \
+		pytest.approx(expected.class_counts[1] / 2)
+
+	# Shards folded in separately and merged match a single accumulator
+	shards = [DecayedSignatureAccumulator(half_life=half_life, use_thresholds=False) for i in range(2)]
+	shards[0].update(records[1::2])
+	shards[1].update(records[::2])
+	merged = DecayedSignatureAccumulator.from_dict(shards[0].to_dict()).merge(shards[1])
+	assert_signatures_equal(merged.signature_weights(), expected.signature_weights())
+
+
+def test_decayed_signature_accumulator_prune():
+	accumulator = DecayedSignatureAccumulator(half_life=60)
+	accumulator.add(1, {"1": 2, "2": 1}, 10, timestamp=0)
+	accumulator.add(1, {"1": 2}, 10, timestamp=600)
+	accumulator.prune(0.01)
+
+	assert list(accumulator.cluster_counts[1][0]) == ["1"]
+	assert list(accumulator.class_counts[0]) == ["1"]
+
+
+def test_decayed_signature_accumulator_options():
+	accumulator = DecayedSignatureAccumulator(
+		{"1": 0.5}, False, half_life=60, use_pcp_adjustment=False
+	)
+
+	assert accumulator.half_life == 60
+	assert accumulator.thresholds == {"1": 0.5}
+	assert not accumulator.use_thresholds
+	assert not accumulator.use_pcp_adjustment
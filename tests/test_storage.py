@@ -0,0 +1,134 @@
+import json
+
+import pytest
+from hearthstone.enums import FormatType
+
+from hsarchetypes.clustering import Cluster, ClusterSet
+from hsarchetypes.storage import ClusterSetFile, MappedDataPoints
+
+from .utils import DECKSTRINGS, build_cluster_set
+
+
+np = pytest.importorskip("numpy")
+
+
+def _cluster_set():
+	cluster_set = build_cluster_set(DECKSTRINGS * 2)
+	cluster_set.as_of = "2019-01-01T00:00:00"
+	cluster_set.game_format = FormatType.FT_WILD
+	cluster_set.live_in_production = False
+	cluster_set.latest = True
+	class_cluster = cluster_set.class_clusters[0]
+	for i, cluster in enumerate(class_cluster.clusters):
+		cluster.data_points[0].update(x=i * 0.25, y=-i / 3)
+	cluster_set.consolidate_clusters(0.5)
+	cluster_set.create_experimental_clusters({"DRUID": 6})
+
+	# A cluster without signatures and data points without coordinates
+	empty = Cluster.create(Cluster, cluster_set, 10, [])
+	empty.signature = []
+	class_cluster.clusters.append(empty)
+	del class_cluster.clusters[0].data_points[0]["y"]
+	class_cluster.clusters[0].data_points[0]["shortid"] = "abc"
+	return cluster_set
+
+
+def test_binary_round_trip(tmpdir):
+	cluster_set = _cluster_set()
+	path = str(tmpdir.join("clusters.bin"))
+	cluster_set.write_binary(path)
+
+	loaded = ClusterSet.load_binary(path)
+	assert loaded.to_json() == cluster_set.to_json()
+	assert loaded.game_format == FormatType.FT_WILD
+	assert any(c.experimental for c in loaded.class_clusters[0].clusters)
+
+	signatures_only = ClusterSet.load_binary(path, data_points=False)
+	expected = json.loads(cluster_set.to_json())
+	for class_cluster in expected["class_clusters"]:
+		for cluster in class_cluster["clusters"]:
+			cluster["data_points"] = []
+	assert json.loads(signatures_only.to_json()) == expected
+
+
+def test_binary_round_trip_mixed_observations(tmpdir):
+	cluster_set = _cluster_set()
+	cluster_set.class_clusters[0].clusters[0].data_points[0]["observations"] = 2.5
+	path = str(tmpdir.join("clusters.bin"))
+	cluster_set.write_binary(path)
+
+	loaded = ClusterSet.load_binary(path)
+	assert loaded.to_json() == cluster_set.to_json()
+	observations = [d["observations"] for c in loaded.class_clusters[0].clusters for d in c.data_points]
+	assert [type(o) for o in observations].count(float) == 1
+
+
+def test_load_binary_mapped_data_points(tmpdir):
+	cluster_set = _cluster_set()
+	path = str(tmpdir.join("clusters.bin"))
+	cluster_set.write_binary(path)
+
+	loaded = ClusterSet.load_binary(path)
+	clusters = loaded.class_clusters[0].clusters
+	assert all(isinstance(c.data_points, MappedDataPoints) for c in clusters)
+	assert not any(c.data_points.decoded for c in clusters)
+	assert [len(c.data_points) for c in clusters] == [
+		len(c.data_points) for c in cluster_set.class_clusters[0].clusters
+	]
+
+	# Only the accessed cluster is decoded, and keeps its decoded data points
+	assert clusters[0].observations == cluster_set.class_clusters[0].clusters[0].observations
+	assert clusters[0].data_points.decoded
+	assert not any(c.data_points.decoded for c in clusters[1:])
+	assert clusters[0].data_points[0] is clusters[0].data_points[0]
+
+	observations = loaded.binary_file.array("observations")
+	assert not observations.flags.writeable
+	del observations
+	loaded.binary_file.close()
+
+
+def test_cluster_set_file_arrays(tmpdir):
+	cluster_set = _cluster_set()
+	path = str(tmpdir.join("clusters.bin"))
+	cluster_set.write_binary(path)
+
+	data_points = [d for c in cluster_set.class_clusters[0].clusters for d in c.data_points]
+	f = ClusterSetFile(path)
+	observations = f.array("observations")
+	assert observations.tolist() == [d["observations"] for d in data_points]
+	assert not observations.flags.writeable
+	assert np.isnan(f.array("y")[0])
+	assert f.array("card_offsets")[-1] == sum(len(d["cards"]) for d in data_points)
+	del observations
+	f.close()
+
+
+def test_cluster_set_file_header(tmpdir):
+	cluster_set = _cluster_set()
+	clusters = cluster_set.class_clusters[0].clusters
+	for i, data_point in enumerate(d for c in clusters for d in c.data_points):
+		data_point["shortid"] = "deck-%i" % (i)
+		data_point["decklist"] = [i, {"rank": None}]
+	path = str(tmpdir.join("clusters.bin"))
+	cluster_set.write_binary(path)
+
+	# Per data point values are stored in the arrays rather than the header
+	f = ClusterSetFile(path)
+	header = json.dumps(f.header)
+	assert "deck-" not in header
+	assert "rank" not in header
+	assert len(f.header["layouts"]) == 2
+	f.close()
+
+	loaded = ClusterSet.load_binary(path)
+	assert loaded.to_json() == cluster_set.to_json()
+	loaded.binary_file.close()
+
+
+def test_cluster_set_file_invalid(tmpdir):
+	path = tmpdir.join("clusters.json")
+	path.write(_cluster_set().to_json())
+
+	with pytest.raises(ValueError):
+		ClusterSetFile(str(path))
@@ -0,0 +1,24 @@
+from hearthstone.enums import Rarity
+
+from hsarchetypes.synthetic import DECK_SIZE, generate_input_data
+from hsarchetypes.utils import card_db
+
+
+def test_generate_input_data():
+	input_data = generate_input_data(num_classes=2, clusters_per_class=3, decks_per_cluster=4, seed=1)
+
+	assert list(input_data) == ["DRUID", "HUNTER"]
+	assert input_data == generate_input_data(
+		num_classes=2, clusters_per_class=3, decks_per_cluster=4, seed=1
+	)
+
+	db = card_db()
+	for data_points in input_data.values():
+		assert len(data_points) == 12
+		assert sorted(set(d["archetype"] for d in data_points)) == [0, 1, 2]
+		for data_point in data_points:
+			assert sum(data_point["cards"].values()) == DECK_SIZE
+			assert data_point["observations"] >= 1
+			for dbf_id, count in data_point["cards"].items():
+				if db[int(dbf_id)].rarity == Rarity.LEGENDARY:
+					assert count == 1
@@ -1,4 +1,14 @@
 from hearthstone.deckstrings import parse_deckstring
+from hearthstone.enums import CardClass
+
+from hsarchetypes.clustering import ClassClusters, Cluster, ClusterSet
+
+
+DECKSTRINGS = [
+	"AAECAZICCMQGws4Cr9MC5tMCjeYC8eoC3esCv/ICC0Bf6QHkCMnHApTSApjSAp7SAovhAoTmAo3wAgA=",
+	"AAECAZICBFaHzgKZ0wLx+wINQF/pAf4BxAbkCKDNApTSApjSAp7SAtvTAoTmAr/yAgA=",
+	"AAECAZICApnTAvH7Ag5AX+kB/gHTA8QGpAf2B+QIktICmNICntICv/ICj/YCAA==",
+]
 
 
 def get_deck_from_deckstring(deckstring):
@@ -10,3 +20,21 @@ def get_data_point_from_deckstring(deckstring):
 	return {
 		"cards": get_deck_from_deckstring(deckstring),
 	}
+
+
+def build_cluster_set(deckstrings=DECKSTRINGS, tracer=None):
+	"""
+	Return a ClusterSet with a single Druid ClassClusters, one cluster per deckstring.
+	The data point of the i-th cluster is observed i + 1 times.
+	"""
+	cluster_set = ClusterSet()
+	if tracer is not None:
+		cluster_set.tracer = tracer
+	clusters = []
+	for i, deckstring in enumerate(deckstrings):
+		deck = get_deck_from_deckstring(deckstring)
+		data_point = {"cards": {str(k): v for k, v in deck.items()}, "observations": i + 1}
+		clusters.append(Cluster.create(Cluster, cluster_set, i, [data_point]))
+	class_cluster = ClassClusters.create(ClassClusters, cluster_set, CardClass.DRUID, clusters)
+	setattr(cluster_set, "class_clusters", [class_cluster])
+	return cluster_set